@@ -0,0 +1,408 @@
+"""TGAssist 基准测试
+
+用合成的 Telegram Update 和导出文件驱动 TelegramBot 的热点路径。Bot API 为本地假实现
+（见 benchmarks/fakes.py），Gemini 使用 fake 后端（GEMINI_BACKEND=fake），不需要网络和真实的 Token。
+
+用法（在项目根目录运行）：
+    python -m benchmarks.bench_bot                          # 运行全部场景
+    python -m benchmarks.bench_bot --scenario ingest --messages 50000
+    python -m benchmarks.bench_bot --json baseline.json     # 保存结果
+    python -m benchmarks.bench_bot --baseline baseline.json # 与基线比较，退化时返回非零状态
+
+每个场景在独立的子进程和临时目录中运行，使用全新的数据库，峰值 RSS 互不影响。
+合成数据由 --seed 决定，相同参数的多次运行处理的数据完全一致。
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+OWNER_ID = 1
+TOKEN = '123456:BENCHMARK'
+SCENARIOS = ('ingest', 'store_batch', 'import_json', 'callbacks')
+CALLBACK_ACTIONS = ('analyze', 'actions_group', 'suggest', 'actions_today')
+
+# 项目根目录，子进程切换到临时目录后仍需从这里导入 main 和 utils
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _configure_env(options):
+    """导入 settings 之前设置运行所需的环境变量，不读取真实配置"""
+    os.environ.update({
+        'TELEGRAM_TOKEN': TOKEN,
+        'BOT_OWNER_ID': str(OWNER_ID),
+        'GEMINI_BACKEND': 'fake',
+        'GEMINI_FAKE_LATENCY': str(options['gemini_latency']),
+        'GEMINI_FAKE_JITTER': str(options['gemini_jitter']),
+        'GEMINI_FAKE_ERROR_RATE': '0',
+        'GEMINI_FAKE_RPM': '0',
+        'GEMINI_FAKE_SEED': str(options['seed']),
+        'USE_WEBHOOK': 'false',
+        'METRICS_PORT': '0',
+        'LOG_LEVEL': 'WARNING',
+        # 后台自动分析由 callbacks 场景单独衡量，写入场景中不触发
+        'ANALYSIS_DEBOUNCE_SECONDS': '3600',
+    })
+
+
+def percentile(samples, fraction):
+    """最近秩法计算分位数"""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = max(0, min(len(ordered) - 1, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def summarize(scenario, name, count, seconds, samples):
+    return {
+        'scenario': scenario,
+        'name': name,
+        'count': count,
+        'seconds': round(seconds, 4),
+        'per_sec': round(count / seconds, 1) if seconds > 0 else 0.0,
+        'p50_ms': round(percentile(samples, 0.50) * 1000, 3),
+        'p99_ms': round(percentile(samples, 0.99) * 1000, 3),
+    }
+
+
+class SyntheticChats:
+    """按固定随机种子生成群组、用户和消息内容"""
+
+    WORDS = [
+        '今天', '明天', '会议', '项目', '进度', '上线', '测试', '问题', '需要', '确认',
+        'deploy', 'review', 'PR', 'bug', 'fix', 'OK', '好的', '收到', '谢谢', '稍等',
+        '文档', '接口', '数据库', '性能', '优化', '周报', '安排', '时间', '下午', '晚上',
+        '@owner', '请看一下', 'https://example.com/issue/42', '？', '！', '。',
+    ]
+
+    def __init__(self, seed, groups, users=50):
+        self.rng = random.Random(seed)
+        self.groups = [-(1000000000000 + index) for index in range(groups)]
+        self.users = [(1000 + index, f'user{index}') for index in range(users)]
+
+    def text(self):
+        # 大多数消息很短，少数是长消息
+        words = self.rng.choice((3, 5, 8, 12, 20, 60))
+        return ' '.join(self.rng.choice(self.WORDS) for _ in range(words))
+
+    def records(self, count, start=None):
+        """生成可直接写入数据库的消息记录，时间戳从 start 起递增"""
+        start = start or datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        message_ids = {chat_id: 0 for chat_id in self.groups}
+        for index in range(count):
+            chat_id = self.groups[index % len(self.groups)]
+            message_ids[chat_id] += 1
+            user_id, username = self.rng.choice(self.users)
+            yield {
+                'chat_id': chat_id,
+                'message_id': message_ids[chat_id],
+                'user_id': user_id,
+                'username': username,
+                'message_text': self.text(),
+                'timestamp': (start + timedelta(seconds=index)).isoformat(),
+            }
+
+    def export_json(self, count):
+        """生成 Telegram Desktop 格式的导出文件内容"""
+        start = datetime(2024, 1, 1)
+        messages = []
+        for index in range(count):
+            user_id, username = self.rng.choice(self.users)
+            messages.append({
+                'id': index + 1,
+                'type': 'message',
+                'date': (start + timedelta(seconds=index)).isoformat(),
+                'from': username,
+                'from_id': f'user{user_id}',
+                'text': self.text(),
+            })
+        export = {'name': 'Bench Export', 'type': 'private_supergroup', 'id': 2000000000, 'messages': messages}
+        return json.dumps(export, ensure_ascii=False).encode('utf-8')
+
+
+class Harness:
+    """在假 Bot API 和假 Gemini 上运行的 TelegramBot"""
+
+    def __init__(self, options):
+        from telegram.ext import Application
+        from main import TelegramBot
+        from benchmarks.fakes import FakeBotRequest
+
+        self.options = options
+        self.request = FakeBotRequest(latency=options['api_latency'])
+        self.application = (
+            Application.builder()
+            .token(TOKEN)
+            .request(self.request)
+            .get_updates_request(FakeBotRequest())
+            .build()
+        )
+        self.bot = TelegramBot()
+        if not options['cache']:
+            self.bot.gemini.cache = None
+        self.chats = SyntheticChats(options['seed'], options['groups'])
+        self._update_ids = itertools.count(1)
+
+    async def __aenter__(self):
+        await self.application.initialize()
+        self.bot.buffer.start()
+        self.bot.scheduler.start()
+        self.bot.backfill.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.bot.buffer.close()
+        await self.bot.scheduler.stop()
+        await self.bot.backfill.stop()
+        self.bot.db.close()
+        await self.application.shutdown()
+
+    def update(self, data):
+        from telegram import Update
+        data['update_id'] = next(self._update_ids)
+        return Update.de_json(data, self.application.bot)
+
+    def context(self, update):
+        return self.application.context_types.context.from_update(update, self.application)
+
+    @staticmethod
+    def owner():
+        return {'id': OWNER_ID, 'is_bot': False, 'first_name': 'Owner', 'username': 'owner'}
+
+    def group_message(self, record):
+        user_id, username = record['user_id'], record['username']
+        return self.update({'message': {
+            'message_id': record['message_id'],
+            'date': int(time.time()),
+            'chat': {'id': record['chat_id'], 'type': 'supergroup', 'title': f"Bench Group {record['chat_id']}"},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': username, 'username': username},
+            'text': record['message_text'],
+        }})
+
+    def private_document(self, file_id, file_name='result.json'):
+        return self.update({'message': {
+            'message_id': 1,
+            'date': int(time.time()),
+            'chat': {'id': OWNER_ID, 'type': 'private'},
+            'from': self.owner(),
+            'document': {'file_id': file_id, 'file_unique_id': file_id, 'file_name': file_name},
+        }})
+
+    def callback(self, data):
+        return self.update({'callback_query': {
+            'id': str(next(self._update_ids)),
+            'from': self.owner(),
+            'chat_instance': 'benchmark',
+            'data': json.dumps(data),
+            'message': {
+                'message_id': 1,
+                'date': int(time.time()),
+                'chat': {'id': OWNER_ID, 'type': 'private'},
+                'text': '请选择群组：',
+            },
+        }})
+
+    async def drive(self, handler, updates):
+        """以 options['concurrency'] 的并发调用处理函数，返回 (总耗时, 每次调用耗时)"""
+        semaphore = asyncio.Semaphore(self.options['concurrency'])
+        samples = []
+
+        async def call(update):
+            async with semaphore:
+                start = time.perf_counter()
+                await handler(update, self.context(update))
+                samples.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(call(update) for update in updates))
+        return time.perf_counter() - start, samples
+
+
+async def bench_ingest(harness, options):
+    """群组消息经 message_handler 进入写入缓冲区并落盘"""
+    count = options['messages']
+    updates = [harness.group_message(record) for record in harness.chats.records(count)]
+    start = time.perf_counter()
+    _, samples = await harness.drive(harness.bot.message_handler, updates)
+    await harness.bot.buffer.flush()
+    elapsed = time.perf_counter() - start
+    return [summarize('ingest', 'message_handler', count, elapsed, samples)]
+
+
+async def bench_store_batch(harness, options):
+    """store_messages_batch 批量写入"""
+    records = list(harness.chats.records(options['messages']))
+    size = options['batch_size']
+    samples = []
+    start = time.perf_counter()
+    for offset in range(0, len(records), size):
+        batch_start = time.perf_counter()
+        await harness.bot.db.store_messages_batch(records[offset:offset + size])
+        samples.append(time.perf_counter() - batch_start)
+    elapsed = time.perf_counter() - start
+    return [summarize('store_batch', f'batch={size}', len(records), elapsed, samples)]
+
+
+async def bench_import_json(harness, options):
+    """通过 import_json 导入导出文件：第一次全部为新消息，之后的导入全部去重"""
+    count = options['messages']
+    harness.request.add_file('export', harness.chats.export_json(count))
+    results = []
+    for run in range(options['import_runs']):
+        update = harness.private_document('export')
+        elapsed, samples = await harness.drive(harness.bot.import_json, [update])
+        name = 'first import' if run == 0 else 're-import (duplicates)'
+        results.append(summarize('import_json', name, count, elapsed, samples))
+    return results
+
+
+async def bench_callbacks(harness, options):
+    """handle_callback 中调用 Gemini 的操作"""
+    chats = harness.chats
+    records = list(chats.records(options['history']))
+    await harness.bot.db.store_messages_batch(records)
+    for chat_id in chats.groups:
+        await harness.bot.db.update_chat_info(chat_id, f'Bench Group {chat_id}')
+
+    results = []
+    requests = options['requests']
+    for action in CALLBACK_ACTIONS:
+        if action == 'actions_today':
+            # 每次请求都会遍历所有群组，请求数按群组数缩减
+            updates = [harness.callback({'action': action}) for _ in range(max(1, requests // len(chats.groups)))]
+        else:
+            updates = [
+                harness.callback({'action': action, 'group_id': chats.groups[index % len(chats.groups)]})
+                for index in range(requests)
+            ]
+        elapsed, samples = await harness.drive(harness.bot.handle_callback, updates)
+        results.append(summarize('callbacks', action, len(updates), elapsed, samples))
+    return results
+
+
+BENCHMARKS = {
+    'ingest': bench_ingest,
+    'store_batch': bench_store_batch,
+    'import_json': bench_import_json,
+    'callbacks': bench_callbacks,
+}
+
+
+def run_scenario(scenario, options):
+    """在当前（子）进程中运行一个场景，返回结果列表"""
+    workdir = tempfile.mkdtemp(prefix=f'tgassist-bench-{scenario}-')
+    os.chdir(workdir)
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    _configure_env(options)
+
+    async def run():
+        async with Harness(options) as harness:
+            results = await BENCHMARKS[scenario](harness, options)
+            api_calls = sum(harness.request.calls.values())
+        return results, api_calls
+
+    results, api_calls = asyncio.run(run())
+    # Linux 上 ru_maxrss 的单位为 KB
+    peak_rss_mb = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    for result in results:
+        result['peak_rss_mb'] = peak_rss_mb
+        result['api_calls'] = api_calls
+    return results
+
+
+def print_report(results):
+    header = f"{'scenario':<12} {'name':<24} {'count':>8} {'per_sec':>10} {'p50_ms':>10} {'p99_ms':>10} {'rss_mb':>8}"
+    print(header)
+    print('-' * len(header))
+    for r in results:
+        print(f"{r['scenario']:<12} {r['name']:<24} {r['count']:>8} {r['per_sec']:>10} "
+              f"{r['p50_ms']:>10} {r['p99_ms']:>10} {r['peak_rss_mb']:>8}")
+
+
+def compare(results, baseline, tolerance):
+    """与基线比较吞吐量和 p99 延迟，返回退化项列表"""
+    previous = {(r['scenario'], r['name']): r for r in baseline}
+    regressions = []
+    for r in results:
+        base = previous.get((r['scenario'], r['name']))
+        if not base:
+            continue
+        if base['per_sec'] and r['per_sec'] < base['per_sec'] * (1 - tolerance):
+            regressions.append(f"{r['scenario']}/{r['name']}: 吞吐量 {base['per_sec']} -> {r['per_sec']} /s")
+        if base['p99_ms'] and r['p99_ms'] > base['p99_ms'] * (1 + tolerance):
+            regressions.append(f"{r['scenario']}/{r['name']}: p99 {base['p99_ms']} -> {r['p99_ms']} ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="TGAssist 写入与分析路径基准测试")
+    parser.add_argument('--scenario', choices=SCENARIOS, action='append', help="要运行的场景，可重复；默认全部")
+    parser.add_argument('--messages', type=int, default=20000, help="ingest/store_batch/import_json 的消息数")
+    parser.add_argument('--groups', type=int, default=10, help="合成群组数")
+    parser.add_argument('--batch-size', type=int, default=1000, help="store_batch 每批消息数")
+    parser.add_argument('--import-runs', type=int, default=2, help="import_json 重复导入次数")
+    parser.add_argument('--history', type=int, default=5000, help="callbacks 场景预先写入的历史消息数")
+    parser.add_argument('--requests', type=int, default=50, help="callbacks 场景每种操作的请求数")
+    parser.add_argument('--concurrency', type=int, default=16, help="同时处理的 Update 数")
+    parser.add_argument('--api-latency', type=float, default=0.0, help="假 Bot API 每次调用的延迟（秒）")
+    parser.add_argument('--gemini-latency', type=float, default=0.2, help="fake Gemini 后端的延迟中位数（秒）")
+    parser.add_argument('--gemini-jitter', type=float, default=0.3, help="fake Gemini 后端延迟分布的离散程度")
+    parser.add_argument('--cache', action='store_true', help="启用 Gemini 响应缓存")
+    parser.add_argument('--seed', type=int, default=42, help="合成数据的随机种子")
+    parser.add_argument('--json', help="把结果写入 JSON 文件")
+    parser.add_argument('--baseline', help="与之前保存的 JSON 结果比较")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="允许的退化比例")
+    args = parser.parse_args()
+
+    options = {
+        'messages': args.messages,
+        'groups': args.groups,
+        'batch_size': args.batch_size,
+        'import_runs': args.import_runs,
+        'history': args.history,
+        'requests': args.requests,
+        'concurrency': args.concurrency,
+        'api_latency': args.api_latency,
+        'gemini_latency': args.gemini_latency,
+        'gemini_jitter': args.gemini_jitter,
+        'cache': args.cache,
+        'seed': args.seed,
+    }
+
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for scenario in args.scenario or SCENARIOS:
+        print(f"运行场景：{scenario}", file=sys.stderr)
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            results.extend(executor.submit(run_scenario, scenario, options).result())
+
+    print_report(results)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as output:
+            json.dump({'options': options, 'results': results}, output, ensure_ascii=False, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as baseline_file:
+            baseline = json.load(baseline_file)['results']
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("\n性能退化：", file=sys.stderr)
+            for regression in regressions:
+                print(f"  {regression}", file=sys.stderr)
+            sys.exit(1)
+        print("\n与基线相比没有超过阈值的退化", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+"""向量索引基准测试
+
+衡量 utils/embedding_index.py 的索引吞吐量、近似检索的延迟和召回率，以及内存和磁盘占用。
+需要安装 numpy；不需要 Telegram 和 Gemini 的配置。
+
+用法（在项目根目录运行）：
+    python -m benchmarks.bench_embeddings
+    python -m benchmarks.bench_embeddings --messages 1000000 --queries 500
+    python -m benchmarks.bench_embeddings --json embeddings.json
+
+召回率以精确检索（对所有向量计算相似度）的前 k 个结果为基准；合成消息的词汇很少，
+相似度并列的情况很多，因此按分数计算：近似结果的分数不低于精确结果第 k 名的分数即视为命中。
+"""
+import argparse
+import itertools
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from benchmarks.bench_bot import SyntheticChats, summarize
+
+
+def _rss_mb():
+    # Linux 上 ru_maxrss 的单位为 KB
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def recall_at_k(approximate, exact, k):
+    if not exact:
+        return 1.0
+    threshold = exact[min(k, len(exact)) - 1][1] - 1e-6
+    return min(1.0, sum(1 for _, score in approximate[:k] if score >= threshold) / min(k, len(exact)))
+
+
+def run(options):
+    from utils.embedding_index import EmbeddingIndex
+
+    workdir = tempfile.mkdtemp(prefix='tgassist-bench-embeddings-')
+    results = []
+    try:
+        index = EmbeddingIndex(os.path.join(workdir, 'embeddings'))
+        chats = SyntheticChats(options['seed'], options['groups'])
+        records = chats.records(options['messages'])
+        rss_before = _rss_mb()
+
+        # 索引：按批追加，与机器人后台任务的方式相同
+        samples = []
+        start = time.perf_counter()
+        message_id = 0
+        while True:
+            batch = list(itertools.islice(records, options['batch_size']))
+            if not batch:
+                break
+            ids = list(range(message_id + 1, message_id + len(batch) + 1))
+            message_id += len(batch)
+            batch_start = time.perf_counter()
+            index.append(ids, [r['chat_id'] for r in batch], [r['message_text'] for r in batch])
+            samples.append(time.perf_counter() - batch_start)
+        result = summarize('embeddings', 'index', index.count, time.perf_counter() - start, samples)
+        result['unit'] = 'batch'
+        results.append(result)
+
+        # 查询：近似检索、按群组过滤的近似检索和精确检索
+        queries = [chats.text() for _ in range(options['queries'])]
+        timings = {'search_ann': [], 'search_ann_group': [], 'search_exact': []}
+        recalls = []
+        k = options['k']
+        for number, query in enumerate(queries):
+            began = time.perf_counter()
+            approximate = index.search(query, limit=k)
+            timings['search_ann'].append(time.perf_counter() - began)
+
+            began = time.perf_counter()
+            index.search(query, limit=k, chat_id=chats.groups[number % len(chats.groups)])
+            timings['search_ann_group'].append(time.perf_counter() - began)
+
+            began = time.perf_counter()
+            exact = index.search(query, limit=k, candidates=None)
+            timings['search_exact'].append(time.perf_counter() - began)
+            recalls.append(recall_at_k(approximate, exact, k))
+
+        for name, samples in timings.items():
+            result = summarize('embeddings', name, len(samples), sum(samples), samples)
+            result['unit'] = 'query'
+            results.append(result)
+        results[1][f'recall_at_{k}'] = round(sum(recalls) / len(recalls), 4)
+
+        footprint = {
+            'index_mb': round(index.nbytes / 1024 / 1024, 1),
+            'bytes_per_message': round(index.nbytes / max(1, index.capacity), 1),
+            'rss_growth_mb': round(_rss_mb() - rss_before, 1),
+            'peak_rss_mb': _rss_mb(),
+        }
+        for result in results:
+            result.update(footprint)
+        return results
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def print_report(results):
+    header = f"{'name':<18} {'count':>8} {'per_sec':>10} {'p50_ms':>10} {'p99_ms':>10} {'recall':>8}"
+    print(header)
+    print('-' * len(header))
+    for r in results:
+        recall = next((value for key, value in r.items() if key.startswith('recall_at_')), '')
+        print(f"{r['name']:<18} {r['count']:>8} {r['per_sec']:>10} {r['p50_ms']:>10} {r['p99_ms']:>10} {recall:>8}")
+    if results:
+        r = results[0]
+        print(f"\n索引文件 {r['index_mb']} MB（每条 {r['bytes_per_message']} 字节），"
+              f"RSS 增长 {r['rss_growth_mb']} MB，峰值 RSS {r['peak_rss_mb']} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="TGAssist 向量索引基准测试")
+    parser.add_argument('--messages', type=int, default=200000, help="索引的消息数")
+    parser.add_argument('--groups', type=int, default=10, help="合成群组数")
+    parser.add_argument('--batch-size', type=int, default=5000, help="每批追加的消息数")
+    parser.add_argument('--queries', type=int, default=200, help="查询次数")
+    parser.add_argument('--k', type=int, default=10, help="每次查询返回的结果数")
+    parser.add_argument('--seed', type=int, default=42, help="合成数据的随机种子")
+    parser.add_argument('--json', help="把结果写入 JSON 文件")
+    args = parser.parse_args()
+
+    options = {
+        'messages': args.messages,
+        'groups': args.groups,
+        'batch_size': args.batch_size,
+        'queries': args.queries,
+        'k': args.k,
+        'seed': args.seed,
+    }
+    print(f"索引 {args.messages} 条消息，查询 {args.queries} 次", file=sys.stderr)
+    results = run(options)
+    print_report(results)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as output:
+            json.dump({'options': options, 'results': results}, output, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
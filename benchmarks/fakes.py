@@ -0,0 +1,87 @@
+"""基准测试使用的假 Bot API，不访问网络
+
+Gemini 使用 utils/gemini_backends.py 中的 FakeGeminiBackend（GEMINI_BACKEND=fake）。
+"""
+import asyncio
+import itertools
+import json
+import time
+
+from telegram.request import BaseRequest
+
+BOT_ID = 100000
+BOT_USERNAME = 'bench_bot'
+
+
+class FakeBotRequest(BaseRequest):
+    """在内存中应答 Bot API 请求的 BaseRequest 实现
+
+    每次调用等待 latency 秒模拟网络延迟，并按方法统计调用次数。
+    通过 add_file 注册的文件可以被 get_file / download_to_drive 下载。
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = {}
+        self.files = {}
+        self._message_ids = itertools.count(1)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @property
+    def read_timeout(self):
+        return None
+
+    def add_file(self, file_id, content):
+        """注册一个可下载的文件，返回其 file_path"""
+        file_path = f'documents/{file_id}.json'
+        self.files[file_path] = content
+        return file_path
+
+    def _message(self, params):
+        return {
+            'message_id': int(params.get('message_id') or next(self._message_ids)),
+            'date': int(time.time()),
+            'chat': {'id': int(params.get('chat_id') or 0), 'type': 'private'},
+            'text': params.get('text', ''),
+        }
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        # 文件下载：https://api.telegram.org/file/bot<token>/<file_path>
+        if '/file/bot' in url:
+            file_path = url.split('/', 5)[-1]
+            self.calls['download'] = self.calls.get('download', 0) + 1
+            return 200, self.files[file_path]
+
+        api_method = url.rsplit('/', 1)[-1]
+        self.calls[api_method] = self.calls.get(api_method, 0) + 1
+        params = request_data.parameters if request_data else {}
+
+        if api_method == 'getMe':
+            result = {'id': BOT_ID, 'is_bot': True, 'first_name': 'Bench', 'username': BOT_USERNAME}
+        elif api_method == 'getChatMember':
+            result = {
+                'status': 'member',
+                'user': {'id': int(params['user_id']), 'is_bot': False, 'first_name': 'Owner'},
+            }
+        elif api_method in ('sendMessage', 'editMessageText'):
+            result = self._message(params)
+        elif api_method == 'getFile':
+            file_path = f"documents/{params['file_id']}.json"
+            result = {
+                'file_id': params['file_id'],
+                'file_unique_id': params['file_id'],
+                'file_size': len(self.files.get(file_path, b'')),
+                'file_path': file_path,
+            }
+        else:
+            result = True
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
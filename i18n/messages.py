@@ -10,9 +10,10 @@ MESSAGES = {
                '• /help - 显示此帮助信息\n'
                '• /lang - 切换语言（中文/英文）\n\n'
                '群组管理：\n'
-               '• /analyze - 分析群组历史消息\n'
+               '• /analyze [天数] - 分析群组历史消息，可指定最近若干天\n'
                '• /actions - 检查待办事项\n'
                '• /suggest - 获取回复建议\n'
+               '• /search - 搜索聊天记录（关键词都少于 3 个字时只搜索最近 2 万条消息）\n'
                '• /sync - 同步历史消息\n'
                '• /import - 导入聊天记录\n'
                '• /delete - 删除聊天记录\n\n'
@@ -37,9 +38,10 @@ MESSAGES = {
                '• /help - Show this help message\n'
                '• /lang - Change language (English/Chinese)\n\n'
                'Group Management:\n'
-               '• /analyze - Analyze group history\n'
+               '• /analyze [days] - Analyze group history, optionally the last N days\n'
                '• /actions - Check action items\n'
                '• /suggest - Get reply suggestions\n'
+               '• /search - Search chat history (if every keyword is shorter than 3 characters, only the latest 20,000 messages are searched)\n'
                '• /sync - Sync historical messages\n'
                '• /import - Import chat logs\n'
                '• /delete - Delete chat records\n\n'
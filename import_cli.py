@@ -0,0 +1,174 @@
+"""离线批量导入聊天记录
+
+不经过机器人，直接把 Telegram Desktop 导出的聊天记录（或另一个机器人数据库）
+写入 data/telegram_bot.db，不受 Telegram 文件下载大小限制。
+
+用法：
+    python import_cli.py exports 导出目录或result.json [...] [--workers 4]
+    python import_cli.py merge 其他数据库.db
+"""
+from utils.db_handler import DatabaseHandler
+from utils.export_reader import ExportReader
+from utils.logger import setup_logging
+import multiprocessing
+import argparse
+import queue
+import time
+import os
+
+# 等待解析结果的超时时间（秒），超时后检查解析进程是否异常退出
+RESULT_POLL_SECONDS = 1
+
+
+def find_export_files(paths):
+    """展开参数中的导出目录，返回所有 JSON 文件路径"""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            result_file = os.path.join(path, 'result.json')
+            if os.path.exists(result_file):
+                files.append(result_file)
+            else:
+                # 包含多个导出目录的上级目录
+                for name in sorted(os.listdir(path)):
+                    candidate = os.path.join(path, name, 'result.json')
+                    if os.path.exists(candidate):
+                        files.append(candidate)
+        elif path.endswith('.json'):
+            files.append(path)
+        else:
+            print(f"跳过无法识别的路径：{path}")
+    return files
+
+
+def parse_worker(task_queue, result_queue, batch_size):
+    """解析进程：逐个解析导出文件，把消息按批交给写入进程"""
+    while True:
+        path = task_queue.get()
+        if path is None:
+            break
+        # 记录当前解析的文件，进程异常退出时写入进程据此判断哪个文件未完成
+        result_queue.put(('start', path, os.getpid()))
+        try:
+            with open(path, encoding='utf-8') as export_file:
+                reader = ExportReader(export_file)
+                header = reader.read_header()
+                chat_id = header.get('id', 0)
+                result_queue.put(('header', path, (chat_id, header.get('name', 'Unknown Group'))))
+                for batch in reader.iter_batches(chat_id, batch_size):
+                    result_queue.put(('batch', path, batch))
+            result_queue.put(('done', path, None))
+        except Exception as e:
+            result_queue.put(('error', path, str(e)))
+
+
+def import_exports(db, paths, workers, batch_size):
+    """多进程解析导出文件，由当前进程统一写入数据库"""
+    files = find_export_files(paths)
+    if not files:
+        print("未找到任何导出文件")
+        return 0, 0
+
+    workers = max(1, min(workers, len(files)))
+    print(f"找到 {len(files)} 个导出文件，使用 {workers} 个解析进程")
+
+    task_queue = multiprocessing.Queue()
+    # 限制队列长度，解析快于写入时解析进程会等待，内存占用保持稳定
+    result_queue = multiprocessing.Queue(maxsize=workers * 4)
+    for path in files:
+        task_queue.put(path)
+    for _ in range(workers):
+        task_queue.put(None)
+
+    processes = [
+        multiprocessing.Process(target=parse_worker, args=(task_queue, result_queue, batch_size))
+        for _ in range(workers)
+    ]
+    for process in processes:
+        process.start()
+
+    total_messages = 0
+    new_messages = 0
+    finished = 0
+    # 各解析进程正在处理的文件
+    current = {}
+    try:
+        while finished < len(files):
+            try:
+                kind, path, payload = result_queue.get(timeout=RESULT_POLL_SECONDS)
+            except queue.Empty:
+                # 队列已空：被系统终止（如内存不足）的进程不会再发送结果，把它正在处理的文件记为失败
+                for process in processes:
+                    if process.exitcode not in (None, 0) and process.pid in current:
+                        finished += 1
+                        print(f"导入 {current.pop(process.pid)} 时解析进程异常退出（退出码 {process.exitcode}）")
+                if not any(process.is_alive() for process in processes) and finished < len(files):
+                    # 异常退出的进程没有取走它的结束标记，剩余的文件可能无人处理
+                    print(f"解析进程已全部退出，{len(files) - finished} 个文件未导入")
+                    break
+                continue
+            if kind == 'start':
+                current[payload] = path
+            elif kind == 'header':
+                chat_id, chat_name = payload
+                print(f"正在导入：{chat_name} (ID: {chat_id}) <- {path}")
+                db.update_chat_info(chat_id, chat_name)
+            elif kind == 'batch':
+                total_messages += len(payload)
+                new_messages += db.store_messages_batch(payload)
+            elif kind in ('done', 'error'):
+                finished += 1
+                current = {pid: current_path for pid, current_path in current.items() if current_path != path}
+                if kind == 'done':
+                    print(f"完成 {finished}/{len(files)}：{path}")
+                else:
+                    print(f"导入 {path} 时出错：{payload}")
+    except BaseException:
+        # 写入出错（如数据库被锁、磁盘已满）时不再读取结果，解析进程会一直阻塞在已满的队列上
+        for process in processes:
+            process.terminate()
+        raise
+    finally:
+        for process in processes:
+            process.join()
+
+    return total_messages, new_messages
+
+
+def main():
+    parser = argparse.ArgumentParser(description="离线批量导入 Telegram 聊天记录")
+    parser.add_argument('--db', default='data/telegram_bot.db', help="目标数据库路径")
+    parser.add_argument('--log-level', default='WARNING', help="数据库等模块的日志级别")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    exports_parser = subparsers.add_parser('exports', help="导入 Telegram Desktop 导出的 JSON 聊天记录")
+    exports_parser.add_argument('paths', nargs='+', help="导出目录、包含多个导出目录的目录或 result.json 文件")
+    exports_parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="解析进程数")
+    exports_parser.add_argument('--batch-size', type=int, default=5000, help="每个事务写入的消息数")
+
+    merge_parser = subparsers.add_parser('merge', help="合并另一个机器人数据库")
+    merge_parser.add_argument('source', help="要合并进来的数据库文件")
+
+    args = parser.parse_args()
+    setup_logging(args.log_level)
+    db = DatabaseHandler(args.db)
+    start_time = time.perf_counter()
+    try:
+        if args.command == 'exports':
+            total_messages, new_messages = import_exports(db, args.paths, args.workers, args.batch_size)
+        else:
+            total_messages, new_messages = db.merge_database(args.source)
+    finally:
+        db.close()
+    elapsed = time.perf_counter() - start_time
+
+    print("\n=== 导入完成 ===")
+    print(f"处理消息数：{total_messages}")
+    print(f"新增消息数：{new_messages}")
+    print(f"耗时：{elapsed:.2f} 秒")
+    if elapsed > 0:
+        print(f"吞吐量：{total_messages / elapsed:.0f} 条/秒")
+
+
+if __name__ == '__main__':
+    main()
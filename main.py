@@ -1,27 +1,124 @@
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, CallbackQuery
+from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ChatMemberHandler, filters, ContextTypes
 from settings import (
     TELEGRAM_TOKEN, GEMINI_API_KEY, BOT_OWNER_ID,
     USE_WEBHOOK, WEBHOOK_HOST, WEBHOOK_PORT,
     WEBHOOK_LISTEN, WEBHOOK_URL_PATH, WEBHOOK_URL,
-    DEFAULT_LANGUAGE
+    DEFAULT_LANGUAGE, GEMINI_TIMEOUT, GEMINI_MAX_CONCURRENCY,
+    INGEST_BATCH_SIZE, INGEST_FLUSH_INTERVAL_MS, OWNER_MEMBERSHIP_TTL,
+    ANALYSIS_MAX_CONCURRENCY, ANALYSIS_DEBOUNCE_SECONDS,
+    ACTIONS_MAX_CONCURRENCY, ACTIONS_TIMEOUT,
+    RESPONSE_CACHE_TTL, RESPONSE_CACHE_SIZE, CONTEXT_TOKEN_BUDGET,
+    RETRIEVAL_LIMIT, RETRIEVAL_RECENT_MESSAGES,
+    EMBEDDING_INDEX, EMBEDDING_DIR, EMBEDDING_BATCH_SIZE, SUMMARY_TREE, SUMMARY_BUILD_LIMIT,
+    LOG_LEVEL, LOG_FORMAT, LOG_SAMPLE_RATE, METRICS_LISTEN, METRICS_PORT,
+    GEMINI_BACKEND, GEMINI_FAKE_LATENCY, GEMINI_FAKE_JITTER, GEMINI_FAKE_ERROR_RATE,
+    GEMINI_FAKE_RPM, GEMINI_FAKE_SEED, GEMINI_RPM, GEMINI_TPM, GEMINI_MAX_RETRIES,
+    GEMINI_RETRY_BASE_DELAY, GEMINI_OWNER_WEIGHT
+)
+from utils.gemini_handler import GeminiHandler, GeminiError
+from utils.gemini_backends import create_backend
+from utils.db_handler import DatabaseHandler, AsyncDatabaseHandler, normalize_chat_id
+from utils.message_buffer import MessageBuffer
+from utils.cache import TTLCache
+from utils.scheduler import AnalysisScheduler
+from utils.rate_limiter import RequestGovernor
+from utils.response_cache import ResponseCache
+from utils.export_reader import ExportReader
+from utils.context_builder import build_context, estimate_tokens, truncate_text, MAX_MESSAGE_TOKENS
+from utils.retrieval import extract_keywords, select_related, merge_ranked
+from utils.summary_tree import SummaryTree, SummaryBuildLimitError
+from utils.logger import setup_logging, SAMPLED
+from utils.metrics import (
+    track_handler, start_metrics_server,
+    SCHEDULER_QUEUE_DEPTH, SCHEDULER_RUNNING, BUFFER_PENDING, GOVERNOR_QUEUE_DEPTH
 )
-from utils.gemini_handler import GeminiHandler
-from utils.db_handler import DatabaseHandler
 from i18n.messages import MESSAGES
 import asyncio
 import json
+import logging
 import os
+import tempfile
+from datetime import timedelta
+
+logger = logging.getLogger(__name__)
 
 class TelegramBot:
+    # 每次增量更新背景时最多合并的新消息数
+    SUMMARY_BATCH_SIZE = 200
+    # 合并新消息时至少留给消息的 token 数，远大于单条消息的上限，最早的一条新消息总能完整放入；
+    # 背景太长、剩余预算不足时先把背景压缩到 BACKGROUND_COMPACT_LENGTH 字
+    MIN_SUMMARY_MESSAGE_TOKENS = 4 * MAX_MESSAGE_TOKENS
+    BACKGROUND_COMPACT_LENGTH = 2000
+    # 进度消息的最短更新间隔（秒）和 Telegram 单条消息长度上限
+    PROGRESS_EDIT_INTERVAL = 2
+    # 流式输出时两次编辑消息的最短间隔（秒），避免触发 Telegram 的编辑频率限制
+    STREAM_EDIT_INTERVAL = 1.5
+    MAX_MESSAGE_LENGTH = 4096
+    # /analyze <天数> 允许的最大天数，以及一次分析中最多现场生成的分时段摘要数；
+    # 缺少的摘要更多时转为后台补齐，避免一个所有者请求长时间占用 Gemini
+    MAX_ANALYZE_DAYS = 730
+    ANALYZE_BUILD_LIMIT = 100
+    # 每次向量索引任务最多处理的批数，导入大量消息后分多次完成
+    EMBEDDING_BATCHES_PER_RUN = 4
+    # 估算读取历史消息条数时假设的每条消息最少 token 数
+    MIN_TOKENS_PER_MESSAGE = 10
+    # 导入聊天记录时每个事务写入的消息数
+    IMPORT_BATCH_SIZE = 5000
+    # 搜索结果每页条数、每条消息最多显示的字符数，以及每个用户保留的最近搜索数
+    SEARCH_PAGE_SIZE = 10
+    SEARCH_SNIPPET_LENGTH = 200
+    MAX_SAVED_SEARCHES = 20
+
     def __init__(self):
-        self.gemini = GeminiHandler(GEMINI_API_KEY)
-        self.db = DatabaseHandler()
+        embeddings = None
+        if EMBEDDING_INDEX:
+            # numpy 是可选依赖，只在启用向量索引时导入
+            from utils.embedding_index import EmbeddingIndex
+            embeddings = EmbeddingIndex(EMBEDDING_DIR)
+        self.db = AsyncDatabaseHandler(DatabaseHandler(embeddings=embeddings))
+        self.gemini = GeminiHandler(
+            GEMINI_API_KEY,
+            timeout=GEMINI_TIMEOUT,
+            governor=RequestGovernor(
+                max_concurrency=GEMINI_MAX_CONCURRENCY,
+                rpm=GEMINI_RPM,
+                tpm=GEMINI_TPM,
+                owner_weight=GEMINI_OWNER_WEIGHT
+            ),
+            max_retries=GEMINI_MAX_RETRIES,
+            retry_base_delay=GEMINI_RETRY_BASE_DELAY,
+            cache=ResponseCache(self.db, ttl=RESPONSE_CACHE_TTL, maxsize=RESPONSE_CACHE_SIZE),
+            context_budget=CONTEXT_TOKEN_BUDGET or None,
+            backend=create_backend(
+                GEMINI_BACKEND,
+                api_key=GEMINI_API_KEY,
+                latency=GEMINI_FAKE_LATENCY,
+                jitter=GEMINI_FAKE_JITTER,
+                error_rate=GEMINI_FAKE_ERROR_RATE,
+                rpm=GEMINI_FAKE_RPM,
+                seed=GEMINI_FAKE_SEED
+            )
+        )
+        self.summaries = SummaryTree(self.db, self.gemini, build_limit=SUMMARY_BUILD_LIMIT)
+        self.buffer = MessageBuffer(
+            self.db,
+            max_size=INGEST_BATCH_SIZE,
+            flush_interval=INGEST_FLUSH_INTERVAL_MS / 1000,
+            on_flush=self.on_messages_flushed
+        )
+        self._group_chat_ids = set()
+        # 所有者在各群组中的成员状态缓存，避免每条消息都调用 get_member
+        self._owner_membership = TTLCache(ttl=OWNER_MEMBERSHIP_TTL, maxsize=10000)
+        self.scheduler = AnalysisScheduler(max_concurrency=ANALYSIS_MAX_CONCURRENCY)
+        # 分层摘要补齐和向量索引耗时较长，单独排队，不占用分析任务的并发名额
+        self.backfill = AnalysisScheduler(max_concurrency=1)
         self.owner_id = BOT_OWNER_ID
+        self.metrics_runner = None
         
-    def get_message(self, key: str, user_id: int) -> str:
+    async def get_message(self, key: str, user_id: int) -> str:
         """获取指定语言的消息"""
-        lang = self.db.get_user_language(user_id)
+        lang = await self.db.get_user_language(user_id)
         return MESSAGES[lang][key]
         
     async def lang(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -41,7 +138,7 @@ class TelegramBot:
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
         await update.message.reply_text(
-            self.get_message('lang_select', update.effective_user.id),
+            await self.get_message('lang_select', update.effective_user.id),
             reply_markup=reply_markup
         )
         
@@ -57,9 +154,9 @@ class TelegramBot:
             # 处理语言切换
             if query.data.startswith('lang_'):
                 lang = query.data.split('_')[1]
-                self.db.set_user_language(update.effective_user.id, lang)
+                await self.db.set_user_language(update.effective_user.id, lang)
                 await query.edit_message_text(
-                    self.get_message('lang_changed', update.effective_user.id)
+                    await self.get_message('lang_changed', update.effective_user.id)
                 )
                 return
 
@@ -81,7 +178,7 @@ class TelegramBot:
                 # 处理提示词设置
                 prompt_type = data.get("type")
                 if "new_prompt" not in data:
-                    current_prompt = self.db.get_system_prompt(prompt_type)
+                    current_prompt = await self.db.get_system_prompt(prompt_type)
                     await query.edit_message_text(
                         f"当前的提示词是：\n\n{current_prompt}\n\n"
                         f"请直接回复新的提示词，或者输入 /cancel 取消。"
@@ -89,45 +186,28 @@ class TelegramBot:
                     context.user_data["waiting_for_prompt"] = prompt_type
                 return
 
+            elif action == "search":
+                # 处理搜索范围选择和翻页，关键词按编号保存在 user_data 中
+                search_text = context.user_data.get("searches", {}).get(data.get("s"))
+                if search_text is None:
+                    await query.edit_message_text("搜索已过期，请重新使用 /search 搜索。")
+                    return
+                await self._show_search_page(query, data["s"], search_text, data.get("g") or None, data.get("p", 0))
+                return
+
             elif action == "actions_today":
                 # 获取今日所有群组的待办事项
-                groups = self.db.get_all_groups()
+                groups = await self.db.get_all_groups()
                 if not groups:
                     await query.edit_message_text("未找到任何群组记录。")
                     return
                 
-                today_report = []
-                for group_id, group_name in groups:
-                    messages = self.db.get_today_messages(group_id)
-                    if messages and len(messages) > 0:
-                        formatted_messages = self._format_messages(messages)
-                        background = self.db.get_background_analysis(group_id)
-                        if not background:
-                            background = "暂无群组背景信息"
-                        system_prompt = (
-                            f"{self.db.get_system_prompt('actions')}\n\n"
-                            f"群组背景信息：\n{background}\n\n"
-                            f"今日消息："
-                        )
-                        try:
-                            actions = await self.gemini.find_action_items(formatted_messages, system_prompt)
-                            if actions and not actions.startswith("没有"):
-                                today_report.append(f"\n{group_name}：\n{actions}")
-                        except Exception as e:
-                            print(f"处理群组 {group_name} 的消息时出错：{str(e)}")
-                            today_report.append(f"\n{group_name}：处理出错，请稍后重试")
-                
-                if today_report:
-                    await query.edit_message_text(
-                        "今日各群组待办事项：\n" + "\n".join(today_report)
-                    )
-                else:
-                    await query.edit_message_text("今日所有群组暂无待办事项。")
+                await self._report_today_actions(query, groups)
                 return
 
             elif action == "actions_select":
                 # 显示群组选择按钮
-                groups = self.db.get_all_groups()
+                groups = await self.db.get_all_groups()
                 if not groups:
                     await query.edit_message_text("未找到任何群组记录。")
                     return
@@ -138,24 +218,27 @@ class TelegramBot:
             elif action == "actions_group":
                 # 处理特定群组的待办事项
                 group_id = data.get("group_id")
-                group_info = self.db.get_group_info(group_id)
+                group_info = await self.db.get_group_info(group_id)
                 if not group_info:
                     await query.edit_message_text("无法获取群组信息。")
                     return
                     
                 group_name = group_info[1]
-                messages = self.db.get_chat_history(group_id)[-50:]
+                # 启用检索时只发送最近一段对话，更早的相关消息由检索补充
+                limit = RETRIEVAL_RECENT_MESSAGES if RETRIEVAL_LIMIT else self._history_limit()
+                messages = await self.db.get_recent_messages(group_id, limit=limit)
                 if not messages:
                     await query.edit_message_text(f"群组 {group_name} 暂无消息记录。")
                     return
                     
-                formatted_messages = self._format_messages(messages)
-                background = self.db.get_background_analysis(group_id)
+                background = await self.db.get_background_analysis(group_id)
+                actions_prompt = await self.db.get_system_prompt('actions')
                 system_prompt = (
-                    f"{self.db.get_system_prompt('actions')}\n\n"
+                    f"{actions_prompt}\n\n"
                     f"群组背景信息：\n{background}\n\n"
                     f"最近消息："
                 )
+                formatted_messages = await self._format_with_history(group_id, messages, system_prompt)
                 actions = await self.gemini.find_action_items(formatted_messages, system_prompt)
                 await query.edit_message_text(f"群组：{group_name}\n\n{actions}")
                 return
@@ -163,48 +246,74 @@ class TelegramBot:
             elif action == "analyze":
                 # 处理群组分析
                 group_id = data.get("group_id")
-                group_info = self.db.get_group_info(group_id)
+                group_info = await self.db.get_group_info(group_id)
                 if not group_info:
                     await query.edit_message_text("无法获取群组信息。")
                     return
                     
                 group_name = group_info[1]
-                messages = self.db.get_chat_history(group_id)
-                if not messages or len(messages) < 5:
+                # 指定天数时分析该时间范围，使用分层摘要
+                days = data.get("days")
+                header = f"群组：{group_name}（最近 {days} 天）\n\n" if days else f"群组：{group_name}\n\n"
+                await query.edit_message_text(
+                    f"正在分析群组 {group_name}...\n"
+                    f"排队中的分析任务：{self.scheduler.queue_depth}"
+                )
+                streamed_here = False
+
+                async def run_analysis():
+                    nonlocal streamed_here
+                    streamed_here = True
+                    if days:
+                        return await self.analyze_range(group_id, days, query=query, header=header)
+                    return await self.analyze_group(group_id, query=query, header=header)
+
+                # 所有者发起的分析优先于后台自动刷新；完整分析与自动刷新共用同一个 key，
+                # 排队中的自动刷新会被提升为这次分析，两者不会同时写入同一群组的背景
+                try:
+                    analysis = await self.scheduler.submit(
+                        ("analyze", group_id, days) if days else self._background_key(group_id),
+                        run_analysis,
+                        priority=AnalysisScheduler.PRIORITY_OWNER
+                    )
+                except SummaryBuildLimitError as e:
+                    self._submit_summary_refresh(group_id)
+                    await query.edit_message_text(
+                        f"群组 {group_name} 最近 {days} 天还有 {e.needed} 个分时段摘要未生成，"
+                        f"超过单次分析的上限（{e.limit} 个）。\n已在后台开始生成，请稍后再试。"
+                    )
+                    return
+                if analysis is None:
                     await query.edit_message_text(f"群组 {group_name} 的消息记录太少，无法进行分析。")
                     return
-                    
-                formatted_messages = self._format_messages(messages)
-                system_prompt = self.db.get_system_prompt("background")
-                analysis = await self.gemini.analyze_group_history(formatted_messages, system_prompt)
-                
-                # 存储分析结果
-                self.db.store_analysis(group_id, "background", analysis)
-                await query.edit_message_text(f"群组：{group_name}\n\n{analysis}")
+                if not streamed_here:
+                    # 与其他请求合并执行时，直接显示最终结果
+                    await self._edit_long_message(query, header + analysis)
                 return
 
             elif action == "suggest":
                 # 处理回复建议
                 group_id = data.get("group_id")
-                group_info = self.db.get_group_info(group_id)
+                group_info = await self.db.get_group_info(group_id)
                 if not group_info:
                     await query.edit_message_text("无法获取群组信息。")
                     return
                     
                 group_name = group_info[1]
                 message_count = context.user_data.get("suggest_message_count", 5)
-                messages = self.db.get_chat_history(group_id)[-message_count:]
+                messages = await self.db.get_recent_messages(group_id, limit=message_count)
                 if not messages or len(messages) < 2:
                     await query.edit_message_text(f"群组 {group_name} 的消息记录太少，无法提供建议。")
                     return
                     
-                formatted_messages = self._format_messages(messages)
-                background = self.db.get_background_analysis(group_id)
+                background = await self.db.get_background_analysis(group_id)
+                suggestion_prompt = await self.db.get_system_prompt('suggestion')
                 system_prompt = (
-                    f"{self.db.get_system_prompt('suggestion')}\n\n"
+                    f"{suggestion_prompt}\n\n"
                     f"群组背景信息：\n{background}\n\n"
                     f"最近消息："
                 )
+                formatted_messages = await self._format_with_history(group_id, messages, system_prompt)
                 suggestion = await self.gemini.suggest_reply(formatted_messages, system_prompt)
                 await query.edit_message_text(f"群组：{group_name}\n\n{suggestion}")
                 return
@@ -212,13 +321,13 @@ class TelegramBot:
             elif action == "delete":
                 # 处理群组记录删除
                 group_id = data.get("group_id")
-                group_info = self.db.get_group_info(group_id)
+                group_info = await self.db.get_group_info(group_id)
                 if not group_info:
                     await query.edit_message_text("无法获取群组信息。")
                     return
                     
                 group_name = group_info[1]
-                if self.db.delete_chat_history(group_id):
+                if await self.db.delete_chat_history(group_id):
                     await query.edit_message_text(f"已成功删除群组 {group_name} 的所有记录。")
                 else:
                     await query.edit_message_text(f"删除群组 {group_name} 的记录时出错。")
@@ -227,18 +336,205 @@ class TelegramBot:
             # 如果没有匹配的操作
             await query.edit_message_text("未知的操作请求。")
 
+        except GeminiError as e:
+            # 调用失败时不保存结果，只提示用户（错误已由 GeminiHandler 记录）
+            await query.edit_message_text(f"分析过程中出错：{e}")
         except Exception as e:
-            print(f"处理回调时出错：{str(e)}")
-            print(f"错误类型：{type(e)}")
-            print(f"错误详情：", e.__traceback__.tb_frame.f_locals)
+            logger.exception("处理回调时出错：%s", e)
             await query.edit_message_text("处理请求时出错，请稍后重试。")
 
+    @staticmethod
+    def _search_callback(search_id, group_id, page):
+        """搜索按钮的回调数据，Telegram 限制为 64 字节，关键词本身不放在其中"""
+        return json.dumps({"action": "search", "s": search_id, "g": group_id or 0, "p": page}, separators=(',', ':'))
+
+    def _search_snippet(self, text, terms):
+        """截取消息中第一个命中关键词附近的内容"""
+        text = text or ""
+        limit = self.SEARCH_SNIPPET_LENGTH
+        if len(text) <= limit:
+            return text
+        lowered = text.lower()
+        positions = [lowered.find(term.lower()) for term in terms]
+        start = max(0, min((p for p in positions if p >= 0), default=0) - limit // 4)
+        end = start + limit
+        return ("…" if start > 0 else "") + text[start:end] + ("…" if end < len(text) else "")
+
+    async def _show_search_page(self, query, search_id, search_text, group_id, page):
+        """在回调消息中显示一页搜索结果和翻页按钮"""
+        rows, has_more = await self.db.search_messages(
+            search_text, chat_id=group_id, limit=self.SEARCH_PAGE_SIZE, offset=page * self.SEARCH_PAGE_SIZE
+        )
+        group_names = dict(await self.db.get_all_groups())
+        scope = f"群组 {group_names.get(group_id, group_id)}" if group_id else "所有群组"
+        if not rows and page == 0:
+            await query.edit_message_text(f"在{scope}中没有找到与「{search_text}」相关的消息。")
+            return
+
+        terms = search_text.split()
+        lines = [f"搜索「{search_text}」（{scope}，第 {page + 1} 页）："]
+        for _, chat_id, username, message_text, timestamp in rows:
+            source = f"[{group_names.get(chat_id, chat_id)}] " if group_id is None else ""
+            lines.append(f"\n{source}{timestamp} {username}：\n{self._search_snippet(message_text, terms)}")
+
+        buttons = []
+        if page > 0:
+            buttons.append(InlineKeyboardButton("◀ 上一页", callback_data=self._search_callback(search_id, group_id, page - 1)))
+        if has_more:
+            buttons.append(InlineKeyboardButton("下一页 ▶", callback_data=self._search_callback(search_id, group_id, page + 1)))
+        await query.edit_message_text(
+            "\n".join(lines)[:self.MAX_MESSAGE_LENGTH],
+            reply_markup=InlineKeyboardMarkup([buttons]) if buttons else None
+        )
+
+    async def _check_today_actions(self, group_id, group_name, actions_prompt):
+        """检查单个群组的今日待办，没有待办时返回 None"""
+        try:
+            messages = await self.db.get_today_messages(group_id)
+            if not messages:
+                return None
+            background = await self.db.get_background_analysis(group_id)
+            if not background:
+                background = "暂无群组背景信息"
+            system_prompt = (
+                f"{actions_prompt}\n\n"
+                f"群组背景信息：\n{background}\n\n"
+                f"今日消息："
+            )
+            formatted_messages = await self._format_with_history(group_id, messages, system_prompt)
+            actions = await self.gemini.find_action_items(formatted_messages, system_prompt)
+            if actions and not actions.startswith("没有"):
+                return f"\n{group_name}：\n{actions}"
+            return None
+        except GeminiError as e:
+            return f"\n{group_name}：分析过程中出错：{e}"
+        except Exception as e:
+            logger.exception("处理群组 %s 的消息时出错：%s", group_name, e)
+            return f"\n{group_name}：处理出错，请稍后重试"
+
+    async def _report_today_actions(self, query, groups):
+        """并发检查所有群组的今日待办，边完成边更新进度，总耗时不超过 ACTIONS_TIMEOUT"""
+        semaphore = asyncio.Semaphore(ACTIONS_MAX_CONCURRENCY)
+        actions_prompt = await self.db.get_system_prompt('actions')
+
+        async def check_group(index, group_id, group_name):
+            async with semaphore:
+                return index, await self._check_today_actions(group_id, group_name, actions_prompt)
+
+        tasks = [
+            asyncio.create_task(check_group(index, group_id, group_name))
+            for index, (group_id, group_name) in enumerate(groups)
+        ]
+        results = {}
+        timed_out = False
+        last_edit = asyncio.get_running_loop().time()
+        try:
+            for next_done in asyncio.as_completed(tasks, timeout=ACTIONS_TIMEOUT):
+                index, report = await next_done
+                results[index] = report
+                now = asyncio.get_running_loop().time()
+                if now - last_edit >= self.PROGRESS_EDIT_INTERVAL and len(results) < len(tasks):
+                    last_edit = now
+                    partial = [results[i] for i in sorted(results) if results[i]]
+                    await self._edit_progress(
+                        query,
+                        f"正在检查今日待办：{len(results)}/{len(tasks)} 个群组\n" + "\n".join(partial)
+                    )
+        except asyncio.TimeoutError:
+            timed_out = True
+            logger.warning("检查今日待办超时，已完成 %d/%d 个群组", len(results), len(tasks))
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        # 按群组顺序输出，结果与完成先后无关
+        today_report = [results[i] for i in sorted(results) if results[i]]
+        if timed_out:
+            today_report.append(f"\n（超时，{len(tasks) - len(results)} 个群组未完成检查）")
+        if today_report:
+            # 群组较多时报告可能超过单条消息的长度上限
+            await self._edit_long_message(query, "今日各群组待办事项：\n" + "\n".join(today_report))
+        else:
+            await query.edit_message_text("今日所有群组暂无待办事项。")
+
+    def _split_message(self, text):
+        """按 Telegram 长度上限拆分文本，尽量在换行处断开"""
+        pages = []
+        while len(text) > self.MAX_MESSAGE_LENGTH:
+            cut = text.rfind("\n", 0, self.MAX_MESSAGE_LENGTH)
+            if cut <= 0:
+                cut = self.MAX_MESSAGE_LENGTH
+            pages.append(text[:cut])
+            text = text[cut:].lstrip("\n")
+        pages.append(text)
+        return pages
+
+    async def _edit_long_message(self, query, text, sent_pages=None):
+        """把文本显示在回调消息中，超出长度的部分作为新消息继续发送
+
+        sent_pages 记录已显示的每页内容，重复调用时只更新有变化的页。
+        """
+        if sent_pages is None:
+            sent_pages = []
+        pages = self._split_message(text)
+        for index, page in enumerate(pages):
+            if index < len(sent_pages):
+                message, shown = sent_pages[index]
+                if page != shown:
+                    if index == 0:
+                        await query.edit_message_text(page)
+                    else:
+                        await message.edit_text(page)
+                    sent_pages[index] = (message, page)
+            elif index == 0:
+                await query.edit_message_text(page)
+                sent_pages.append((query.message, page))
+            else:
+                message = await query.message.chat.send_message(page)
+                sent_pages.append((message, page))
+        # 内容变短导致页数减少时，删除多余的消息
+        while len(sent_pages) > len(pages):
+            message, _ = sent_pages.pop()
+            await message.delete()
+        return sent_pages
+
+    async def _stream_to_message(self, query, header, chunks):
+        """将流式生成的内容逐步编辑到回调消息中，返回完整文本
+
+        第一块内容到达后立即显示，之后按 STREAM_EDIT_INTERVAL 限制编辑频率。
+        """
+        loop = asyncio.get_running_loop()
+        text = ""
+        sent_pages = []
+        last_edit = 0
+        async for chunk in chunks:
+            text += chunk
+            now = loop.time()
+            if now - last_edit >= self.STREAM_EDIT_INTERVAL:
+                last_edit = now
+                try:
+                    await self._edit_long_message(query, header + text + " ▌", sent_pages)
+                except Exception as e:
+                    logger.debug("流式更新消息失败：%s", e)
+        await self._edit_long_message(query, header + text, sent_pages)
+        return text
+
+    async def _edit_progress(self, target, text):
+        """更新进度消息（回调查询或普通消息），失败时忽略（如内容未变化）"""
+        try:
+            if isinstance(target, CallbackQuery):
+                await target.edit_message_text(text[:self.MAX_MESSAGE_LENGTH])
+            else:
+                await target.edit_text(text[:self.MAX_MESSAGE_LENGTH])
+        except Exception as e:
+            logger.debug("更新进度消息失败：%s", e)
+
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """处理 /start 命令"""
         if not await self.check_owner(update):
             return
         await update.message.reply_text(
-            self.get_message('start', update.effective_user.id)
+            await self.get_message('start', update.effective_user.id)
         )
 
     async def help(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -246,7 +542,7 @@ class TelegramBot:
         if not await self.check_owner(update):
             return
         await update.message.reply_text(
-            self.get_message('help', update.effective_user.id)
+            await self.get_message('help', update.effective_user.id)
         )
 
     async def check_owner(self, update: Update) -> bool:
@@ -274,61 +570,240 @@ class TelegramBot:
         return True
 
     async def store_message(self, update: Update):
-        """自动存储消息到数据库"""
+        """将消息加入写入缓冲区，由缓冲区批量写入数据库"""
         try:
             if update.message and update.message.text:
-                print("\n=== 自动存储新消息 ===")
-                
                 # 获取发送者信息
                 username = None
                 if update.message.from_user:
                     username = update.message.from_user.username or update.message.from_user.first_name
-                    print(f"发送者: {username}")
                 
                 # 获取消息信息
                 chat_id = update.message.chat_id
                 chat_type = update.message.chat.type
-                chat_title = update.message.chat.title if chat_type in ['group', 'supergroup'] else 'Private Chat'
-                print(f"群组: {chat_title} (ID: {chat_id})")
-                print(f"消息: {update.message.text[:50]}...")
+                is_group = chat_type in ['group', 'supergroup']
+                chat_title = update.message.chat.title if is_group else 'Private Chat'
+                # 每条消息都会触发，按 LOG_SAMPLE_RATE 抽样记录
+                logger.info("收到新消息：群组 %s (ID: %s)，发送者：%s", chat_title, chat_id, username,
+                            extra=dict(SAMPLED, chat_id=chat_id))
                 
-                # 如果是群组消息，更新群组信息
-                if chat_type in ['group', 'supergroup']:
-                    self.db.update_chat_info(chat_id, chat_title)
-                
-                # 存储消息
-                self.db.store_message(
-                    chat_id=chat_id,
-                    user_id=update.message.from_user.id if update.message.from_user else 0,
-                    username=username or "unknown",
-                    message_text=update.message.text,
-                    timestamp=update.message.date.isoformat()
+                # 存储消息，群组消息同时记录群组名称
+                await self.buffer.add(
+                    {
+                        'chat_id': chat_id,
+                        'message_id': update.message.message_id,
+                        'user_id': update.message.from_user.id if update.message.from_user else 0,
+                        'username': username or "unknown",
+                        'message_text': update.message.text,
+                        'timestamp': update.message.date.isoformat()
+                    },
+                    chat_title=chat_title if is_group else None
                 )
-                print(f"消息已成功存储到数据库")
-                
-                # 检查是否需要进行群组分析
-                if chat_type in ['group', 'supergroup'] and self.db.check_and_analyze_group(chat_id):
-                    messages = self.db.get_chat_history(chat_id)
-                    if messages:
-                        formatted_messages = self._format_messages(messages)
-                        system_prompt = self.db.get_system_prompt("background")
-                        analysis = await self.gemini.analyze_group_history(formatted_messages, system_prompt)
-                        self.db.store_analysis(chat_id, "background", analysis)
-                        print(f"已完成群组自动分析")
+                if is_group:
+                    self._group_chat_ids.add(chat_id)
                 
         except Exception as e:
-            print(f"存储消息时出错：{str(e)}")
+            logger.exception("存储消息时出错：%s", e)
+
+    async def on_messages_flushed(self, chat_ids):
+        """消息批量写入后，为涉及的群组提交自动分析任务"""
+        for chat_id in chat_ids:
+            if chat_id in self._group_chat_ids:
+                # 防抖期间同一群组的多次触发只会执行一次
+                self.scheduler.submit(
+                    self._background_key(chat_id),
+                    lambda chat_id=chat_id: self._auto_analyze_group(chat_id),
+                    priority=AnalysisScheduler.PRIORITY_BACKGROUND,
+                    debounce=ANALYSIS_DEBOUNCE_SECONDS
+                )
+                self.schedule_summary_refresh(chat_id)
+        self.schedule_embedding_index()
+
+    @staticmethod
+    def _background_key(chat_id):
+        """更新群组背景的任务（/analyze 完整分析和自动刷新）使用的调度 key"""
+        return ("background", normalize_chat_id(chat_id))
+
+    def schedule_summary_refresh(self, chat_id, force=False):
+        """提交后台任务，补齐群组已结束周期的分层摘要（未启用 SUMMARY_TREE 时不做任何事）
+
+        每个群组每天只需补齐一次；导入或同步了消息时传入 force，检查并重新生成受影响的摘要。
+        """
+        if SUMMARY_TREE and (force or not self.summaries.is_current(normalize_chat_id(chat_id))):
+            self._submit_summary_refresh(chat_id)
+
+    def _submit_summary_refresh(self, chat_id):
+        """提交补齐分层摘要的后台任务；/analyze <天数> 缺少的摘要太多时即使未启用 SUMMARY_TREE 也会调用"""
+        chat_id = normalize_chat_id(chat_id)
+        self.backfill.submit(
+            ("summaries", chat_id),
+            lambda: self._refresh_summaries(chat_id),
+            priority=AnalysisScheduler.PRIORITY_BACKGROUND,
+            debounce=ANALYSIS_DEBOUNCE_SECONDS
+        )
+
+    async def _refresh_summaries(self, chat_id):
+        """补齐分层摘要，达到每次的生成上限时重新提交，剩余部分排在其他任务之后继续"""
+        done = await self.summaries.refresh(chat_id)
+        if not done:
+            self._submit_summary_refresh(chat_id)
+        return done
+
+    def schedule_embedding_index(self, debounce=ANALYSIS_DEBOUNCE_SECONDS):
+        """提交后台任务，把新消息分批加入向量索引（未启用时不做任何事）"""
+        if self.db.embeddings is not None:
+            self.backfill.submit(
+                ("embeddings",),
+                self._index_embeddings,
+                priority=AnalysisScheduler.PRIORITY_BACKGROUND,
+                debounce=debounce
+            )
+
+    async def _index_embeddings(self):
+        """索引水位线之后的消息，每次最多 EMBEDDING_BATCHES_PER_RUN 批
+
+        还有剩余时重新提交，排在摘要补齐等其他后台任务之后继续。
+        """
+        total = 0
+        for _ in range(self.EMBEDDING_BATCHES_PER_RUN):
+            indexed = await self.db.index_embeddings(EMBEDDING_BATCH_SIZE)
+            total += indexed
+            if indexed < EMBEDDING_BATCH_SIZE:
+                break
+        else:
+            self.schedule_embedding_index(debounce=0)
+        if total:
+            logger.info("向量索引新增 %d 条消息", total)
+        return total
+
+    async def _auto_analyze_group(self, chat_id):
+        """对新消息较多的群组进行自动分析"""
+        if await self.db.check_and_analyze_group(chat_id):
+            return await self.refresh_group_summary(chat_id)
+        return None
+
+    async def analyze_group(self, group_id, query=None, header="", priority=RequestGovernor.PRIORITY_OWNER):
+        """完整分析群组历史，消息太少时返回 None
+
+        传入 query 时以流式方式逐步把结果编辑到该回调消息中。
+        """
+        watermark = await self.db.get_latest_message_id(group_id)
+        messages = await self.db.get_recent_messages(group_id, limit=self._history_limit())
+        if not messages or len(messages) < 5:
+            return None
+
+        system_prompt = await self.db.get_system_prompt("background")
+        formatted_messages = self._format_messages(messages, system_prompt)
+        if query is None:
+            analysis = await self.gemini.analyze_group_history(formatted_messages, system_prompt, priority=priority)
+        else:
+            analysis = await self._stream_to_message(
+                query, header, self.gemini.stream_group_analysis(formatted_messages, system_prompt, priority=priority)
+            )
+
+        # 存储分析结果，后续自动分析在此基础上增量更新
+        await self.db.store_analysis(group_id, "background", analysis, message_watermark=watermark)
+        return analysis
+
+    async def analyze_range(self, group_id, days, query=None, header=""):
+        """分析最近 days 天（含今天）的群组消息，范围内没有消息时返回 None
+
+        今天之前的部分组合缓存的分层摘要，缺少的先生成，不重新读取原始消息；
+        结果只针对这个时间范围，不保存为群组背景。缺少的摘要超过 ANALYZE_BUILD_LIMIT 个时
+        抛出 SummaryBuildLimitError，由调用方转为后台补齐。
+        """
+        system_prompt = await self.db.get_system_prompt("background")
+        today = SummaryTree.today()
+        loop = asyncio.get_running_loop()
+        last_edit = loop.time()
+
+        async def progress(built):
+            nonlocal last_edit
+            now = loop.time()
+            if query is not None and now - last_edit >= self.PROGRESS_EDIT_INTERVAL:
+                last_edit = now
+                await self._edit_progress(query, f"{header}正在生成分时段摘要，已生成 {built} 个...")
+
+        content = await self.summaries.compose(
+            group_id,
+            today - timedelta(days=days - 1),
+            today + timedelta(days=1),
+            self.gemini.context_budget - estimate_tokens(system_prompt),
+            recent_limit=self._history_limit(),
+            progress=progress,
+            build_limit=self.ANALYZE_BUILD_LIMIT
+        )
+        if content is None:
+            return None
+        if query is None:
+            return await self.gemini.analyze_group_history(content, system_prompt)
+        return await self._stream_to_message(query, header, self.gemini.stream_group_analysis(content, system_prompt))
 
-    def _create_group_selection_keyboard(self, groups, action_prefix):
-        """创建群组选择按钮"""
+    async def refresh_group_summary(self, chat_id):
+        """增量更新群组背景：只把水位线之后的新消息合并进上一次的背景分析
+
+        还没有背景时与 /analyze 相同，用最近的消息生成第一份背景，水位线为最新的消息，
+        不从最早的消息开始逐批追赶。导入的更早历史不算新消息；新消息超过 SUMMARY_BATCH_SIZE
+        条时只合并最新的一批，水位线直接推进到最新的消息。
+        """
+        # 自动刷新走后台队列，为所有者的请求让出配额；失败时抛出 GeminiError，不更新背景和水位线
+        background = RequestGovernor.PRIORITY_BACKGROUND
+        previous_summary, watermark = await self.db.get_background_state(chat_id)
+        if not previous_summary or watermark is None:
+            return await self.analyze_group(chat_id, priority=background)
+
+        latest_id = await self.db.get_latest_message_id(chat_id)
+        messages, message_ids = await self.db.get_messages_since(
+            chat_id, watermark, limit=self.SUMMARY_BATCH_SIZE
+        )
+        if not messages:
+            # 水位线之后只有导入的旧历史，跳过它们，不调用 Gemini
+            if latest_id is not None and latest_id > watermark:
+                await self.db.advance_background_watermark(chat_id, latest_id)
+            return None
+
+        system_prompt = await self.db.get_system_prompt("background")
+        # 除背景外可用的预算；背景占用后剩余不足时先压缩背景，压缩请求本身也放不下时先截断
+        available = self.gemini.context_budget - estimate_tokens(system_prompt)
+        budget = available - estimate_tokens(previous_summary)
+        if budget < self.MIN_SUMMARY_MESSAGE_TOKENS:
+            logger.info("群组 %s 的背景过长（约 %d tokens），先压缩再合并新消息",
+                        chat_id, estimate_tokens(previous_summary))
+            previous_summary = await self.gemini.compress_summary(
+                truncate_text(previous_summary, available), self.BACKGROUND_COMPACT_LENGTH, priority=background
+            )
+            # 压缩结果仍然过长时截断
+            previous_summary = truncate_text(previous_summary, available - self.MIN_SUMMARY_MESSAGE_TOKENS)
+            budget = available - estimate_tokens(previous_summary)
+        if budget < self.MIN_SUMMARY_MESSAGE_TOKENS:
+            logger.warning("群组 %s 的上下文预算不足（%d tokens），跳过本次背景更新", chat_id, budget)
+            return None
+        # 按时间顺序合并，预算用完时剩余消息留到下一次，水位线只推进到已完整合并的消息
+        formatted_messages, used = build_context(messages, budget, keep='oldest')
+        if used == 0:
+            return None
+        if used == len(messages):
+            new_watermark = max(latest_id or 0, *message_ids)
+        else:
+            new_watermark = max(message_ids[:used])
+        analysis = await self.gemini.update_group_summary(
+            previous_summary, formatted_messages, system_prompt, priority=background
+        )
+        await self.db.store_analysis(chat_id, "background", analysis, message_watermark=new_watermark)
+        logger.info("已完成群组 %s 自动分析，合并了 %d 条新消息", chat_id, used)
+        return analysis
+
+    def _create_group_selection_keyboard(self, groups, action_prefix, **extra):
+        """创建群组选择按钮，extra 为附加到每个按钮回调数据中的参数"""
         keyboard = []
         for group_id, group_name in groups:
-            callback_data = json.dumps({"action": action_prefix, "group_id": group_id})
+            # 回调数据限制为 64 字节，使用紧凑的 JSON
+            callback_data = json.dumps({"action": action_prefix, "group_id": group_id, **extra}, separators=(',', ':'))
             keyboard.append([InlineKeyboardButton(group_name, callback_data=callback_data)])
         return InlineKeyboardMarkup(keyboard)
 
     async def analyze_history(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """处理 /analyze 命令"""
+        """处理 /analyze 命令，/analyze <天数> 分析最近若干天"""
         if not await self.check_owner(update):
             return
             
@@ -336,13 +811,26 @@ class TelegramBot:
             await update.message.reply_text("请在私聊中使用此命令。")
             return
 
+        extra = {}
+        if context.args:
+            try:
+                days = int(context.args[0])
+                if not 1 <= days <= self.MAX_ANALYZE_DAYS:
+                    raise ValueError
+            except ValueError:
+                await update.message.reply_text(
+                    f"请输入 1 到 {self.MAX_ANALYZE_DAYS} 之间的天数，例如：/analyze 30"
+                )
+                return
+            extra["days"] = days
+
         # 获取用户加入的所有群组
-        groups = self.db.get_all_groups()
+        groups = await self.db.get_all_groups()
         if not groups:
             await update.message.reply_text("未找到任何群组记录。")
             return
 
-        reply_markup = self._create_group_selection_keyboard(groups, "analyze")
+        reply_markup = self._create_group_selection_keyboard(groups, "analyze", **extra)
         await update.message.reply_text("请选择要分析的群组：", reply_markup=reply_markup)
 
     async def check_action_items(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -370,7 +858,7 @@ class TelegramBot:
             await update.message.reply_text("请在私聊中使用此命令。")
             return
 
-        groups = self.db.get_all_groups()
+        groups = await self.db.get_all_groups()
         if not groups:
             await update.message.reply_text("未找到任何群组记录。")
             return
@@ -378,12 +866,88 @@ class TelegramBot:
         reply_markup = self._create_group_selection_keyboard(groups, "suggest")
         await update.message.reply_text("请选择要获取回复建议的群组：", reply_markup=reply_markup)
 
-    def _format_messages(self, messages):
-        """格式化消息记录"""
-        formatted = []
-        for username, text, timestamp in messages:
-            formatted.append(f"[{timestamp}] {username}: {text}")
-        return "\n".join(formatted)
+    async def search(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """处理 /search 命令：全文搜索聊天记录"""
+        if not await self.check_owner(update):
+            return
+
+        if update.message.chat.type != 'private':
+            await update.message.reply_text("请在私聊中使用此命令。")
+            return
+
+        search_text = " ".join(context.args).strip()
+        if not search_text:
+            await update.message.reply_text(
+                "请指定要搜索的关键词，例如：\n"
+                "/search 上线 时间\n"
+                "多个关键词之间用空格分隔，结果需包含所有关键词。\n"
+                "关键词都少于 3 个字时无法使用全文索引，只搜索最近 2 万条消息。"
+            )
+            return
+
+        groups = await self.db.get_all_groups()
+        if not groups:
+            await update.message.reply_text("未找到任何群组记录。")
+            return
+
+        # 保存最近的搜索关键词，回调数据中只携带编号
+        searches = context.user_data.setdefault("searches", {})
+        search_id = context.user_data.get("search_seq", 0) + 1
+        context.user_data["search_seq"] = search_id
+        searches[search_id] = search_text
+        for old_id in list(searches)[:-self.MAX_SAVED_SEARCHES]:
+            del searches[old_id]
+
+        keyboard = [[InlineKeyboardButton("所有群组", callback_data=self._search_callback(search_id, None, 0))]]
+        for group_id, group_name in groups:
+            keyboard.append([InlineKeyboardButton(group_name, callback_data=self._search_callback(search_id, group_id, 0))])
+        await update.message.reply_text("请选择要搜索的群组：", reply_markup=InlineKeyboardMarkup(keyboard))
+
+    def _format_messages(self, messages, *reserved_texts):
+        """格式化消息记录，总长度不超过当前模型的 token 预算
+
+        reserved_texts 为同一请求中的其他内容（如 system prompt），会先从预算中扣除；
+        预算不足时优先保留最新的消息。
+        """
+        budget = self.gemini.context_budget - sum(estimate_tokens(text) for text in reserved_texts)
+        formatted, used = build_context(messages, budget)
+        if used < len(messages):
+            logger.info("上下文预算 %d tokens，使用了最近 %d/%d 条消息", budget, used, len(messages))
+        return formatted
+
+    async def _format_with_history(self, group_id, messages, *reserved_texts):
+        """格式化最近消息，并附上按相关度检索到的更早消息
+
+        从最近的对话中提取关键词，用全文索引在更早的消息中检索相关内容（如上周的约定、
+        提到的人和事）；启用向量索引时再合并语义相近的消息。最近消息优先占用预算，
+        剩余预算按相关度选取历史消息。
+        """
+        budget = self.gemini.context_budget - sum(estimate_tokens(text) for text in reserved_texts)
+        formatted, used = build_context(messages, budget)
+        if not RETRIEVAL_LIMIT or not used:
+            return formatted
+
+        recent = messages[-used:]
+        before = recent[0][2]
+        related = []
+        terms = extract_keywords(text for _, text, _ in recent)
+        if terms:
+            related = await self.db.get_related_messages(group_id, terms, before=before, limit=RETRIEVAL_LIMIT)
+        if self.db.embeddings is not None:
+            similar = await self.db.find_similar_messages(
+                "\n".join(text for _, text, _ in recent if text), chat_id=group_id, limit=RETRIEVAL_LIMIT, before=before
+            )
+            related = merge_ranked(related, [row[2:] for row in similar], limit=RETRIEVAL_LIMIT)
+        header = "\n\n以下是与最近对话相关的更早消息（按时间排序）：\n"
+        history, count = select_related(related, budget - estimate_tokens(formatted) - estimate_tokens(header))
+        if not count:
+            return formatted
+        logger.info("群组 %s 附上 %d 条相关历史消息", group_id, count)
+        return formatted + header + history
+
+    def _history_limit(self):
+        """按上下文预算估算需要从数据库读取的消息条数"""
+        return max(100, self.gemini.context_budget // self.MIN_TOKENS_PER_MESSAGE)
 
     async def message_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """处理所有新消息"""
@@ -397,7 +961,7 @@ class TelegramBot:
                     if update.message.text == "/cancel":
                         await update.message.reply_text("已取消设置提示词。")
                     else:
-                        self.db.update_system_prompt(prompt_type, update.message.text)
+                        await self.db.update_system_prompt(prompt_type, update.message.text)
                         await update.message.reply_text("提示词已更新。")
                     del context.user_data["waiting_for_prompt"]
                     return
@@ -421,12 +985,35 @@ class TelegramBot:
                             break
 
                 # 自动存储所有消息（只存储所有者的群组消息）
-                chat_member = await update.message.chat.get_member(self.owner_id)
-                if chat_member.status in ['creator', 'administrator', 'member']:
+                if await self.is_owner_in_chat(update.message.chat):
                     await self.store_message(update)
                 
         except Exception as e:
-            print(f"处理消息时出错：{str(e)}")
+            logger.exception("处理消息时出错：%s", e)
+
+    async def is_owner_in_chat(self, chat) -> bool:
+        """检查所有者是否在群组中，结果按群组ID缓存"""
+        is_member = self._owner_membership.get(chat.id)
+        if is_member is None:
+            chat_member = await chat.get_member(self.owner_id)
+            is_member = chat_member.status in ['creator', 'administrator', 'member']
+            self._owner_membership.set(chat.id, is_member)
+        return is_member
+
+    async def chat_member_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """处理成员变化，更新所有者成员状态缓存"""
+        member_update = update.chat_member or update.my_chat_member
+        if not member_update:
+            return
+        chat_id = member_update.chat.id
+        new_member = member_update.new_chat_member
+        if new_member.user.id == self.owner_id:
+            # 所有者自身的变化可以直接得到最新状态
+            is_member = new_member.status in ['creator', 'administrator', 'member']
+            self._owner_membership.set(chat_id, is_member)
+        elif update.my_chat_member:
+            # 机器人被加入或移出群组时，下次收到消息重新查询
+            self._owner_membership.pop(chat_id)
 
     async def sync_messages(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """同步群组历史消息"""
@@ -447,10 +1034,10 @@ class TelegramBot:
                 chat_id = current_chat.id
                 chat_title = current_chat.title
                 
-                print(f"\n开始同步群组：{chat_title} (ID: {chat_id})")
+                logger.info("开始同步群组：%s (ID: %s)", chat_title, chat_id)
                 
                 # 更新群组信息
-                self.db.update_chat_info(chat_id, chat_title)
+                await self.db.update_chat_info(chat_id, chat_title)
                 
                 try:
                     # 获取历史消息
@@ -477,6 +1064,7 @@ class TelegramBot:
                                 
                             messages_to_store.append({
                                 'chat_id': chat_id,
+                                'message_id': message.message_id,
                                 'user_id': message.from_user.id if message.from_user else 0,
                                 'username': username or "unknown",
                                 'message_text': message.text,
@@ -484,7 +1072,7 @@ class TelegramBot:
                             })
                             
                             if len(messages_to_store) >= 100:  # 批量存储
-                                self.db.store_messages_batch(messages_to_store)
+                                await self.db.store_messages_batch(messages_to_store)
                                 total_messages += len(messages_to_store)
                                 messages_to_store = []
                                 await status_message.edit_text(f"已同步 {total_messages} 条消息...")
@@ -498,20 +1086,22 @@ class TelegramBot:
                     
                     # 存储剩余消息
                     if messages_to_store:
-                        self.db.store_messages_batch(messages_to_store)
+                        await self.db.store_messages_batch(messages_to_store)
                         total_messages += len(messages_to_store)
                         await status_message.edit_text(f"已同步 {total_messages} 条消息...")
                         
                 except Exception as e:
-                    print(f"同步群组 {chat_title} 的消息时出错：{str(e)}")
+                    logger.exception("同步群组 %s 的消息时出错：%s", chat_title, e)
             
             if total_messages > 0:
+                self.schedule_embedding_index()
+                self.schedule_summary_refresh(chat_id, force=True)
                 await status_message.edit_text(f"同步完成！共同步了 {total_messages} 条消息。")
             else:
                 await status_message.edit_text("未找到需要同步的消息。请确保我在群组中并且有足够的权限。")
             
         except Exception as e:
-            print(f"同步消息时出错：{str(e)}")
+            logger.exception("同步消息时出错：%s", e)
             await update.message.reply_text(f"同步消息时出错：{str(e)}")
 
     async def import_json(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -544,96 +1134,93 @@ class TelegramBot:
                 
             status_message = await update.message.reply_text("正在处理聊天记录...")
             
-            # 下载文件
+            # 下载到临时文件，之后流式解析，不把整个文件读入内存
             file = await context.bot.get_file(update.message.document.file_id)
-            json_str = await file.download_as_bytearray()
-            
-            # 解析JSON
+            fd, path = tempfile.mkstemp(suffix='.json')
+            os.close(fd)
             try:
-                chat_data = json.loads(json_str.decode('utf-8'))
-            except json.JSONDecodeError:
-                await status_message.edit_text("无法解析JSON文件，请确保文件格式正确。")
-                return
-                
-            # 验证JSON结构
-            if 'messages' not in chat_data:
-                await status_message.edit_text("JSON文件格式不正确，找不到消息记录。")
-                return
-                
-            # 获取群组信息
-            chat_id = chat_data.get('id', 0)
-            chat_name = chat_data.get('name', 'Unknown Group')
-            
-            # 检查群组是否存在
-            exists, existing_count = self.db.check_chat_exists(chat_id)
-            if exists:
-                await status_message.edit_text(
-                    f"检测到群组 {chat_name} (ID: {chat_id}) 已存在，"
-                    f"当前有 {existing_count} 条消息。\n"
-                    f"正在导入新消息..."
-                )
-            else:
-                await status_message.edit_text(
-                    f"正在导入群组 {chat_name} (ID: {chat_id}) 的消息..."
-                )
-            
-            # 更新群组信息
-            self.db.update_chat_info(chat_id, chat_name)
+                await file.download_to_drive(path)
+                with open(path, encoding='utf-8') as export_file:
+                    await self._import_export_file(export_file, status_message)
+            finally:
+                os.remove(path)
+            self.schedule_embedding_index()
             
-            # 处理消息
-            messages_to_store = []
-            total_messages = 0
-            new_messages = 0
+        except Exception as e:
+            logger.exception("导入JSON文件时出错：%s", e)
+            await update.message.reply_text(f"导入JSON文件时出错：{str(e)}")
+
+    async def _import_export_file(self, export_file, status_message):
+        """流式导入已下载的导出文件，按批写入并定期更新进度"""
+        reader = ExportReader(export_file)
+        
+        # 解析群组信息
+        try:
+            chat_data = await asyncio.to_thread(reader.read_header)
+        except json.JSONDecodeError:
+            await status_message.edit_text("无法解析JSON文件，请确保文件格式正确。")
+            return
+        except ValueError:
+            await status_message.edit_text("JSON文件格式不正确，找不到消息记录。")
+            return
             
-            for msg in chat_data['messages']:
-                if msg.get('type') != 'message' or 'text' not in msg:
-                    continue
-                    
-                # 处理文本内容
-                text = msg['text']
-                if isinstance(text, list):  # 处理富文本消息
-                    text_parts = []
-                    for part in text:
-                        if isinstance(part, str):
-                            text_parts.append(part)
-                        elif isinstance(part, dict):
-                            text_parts.append(part.get('text', ''))
-                    text = ' '.join(text_parts)
-                
-                messages_to_store.append({
-                    'chat_id': chat_id,
-                    'user_id': msg.get('from_id', '').replace('user', '') if msg.get('from_id') else 0,
-                    'username': msg.get('from', 'unknown'),
-                    'message_text': text,
-                    'timestamp': msg.get('date', '')
-                })
-                total_messages += 1
-                
-                if len(messages_to_store) >= 100:  # 批量存储
-                    new_count = self.db.store_messages_batch(messages_to_store)
-                    new_messages += new_count
-                    messages_to_store = []
-                    await status_message.edit_text(
+        # 获取群组信息
+        chat_id = chat_data.get('id', 0)
+        chat_name = chat_data.get('name', 'Unknown Group')
+        
+        # 检查群组是否存在
+        exists, existing_count = await self.db.check_chat_exists(chat_id)
+        if exists:
+            await status_message.edit_text(
+                f"检测到群组 {chat_name} (ID: {chat_id}) 已存在，"
+                f"当前有 {existing_count} 条消息。\n"
+                f"正在导入新消息..."
+            )
+        else:
+            await status_message.edit_text(
+                f"正在导入群组 {chat_name} (ID: {chat_id}) 的消息..."
+            )
+        
+        # 更新群组信息
+        await self.db.update_chat_info(chat_id, chat_name)
+        
+        # 解析在线程中进行，每次取一批，避免阻塞事件循环
+        batches = reader.iter_batches(chat_id, self.IMPORT_BATCH_SIZE)
+        total_messages = 0
+        new_messages = 0
+        loop = asyncio.get_running_loop()
+        last_edit = loop.time()
+        try:
+            while True:
+                batch = await asyncio.to_thread(next, batches, None)
+                if batch is None:
+                    break
+                total_messages += len(batch)
+                new_messages += await self.db.store_messages_batch(batch)
+                now = loop.time()
+                if now - last_edit >= self.PROGRESS_EDIT_INTERVAL:
+                    last_edit = now
+                    await self._edit_progress(
+                        status_message,
                         f"正在导入消息...\n"
                         f"总消息数：{total_messages}\n"
                         f"新消息数：{new_messages}"
                     )
-            
-            # 存储剩余消息
-            if messages_to_store:
-                new_count = self.db.store_messages_batch(messages_to_store)
-                new_messages += new_count
-            
+        except ValueError:
             await status_message.edit_text(
-                f"导入完成！\n"
-                f"群组：{chat_name}\n"
-                f"总消息数：{total_messages}\n"
+                f"JSON文件在第 {total_messages} 条消息附近解析失败，之前的消息已导入。\n"
                 f"新消息数：{new_messages}"
             )
-            
-        except Exception as e:
-            print(f"导入JSON文件时出错：{str(e)}")
-            await update.message.reply_text(f"导入JSON文件时出错：{str(e)}")
+            return
+        
+        if new_messages:
+            self.schedule_summary_refresh(chat_id, force=True)
+        await status_message.edit_text(
+            f"导入完成！\n"
+            f"群组：{chat_name}\n"
+            f"总消息数：{total_messages}\n"
+            f"新消息数：{new_messages}"
+        )
 
     async def delete_chat(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """处理 /delete 命令"""
@@ -644,7 +1231,7 @@ class TelegramBot:
             await update.message.reply_text("请在私聊中使用此命令。")
             return
 
-        groups = self.db.get_all_groups()
+        groups = await self.db.get_all_groups()
         if not groups:
             await update.message.reply_text("未找到任何群组记录。")
             return
@@ -720,20 +1307,42 @@ class TelegramBot:
         )
 
 def main():
-    # 打印环境变量信息用于调试
-    print("\n=== 环境变量信息 ===")
-    print(f"TELEGRAM_TOKEN: {'已设置' if TELEGRAM_TOKEN else '未设置'}")
-    print(f"GEMINI_API_KEY: {'已设置' if GEMINI_API_KEY else '未设置'}")
-    print(f"BOT_OWNER_ID: {BOT_OWNER_ID}")
-    print(f"USE_WEBHOOK: {USE_WEBHOOK}")
+    setup_logging(LOG_LEVEL, LOG_FORMAT, LOG_SAMPLE_RATE)
+
+    # 记录环境变量信息用于调试
+    logger.info("TELEGRAM_TOKEN: %s", '已设置' if TELEGRAM_TOKEN else '未设置')
+    logger.info("GEMINI_API_KEY: %s", '已设置' if GEMINI_API_KEY else '未设置')
+    logger.info("BOT_OWNER_ID: %s", BOT_OWNER_ID)
+    logger.info("USE_WEBHOOK: %s", USE_WEBHOOK)
     if USE_WEBHOOK:
-        print(f"WEBHOOK_HOST: {WEBHOOK_HOST}")
-        print(f"WEBHOOK_PORT: {WEBHOOK_PORT}")
-        print(f"WEBHOOK_LISTEN: {WEBHOOK_LISTEN}")
-        print(f"WEBHOOK_URL: {WEBHOOK_URL}")
-    print("===================\n")
+        logger.info("WEBHOOK_HOST: %s", WEBHOOK_HOST)
+        logger.info("WEBHOOK_PORT: %s", WEBHOOK_PORT)
+        logger.info("WEBHOOK_LISTEN: %s", WEBHOOK_LISTEN)
 
     bot = TelegramBot()
+
+    async def post_init(application: Application) -> None:
+        bot.buffer.start()
+        bot.scheduler.start()
+        bot.backfill.start()
+        SCHEDULER_QUEUE_DEPTH.set_function(lambda: bot.scheduler.queue_depth)
+        SCHEDULER_RUNNING.set_function(lambda: bot.scheduler.running_count)
+        BUFFER_PENDING.set_function(lambda: len(bot.buffer))
+        GOVERNOR_QUEUE_DEPTH.set_function(lambda: bot.gemini.governor.queue_depth)
+        # 补上次运行之后（或首次启用时已有）尚未索引的消息
+        bot.schedule_embedding_index()
+        if METRICS_PORT:
+            bot.metrics_runner = await start_metrics_server(METRICS_LISTEN, METRICS_PORT)
+
+    async def post_shutdown(application: Application) -> None:
+        # 先写入缓冲区中剩余的消息，再等待排队中的数据库操作完成后关闭连接
+        await bot.buffer.close()
+        await bot.scheduler.stop()
+        await bot.backfill.stop()
+        if bot.metrics_runner:
+            await bot.metrics_runner.cleanup()
+        bot.db.close()
+
     application = (
         Application.builder()
         .token(TELEGRAM_TOKEN)
@@ -742,54 +1351,59 @@ def main():
         .read_timeout(60.0)
         .write_timeout(60.0)
         .pool_timeout(60.0)
+        .concurrent_updates(True)  # 并发处理更新，避免一次 Gemini 调用阻塞其他消息
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
         .build()
     )
 
     # 添加错误处理器
     async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
-        print(f"发生错误：{context.error}")
+        logger.error("发生错误：%s", context.error, exc_info=context.error)
 
     application.add_error_handler(error_handler)
 
     # 添加命令处理器
-    application.add_handler(CommandHandler("start", bot.start))
-    application.add_handler(CommandHandler("help", bot.help))  # 使用独立的 help 处理函数
-    application.add_handler(CommandHandler("lang", bot.lang))
-    application.add_handler(CommandHandler("analyze", bot.analyze_history))
-    application.add_handler(CommandHandler("actions", bot.check_action_items))
-    application.add_handler(CommandHandler("suggest", bot.suggest_reply))
-    application.add_handler(CommandHandler("sync", bot.sync_messages))
-    application.add_handler(CommandHandler("import", bot.import_json))
-    application.add_handler(CommandHandler("delete", bot.delete_chat))
-    application.add_handler(CommandHandler("setprompt", bot.set_prompt))
-    application.add_handler(CommandHandler("setcount", bot.set_suggest_count))
-    application.add_handler(CommandHandler("setmodel", bot.set_model))
-    application.add_handler(CallbackQueryHandler(bot.handle_callback))
+    application.add_handler(CommandHandler("start", track_handler(bot.start)))
+    application.add_handler(CommandHandler("help", track_handler(bot.help)))  # 使用独立的 help 处理函数
+    application.add_handler(CommandHandler("lang", track_handler(bot.lang)))
+    application.add_handler(CommandHandler("analyze", track_handler(bot.analyze_history)))
+    application.add_handler(CommandHandler("actions", track_handler(bot.check_action_items)))
+    application.add_handler(CommandHandler("suggest", track_handler(bot.suggest_reply)))
+    application.add_handler(CommandHandler("search", track_handler(bot.search)))
+    application.add_handler(CommandHandler("sync", track_handler(bot.sync_messages)))
+    application.add_handler(CommandHandler("import", track_handler(bot.import_json)))
+    application.add_handler(CommandHandler("delete", track_handler(bot.delete_chat)))
+    application.add_handler(CommandHandler("setprompt", track_handler(bot.set_prompt)))
+    application.add_handler(CommandHandler("setcount", track_handler(bot.set_suggest_count)))
+    application.add_handler(CommandHandler("setmodel", track_handler(bot.set_model)))
+    application.add_handler(CallbackQueryHandler(track_handler(bot.handle_callback)))
+    application.add_handler(ChatMemberHandler(track_handler(bot.chat_member_handler), ChatMemberHandler.ANY_CHAT_MEMBER))
     
     # 添加消息处理器
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, bot.message_handler))
-    application.add_handler(MessageHandler(filters.Document.ALL, bot.import_json))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, track_handler(bot.message_handler)))
+    application.add_handler(MessageHandler(filters.Document.ALL, track_handler(bot.import_json)))
 
     # 根据配置决定使用 webhook 还是 polling
     if USE_WEBHOOK:
-        print(f"正在以 Webhook 模式启动机器人...")
-        print(f"Webhook URL: {WEBHOOK_URL}")
-        print(f"监听地址: {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_URL_PATH}")
+        # Webhook URL 中包含 Bot Token，只在 debug 级别输出
+        logger.info("正在以 Webhook 模式启动机器人，监听端口：%s:%s", WEBHOOK_LISTEN, WEBHOOK_PORT)
+        logger.debug("Webhook URL: %s", WEBHOOK_URL)
         
         application.run_webhook(
             listen=WEBHOOK_LISTEN,
             port=WEBHOOK_PORT,
             url_path=WEBHOOK_URL_PATH,
             webhook_url=WEBHOOK_URL,
-            allowed_updates=["message", "callback_query"],
+            allowed_updates=["message", "callback_query", "chat_member", "my_chat_member"],
             drop_pending_updates=True,
             max_connections=100
         )
     else:
-        print("正在以 Polling 模式启动机器人...")
+        logger.info("正在以 Polling 模式启动机器人...")
         application.run_polling(
             drop_pending_updates=True,
-            allowed_updates=["message", "callback_query"]
+            allowed_updates=["message", "callback_query", "chat_member", "my_chat_member"]
         )
 
 if __name__ == '__main__':
@@ -17,6 +17,67 @@ WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
 WEBHOOK_URL_PATH = f"/webhook/{TELEGRAM_TOKEN}"
 WEBHOOK_URL = f"https://{WEBHOOK_HOST}/webhook/{TELEGRAM_TOKEN}"
 
+# Gemini 调用配置
+GEMINI_TIMEOUT = float(os.getenv("GEMINI_TIMEOUT", "120"))  # 单次调用超时（秒）
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "8"))  # 同时进行的请求上限
+GEMINI_RPM = int(os.getenv("GEMINI_RPM", "0"))  # 每个模型每分钟的请求数上限，0 表示不限
+GEMINI_TPM = int(os.getenv("GEMINI_TPM", "0"))  # 每个模型每分钟的 token 数上限，0 表示不限
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "3"))  # 遇到 429/5xx 时的重试次数
+GEMINI_RETRY_BASE_DELAY = float(os.getenv("GEMINI_RETRY_BASE_DELAY", "2"))  # 重试退避的基数（秒），每次翻倍
+GEMINI_OWNER_WEIGHT = int(os.getenv("GEMINI_OWNER_WEIGHT", "3"))  # 排队时每放行几个所有者请求放行一个后台请求
+
+# Gemini 后端：google 调用真实 API；fake 为本地模拟，用于压测和离线调试
+GEMINI_BACKEND = os.getenv("GEMINI_BACKEND", "google").lower()
+GEMINI_FAKE_LATENCY = float(os.getenv("GEMINI_FAKE_LATENCY", "0.5"))  # 延迟中位数（秒）
+GEMINI_FAKE_JITTER = float(os.getenv("GEMINI_FAKE_JITTER", "0.3"))  # 延迟分布的离散程度
+GEMINI_FAKE_ERROR_RATE = float(os.getenv("GEMINI_FAKE_ERROR_RATE", "0"))  # 随机返回 429 的比例
+GEMINI_FAKE_RPM = int(os.getenv("GEMINI_FAKE_RPM", "0"))  # 每分钟请求上限，0 表示不限
+GEMINI_FAKE_SEED = int(os.getenv("GEMINI_FAKE_SEED", "0"))
+
+# 上下文 token 预算，0 表示使用各模型的默认值（见 GeminiHandler.AVAILABLE_MODELS）
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "0"))
+
+# 相关历史检索：待办和回复建议除了最近消息，还会附上按相关度检索到的更早消息
+RETRIEVAL_LIMIT = int(os.getenv("RETRIEVAL_LIMIT", "40"))  # 最多附上的历史消息数，0 表示关闭
+RETRIEVAL_RECENT_MESSAGES = int(os.getenv("RETRIEVAL_RECENT_MESSAGES", "100"))  # 查看群组待办时读取的最近消息数
+
+# 本地向量索引（需要安装 numpy），用于语义检索相关的历史消息
+EMBEDDING_INDEX = os.getenv("EMBEDDING_INDEX", "false").lower() == "true"
+EMBEDDING_DIR = os.getenv("EMBEDDING_DIR", "data/embeddings")
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "5000"))  # 后台每批索引的消息数
+
+# 分层时间摘要（日/周/月/年）：/analyze <天数> 总是使用并按需生成；开启后在后台提前补齐
+SUMMARY_TREE = os.getenv("SUMMARY_TREE", "false").lower() == "true"
+SUMMARY_BUILD_LIMIT = int(os.getenv("SUMMARY_BUILD_LIMIT", "50"))  # 后台每次最多生成的摘要数
+
+# Gemini 响应缓存配置
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "3600"))  # 缓存有效期（秒）
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "256"))  # 内存中保留的条目数
+
+# 消息写入配置
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "200"))  # 攒满多少条消息写入一次
+INGEST_FLUSH_INTERVAL_MS = int(os.getenv("INGEST_FLUSH_INTERVAL_MS", "500"))  # 最长写入间隔（毫秒）
+
+# 群组分析调度配置
+ANALYSIS_MAX_CONCURRENCY = int(os.getenv("ANALYSIS_MAX_CONCURRENCY", "2"))  # 同时运行的分析任务上限
+ANALYSIS_DEBOUNCE_SECONDS = float(os.getenv("ANALYSIS_DEBOUNCE_SECONDS", "5"))  # 自动分析的防抖时间（秒）
+
+# 今日待办并发检查配置
+ACTIONS_MAX_CONCURRENCY = int(os.getenv("ACTIONS_MAX_CONCURRENCY", "5"))  # 同时检查的群组数
+ACTIONS_TIMEOUT = float(os.getenv("ACTIONS_TIMEOUT", "90"))  # 检查所有群组的总时限（秒）
+
+# 所有者群组成员状态的缓存时间（秒）
+OWNER_MEMBERSHIP_TTL = int(os.getenv("OWNER_MEMBERSHIP_TTL", "600"))
+
+# 指标接口配置，默认不启动；接口没有认证，默认只监听本机
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
+# 日志配置
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()  # DEBUG 级别会输出完整的 prompt 和响应
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")  # text 或 json
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "0.1"))  # 每条消息的高频事件抽样比例
+
 # 语言配置
 DEFAULT_LANGUAGE = os.getenv("DEFAULT_LANGUAGE", "zh")
 
@@ -25,9 +86,11 @@ def validate_config():
     """验证必要的配置是否存在"""
     required_vars = {
         "TELEGRAM_TOKEN": TELEGRAM_TOKEN,
-        "GEMINI_API_KEY": GEMINI_API_KEY,
         "BOT_OWNER_ID": BOT_OWNER_ID
     }
+    # fake 后端不访问 Gemini API，不需要 API Key
+    if GEMINI_BACKEND != "fake":
+        required_vars["GEMINI_API_KEY"] = GEMINI_API_KEY
     
     missing_vars = [var for var, value in required_vars.items() if not value]
     
@@ -36,6 +99,9 @@ def validate_config():
         
     if BOT_OWNER_ID == 0:
         raise ValueError("BOT_OWNER_ID 无效")
+
+    if GEMINI_BACKEND not in ("google", "fake"):
+        raise ValueError(f"GEMINI_BACKEND 无效：{GEMINI_BACKEND}（可选 google 或 fake）")
         
     if USE_WEBHOOK:
         webhook_vars = {
@@ -0,0 +1,78 @@
+from collections import OrderedDict
+import threading
+import time
+
+
+class TTLCache:
+    """带过期时间的内存缓存，超过容量时淘汰最久未使用的条目"""
+
+    def __init__(self, ttl, maxsize=1024):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key, default=None):
+        """获取未过期的缓存值，不存在或已过期时返回 default"""
+        item = self._data.get(key)
+        if item is None:
+            return default
+        value, expires_at = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl=None):
+        """写入缓存值，ttl 为空时使用默认过期时间"""
+        self._data[key] = (value, time.monotonic() + (ttl if ttl is not None else self.ttl))
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """删除缓存值，返回被删除的值"""
+        item = self._data.pop(key, None)
+        return item[0] if item else default
+
+    def clear(self):
+        self._data.clear()
+
+
+class WriteThroughCache:
+    """线程安全的进程内缓存，用于很少修改、条目很少的表
+
+    读取未命中时用 fill 填入从数据库读到的值，写入数据库后用 set 同步更新。
+    fill 不覆盖已有的值：读线程读到旧值的同时，写线程可能已经写入并缓存了新值。
+    """
+    MISSING = object()
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        """返回缓存值，未缓存时返回 MISSING（缓存的值本身可能是 None）"""
+        with self._lock:
+            return self._data.get(key, self.MISSING)
+
+    def fill(self, key, value):
+        with self._lock:
+            return self._data.setdefault(key, value)
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
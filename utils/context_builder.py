@@ -0,0 +1,54 @@
+import re
+
+# 中日韩文字、全角符号等，大致每个字符对应一个 token
+_WIDE_CHARS = re.compile(r'[\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]')
+
+# 单条消息最多占用的 token 数，超出部分截断
+MAX_MESSAGE_TOKENS = 500
+
+
+def estimate_tokens(text):
+    """快速估算文本的 token 数
+
+    中日韩字符按每字 1 个 token，其余字符按每 4 个字符 1 个 token 计算，
+    不调用模型的 count_tokens 接口。
+    """
+    if not text:
+        return 0
+    wide = len(_WIDE_CHARS.findall(text))
+    return wide + (len(text) - wide + 3) // 4
+
+
+def truncate_text(text, max_tokens):
+    """按比例截断过长的文本"""
+    tokens = estimate_tokens(text)
+    if tokens <= max_tokens:
+        return text
+    return text[:max(1, len(text) * max_tokens // tokens)] + "…"
+
+
+def build_context(messages, budget, keep='latest', max_message_tokens=MAX_MESSAGE_TOKENS):
+    """在 token 预算内格式化消息记录
+
+    messages 为按时间正序排列的 (username, text, timestamp)。keep='latest' 时优先保留
+    最新的消息，keep='oldest' 时从最早的消息开始取（用于按顺序增量处理）。
+    返回 (格式化文本, 实际使用的消息数)，文本中的消息始终按时间正序排列。
+    """
+    ordered = reversed(messages) if keep == 'latest' else messages
+    lines = []
+    used = 0
+    for username, text, timestamp in ordered:
+        line = f"[{timestamp}] {username}: {truncate_text(text or '', max_message_tokens)}"
+        # 加 1 计入换行符
+        cost = estimate_tokens(line) + 1
+        if used + cost > budget:
+            if lines:
+                break
+            # 第一条消息就超出预算时截断它，保证至少包含一条消息
+            line = truncate_text(line, budget - 1)
+            cost = estimate_tokens(line) + 1
+        lines.append(line)
+        used += cost
+    if keep == 'latest':
+        lines.reverse()
+    return "\n".join(lines), len(lines)
@@ -1,18 +1,79 @@
 import sqlite3
 import json
-from datetime import datetime
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import functools
+import threading
+import logging
+import time
 import os
 
+from utils.cache import WriteThroughCache
+from utils.metrics import DB_QUERY_SECONDS, DB_QUEUE_SECONDS, DB_ERRORS
+
+logger = logging.getLogger(__name__)
+
+def normalize_chat_id(chat_id):
+    """统一群组ID的符号
+
+    Telegram 群组ID为负数，而导出文件中的ID为正数。写入和查询前统一转换为负数，
+    查询时即可直接使用等值匹配并命中索引。
+    """
+    return -abs(int(chat_id))
+
 class DatabaseHandler:
-    def __init__(self, db_name="data/telegram_bot.db"):
-        print(f"初始化数据库：{db_name}")
+    # 当前数据库结构版本，保存在 PRAGMA user_version 中
+    SCHEMA_VERSION = 6
+    # 检索相关消息时最多参与相关度排序的候选消息数
+    MAX_RETRIEVAL_CANDIDATES = 20000
+    # 搜索词都少于 3 个字符（无法使用 trigram 全文索引）时，最多逐条匹配的最近消息数
+    MAX_SHORT_TERM_SCAN = 20000
+
+    def __init__(self, db_name="data/telegram_bot.db", embeddings=None):
+        logger.info("初始化数据库：%s", db_name)
         self.db_name = db_name
+        # 可选的消息向量索引（utils/embedding_index.py），为 None 时不提供语义检索
+        self.embeddings = embeddings
+        self._embedding_lock = threading.Lock()
+        # 每个线程持有一条长连接，避免每次查询都重新建立连接
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        # user_preferences 和 system_prompts 只在 /lang、/setprompt 时修改，读取全部走内存缓存
+        self.language_cache = WriteThroughCache()
+        self.prompt_cache = WriteThroughCache()
+        # 全文索引的分词方式，首次搜索时读取
+        self._fts_trigram = None
         # 确保数据目录存在
         os.makedirs(os.path.dirname(self.db_name), exist_ok=True)
         self.init_db()
 
+    def _get_connection(self):
+        """获取当前线程的数据库连接，首次调用时创建"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # 连接只在创建它的线程中使用，关闭时可能来自其他线程
+            conn = sqlite3.connect(self.db_name, timeout=30, check_same_thread=False)
+            # WAL 模式下读写互不阻塞
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def close(self):
+        """关闭所有线程的数据库连接"""
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self._local = threading.local()
+        logger.info("数据库连接已关闭")
+
     def init_db(self):
-        with sqlite3.connect(self.db_name) as conn:
+        with self._get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS messages (
@@ -68,81 +129,508 @@ class DatabaseHandler:
                 ('actions', '分析以下今日群组聊天记录，找出需要我执行的待办事项：'),
                 ('suggestion', '根据以下最新消息，建议一个合适的回复：')
             ''')
+            self._migrate(conn)
             conn.commit()
-            print("数据库初始化完成")
-
-    def store_message(self, chat_id, user_id, username, message_text, timestamp):
-        print(f"\n=== 存储新消息 ===")
-        print(f"群组ID: {chat_id}")
-        print(f"用户ID: {user_id}")
-        print(f"用户名: {username}")
-        print(f"消息内容: {message_text[:50]}...")
-        print(f"时间戳: {timestamp}")
-        
-        with sqlite3.connect(self.db_name) as conn:
-            cursor = conn.cursor()
+        # 默认 prompt 可能刚刚写入，丢弃此前缓存的“未找到”
+        self.prompt_cache.clear()
+        logger.info("数据库初始化完成")
+
+    def _migrate(self, conn):
+        """将已有数据库原地升级到当前结构版本"""
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if version >= self.SCHEMA_VERSION:
+            return
+        logger.info("升级数据库结构：v%d -> v%d", version, self.SCHEMA_VERSION)
+        cursor = conn.cursor()
+
+        if version < 1:
+            # 统一群组ID为负数，查询不再需要 ABS() 全表扫描
+            for table in ('messages', 'chat_info', 'analysis'):
+                cursor.execute(f'UPDATE {table} SET chat_id = -chat_id WHERE chat_id > 0')
+                logger.info("已规范化 %s 表中 %d 条记录的群组ID", table, cursor.rowcount)
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_messages_chat_timestamp
+                ON messages (chat_id, timestamp)
+            ''')
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_analysis_chat_type_created
+                ON analysis (chat_id, analysis_type, created_at)
+            ''')
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_chat_info_chat_updated
+                ON chat_info (chat_id, last_updated)
+            ''')
+
+        if version < 2:
+            # 背景分析记录覆盖到的最后一条消息ID，用于增量更新
+            cursor.execute('ALTER TABLE analysis ADD COLUMN message_watermark INTEGER')
+            # 按群组查找水位线之后的消息，先建索引，下面的回填也按群组走这个索引
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_messages_chat_id
+                ON messages (chat_id, id)
+            ''')
+            # 只有每个群组最新的背景分析会被读取，只回填这一条：每个群组计算一次 MAX(id)，
+            # 旧版本每 20 条消息写一条背景分析，逐条回填的耗时随消息数平方增长
+            cursor.execute('''
+                UPDATE analysis
+                SET message_watermark = (
+                    SELECT MAX(m.id)
+                    FROM messages m
+                    WHERE m.chat_id = analysis.chat_id AND m.created_at <= analysis.created_at
+                )
+                WHERE id IN (
+                    SELECT (
+                        SELECT a.id
+                        FROM analysis a
+                        WHERE a.chat_id = chats.chat_id AND a.analysis_type = 'background'
+                        ORDER BY a.created_at DESC, a.id DESC
+                        LIMIT 1
+                    )
+                    FROM (SELECT DISTINCT chat_id FROM analysis WHERE analysis_type = 'background') chats
+                )
+            ''')
+
+        if version < 3:
+            # Gemini 响应缓存
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS response_cache (
+                    cache_key TEXT PRIMARY KEY,
+                    model_name TEXT,
+                    response TEXT,
+                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_response_cache_created
+                ON response_cache (created_at)
+            ''')
+
+        if version < 4:
+            # Telegram 消息ID，(chat_id, message_id) 唯一，重复导入时直接忽略
+            cursor.execute('ALTER TABLE messages ADD COLUMN message_id INTEGER')
+            cursor.execute('''
+                CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_chat_message
+                ON messages (chat_id, message_id)
+            ''')
+
+        if version < 5:
+            # 消息全文索引：external content 表只保存索引，内容仍从 messages 读取，由触发器保持同步。
+            # trigram 分词支持中文任意子串搜索（SQLite 3.34+），旧版本退回 unicode61
+            try:
+                cursor.execute(self._CREATE_FTS_SQL.format(tokenize='trigram'))
+            except sqlite3.OperationalError:
+                logger.warning("SQLite 不支持 trigram 分词，全文索引改用 unicode61")
+                cursor.execute(self._CREATE_FTS_SQL.format(tokenize='unicode61'))
+            cursor.execute('''
+                CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+                    INSERT INTO messages_fts (rowid, message_text) VALUES (new.id, new.message_text);
+                END
+            ''')
             cursor.execute('''
-                INSERT INTO messages (chat_id, user_id, username, message_text, timestamp)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (chat_id, user_id, username, message_text, timestamp))
+                CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+                    INSERT INTO messages_fts (messages_fts, rowid, message_text)
+                    VALUES ('delete', old.id, old.message_text);
+                END
+            ''')
+            cursor.execute('''
+                CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF message_text ON messages BEGIN
+                    INSERT INTO messages_fts (messages_fts, rowid, message_text)
+                    VALUES ('delete', old.id, old.message_text);
+                    INSERT INTO messages_fts (rowid, message_text) VALUES (new.id, new.message_text);
+                END
+            ''')
+            # 为已有消息建立索引
+            cursor.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+
+        if version < 6:
+            # 分层时间摘要（见 utils/summary_tree.py）。message_count 和 message_watermark 记录生成时
+            # 该周期内的消息数和最大消息ID，与当前值不一致（如导入了更早的消息）时重新生成
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS summaries (
+                    chat_id INTEGER,
+                    level TEXT,
+                    period_start TEXT,
+                    content TEXT,
+                    message_count INTEGER,
+                    message_watermark INTEGER,
+                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (chat_id, level, period_start)
+                )
+            ''')
+
+        cursor.execute(f'PRAGMA user_version = {self.SCHEMA_VERSION}')
+        logger.info("数据库结构升级完成")
+
+    _CREATE_FTS_SQL = '''
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            message_text, content='messages', content_rowid='id', tokenize='{tokenize}'
+        )
+    '''
+
+    # 已存在相同 (chat_id, message_id) 的消息时忽略，没有 message_id 的消息总是写入
+    _INSERT_MESSAGE_SQL = '''
+        INSERT OR IGNORE INTO messages (chat_id, message_id, user_id, username, message_text, timestamp)
+        VALUES (:chat_id, :message_id, :user_id, :username, :message_text, :timestamp)
+    '''
+
+    # 导入和同步用：升级前写入的消息没有 message_id，唯一索引无法识别它们，
+    # 另外按群组、时间和内容跳过与这些旧消息重复的消息（与 merge_database 相同）
+    _INSERT_MESSAGE_DEDUP_LEGACY_SQL = '''
+        INSERT OR IGNORE INTO messages (chat_id, message_id, user_id, username, message_text, timestamp)
+        SELECT :chat_id, :message_id, :user_id, :username, :message_text, :timestamp
+        WHERE NOT EXISTS (
+            -- 按 (chat_id, timestamp) 定位；否则查询计划会沿唯一索引扫描群组中所有的旧消息
+            SELECT 1 FROM messages m INDEXED BY idx_messages_chat_timestamp
+            WHERE m.chat_id = :chat_id
+              AND m.timestamp = :timestamp
+              AND m.message_text = :message_text
+              AND m.message_id IS NULL
+        )
+    '''
+
+    @staticmethod
+    def _message_rows(messages):
+        """规范化群组ID并补全可选的 message_id 字段"""
+        return [
+            dict(msg, chat_id=normalize_chat_id(msg['chat_id']), message_id=msg.get('message_id'))
+            for msg in messages
+        ]
+
+    def store_message(self, chat_id, user_id, username, message_text, timestamp, message_id=None):
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(self._INSERT_MESSAGE_SQL, {
+                'chat_id': normalize_chat_id(chat_id),
+                'message_id': message_id,
+                'user_id': user_id,
+                'username': username,
+                'message_text': message_text,
+                'timestamp': timestamp
+            })
             conn.commit()
-            print(f"消息已存储，ID: {cursor.lastrowid}")
+            logger.debug("消息已存储：群组ID=%s，ID=%s", chat_id, cursor.lastrowid)
 
-    def get_chat_history(self, chat_id):
-        """获取群组历史消息"""
-        print(f"\n=== 获取群组历史消息 ===")
-        print(f"群组ID: {chat_id}")
-        with sqlite3.connect(self.db_name) as conn:
+    def get_recent_messages(self, chat_id, limit=100):
+        """获取群组最近的 limit 条消息，按时间正序返回
+
+        沿 (chat_id, timestamp) 索引倒序扫描，只读取需要的行，与群组消息总数无关。
+        """
+        with self._get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 SELECT username, message_text, timestamp
                 FROM messages
-                WHERE ABS(chat_id) = ABS(?)  -- 使用绝对值匹配
-                ORDER BY timestamp ASC  -- 按时间正序排列
-                LIMIT 100
-            ''', (chat_id,))
+                WHERE chat_id = ?
+                ORDER BY timestamp DESC, id DESC
+                LIMIT ?
+            ''', (normalize_chat_id(chat_id), limit))
             messages = cursor.fetchall()
-            print(f"获取到 {len(messages)} 条消息")
+            messages.reverse()
+            logger.debug("获取群组 %s 最近消息 %d 条（上限 %d）", chat_id, len(messages), limit)
             return messages
 
-    def get_today_messages(self, chat_id):
-        print(f"\n=== 获取今日消息 ===")
-        print(f"群组ID: {chat_id}")
-        today = datetime.now().date().isoformat()
-        with sqlite3.connect(self.db_name) as conn:
+    def get_messages_between(self, chat_id, start, end, limit=None):
+        """获取 [start, end) 时间范围内的消息，按时间正序返回
+
+        指定 limit 时只返回该范围内最新的 limit 条。
+        """
+        with self._get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 SELECT username, message_text, timestamp
                 FROM messages
-                WHERE ABS(chat_id) = ABS(?) AND date(timestamp) = ?
-                ORDER BY timestamp DESC
-            ''', (chat_id, today))
+                WHERE chat_id = ? AND timestamp >= ? AND timestamp < ?
+                ORDER BY timestamp DESC, id DESC
+                LIMIT ?
+            ''', (normalize_chat_id(chat_id), str(start), str(end), -1 if limit is None else limit))
             messages = cursor.fetchall()
-            print(f"获取到 {len(messages)} 条今日消息")
+            messages.reverse()
             return messages
 
+    def get_daily_message_stats(self, chat_id, start=None, end=None):
+        """按天统计 [start, end) 范围内的消息，返回 {日期: (消息数, 最大消息ID)}
+
+        只读取 (chat_id, timestamp) 索引，不读取消息内容。
+        """
+        params = [normalize_chat_id(chat_id)]
+        conditions = ''
+        if start is not None:
+            conditions += ' AND timestamp >= ?'
+            params.append(str(start))
+        if end is not None:
+            conditions += ' AND timestamp < ?'
+            params.append(str(end))
+        with self._get_connection() as conn:
+            rows = conn.execute(f'''
+                SELECT substr(timestamp, 1, 10), COUNT(*), MAX(id)
+                FROM messages
+                WHERE chat_id = ?{conditions}
+                GROUP BY 1
+            ''', params).fetchall()
+        stats = {}
+        for day, count, max_id in rows:
+            try:
+                stats[datetime.strptime(day, '%Y-%m-%d').date()] = (count, max_id)
+            except (TypeError, ValueError):
+                # 没有时间或格式无法识别的消息不计入任何一天
+                continue
+        return stats
+
+    def get_summaries(self, chat_id, start, end):
+        """获取周期起始日期在 [start, end) 内的分层摘要
+
+        返回 {(层级, 起始日期): (内容, 消息数, 最大消息ID)}。
+        """
+        with self._get_connection() as conn:
+            rows = conn.execute('''
+                SELECT level, period_start, content, message_count, message_watermark
+                FROM summaries
+                WHERE chat_id = ? AND period_start >= ? AND period_start < ?
+            ''', (normalize_chat_id(chat_id), str(start), str(end))).fetchall()
+        return {
+            (level, datetime.strptime(period_start, '%Y-%m-%d').date()): (content, count, watermark)
+            for level, period_start, content, count, watermark in rows
+        }
+
+    def store_summary(self, chat_id, level, period_start, content, message_count, message_watermark):
+        """保存一个周期的摘要，覆盖该周期已有的摘要"""
+        with self._get_connection() as conn:
+            conn.execute('''
+                INSERT OR REPLACE INTO summaries
+                    (chat_id, level, period_start, content, message_count, message_watermark)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (normalize_chat_id(chat_id), level, str(period_start), content, message_count, message_watermark))
+            conn.commit()
+        logger.debug("摘要已存储：群组ID=%s，%s %s，%d 条消息", chat_id, level, period_start, message_count)
+
+    def get_today_messages(self, chat_id):
+        """获取今日消息，按时间正序返回"""
+        today = datetime.now().date()
+        tomorrow = today + timedelta(days=1)
+        # 使用时间范围代替 date(timestamp)，可以命中 (chat_id, timestamp) 索引
+        messages = self.get_messages_between(chat_id, today.isoformat(), tomorrow.isoformat())
+        logger.debug("获取群组 %s 今日消息 %d 条", chat_id, len(messages))
+        return messages
+
+    def _fts_uses_trigram(self, conn):
+        """全文索引是否使用 trigram 分词（结果缓存，索引只在升级时创建）"""
+        if self._fts_trigram is None:
+            row = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'messages_fts'").fetchone()
+            self._fts_trigram = bool(row) and 'trigram' in row[0]
+        return self._fts_trigram
+
+    @staticmethod
+    def _fts_phrase(term, trigram):
+        """把一个词转为 FTS5 短语，避免被解析为查询语法；unicode61 分词按前缀匹配"""
+        phrase = '"' + term.replace('"', '""') + '"'
+        return phrase if trigram else phrase + '*'
+
+    @staticmethod
+    def _search_terms(query, trigram):
+        """把用户输入拆成 (FTS5 MATCH 表达式, 需要用 LIKE 匹配的短词)
+
+        每个词作为短语加引号，避免用户输入被解析为 FTS5 语法；多个词之间为 AND。
+        trigram 分词无法匹配少于 3 个字符的词，这些词改用 LIKE 过滤；
+        unicode61 分词按前缀匹配。
+        """
+        phrases = []
+        short_terms = []
+        for term in query.split():
+            if trigram and len(term) < 3:
+                short_terms.append(term)
+            else:
+                phrases.append(DatabaseHandler._fts_phrase(term, trigram))
+        return ' '.join(phrases) or None, short_terms
+
+    def search_messages(self, query, chat_id=None, limit=10, offset=0):
+        """全文搜索消息，按相关度（bm25）排序
+
+        chat_id 为空时搜索所有群组。返回 (消息列表, 是否还有下一页)，
+        消息为 (id, chat_id, username, message_text, timestamp)。
+        少于 3 个字符的词在全文索引命中的消息中用 LIKE 过滤；所有词都少于 3 个字符时
+        无法使用全文索引，只在最近的 MAX_SHORT_TERM_SCAN 条消息中查找，按时间倒序返回。
+        """
+        with self._get_connection() as conn:
+            match, short_terms = self._search_terms(query, self._fts_uses_trigram(conn))
+            if match is None and not short_terms:
+                return [], False
+
+            like_conditions = []
+            like_params = []
+            for term in short_terms:
+                escaped = term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+                like_conditions.append("m.message_text LIKE ? ESCAPE '\\'")
+                like_params.append(f'%{escaped}%')
+
+            if match is not None:
+                conditions = ['messages_fts MATCH ?']
+                params = [match]
+                if chat_id is not None:
+                    conditions.append('m.chat_id = ?')
+                    params.append(normalize_chat_id(chat_id))
+                conditions.extend(like_conditions)
+                params.extend(like_params)
+                sql = f'''
+                    SELECT m.id, m.chat_id, m.username, m.message_text, m.timestamp
+                    FROM messages_fts
+                    JOIN messages m ON m.id = messages_fts.rowid
+                    WHERE {' AND '.join(conditions)}
+                    ORDER BY messages_fts.rank, m.id DESC
+                    LIMIT ? OFFSET ?
+                '''
+            else:
+                # 下限取第 MAX_SHORT_TERM_SCAN 新的消息，按索引范围扫描，扫描量与消息总数无关
+                if chat_id is not None:
+                    chat_id = normalize_chat_id(chat_id)
+                    conditions = ['''m.chat_id = ? AND m.timestamp >= COALESCE((
+                        SELECT timestamp FROM messages WHERE chat_id = ?
+                        ORDER BY timestamp DESC LIMIT 1 OFFSET ?
+                    ), '')''']
+                    params = [chat_id, chat_id, self.MAX_SHORT_TERM_SCAN]
+                else:
+                    conditions = ['''m.id >= COALESCE((
+                        SELECT id FROM messages ORDER BY id DESC LIMIT 1 OFFSET ?
+                    ), 0)''']
+                    params = [self.MAX_SHORT_TERM_SCAN]
+                conditions.extend(like_conditions)
+                params.extend(like_params)
+                sql = f'''
+                    SELECT m.id, m.chat_id, m.username, m.message_text, m.timestamp
+                    FROM messages m
+                    WHERE {' AND '.join(conditions)}
+                    ORDER BY m.timestamp DESC, m.id DESC
+                    LIMIT ? OFFSET ?
+                '''
+            # 多取一条判断是否还有下一页
+            params.extend([limit + 1, offset])
+            rows = conn.execute(sql, params).fetchall()
+        logger.debug("搜索 %r（群组 %s）第 %d 条起返回 %d 条", query, chat_id, offset, min(len(rows), limit))
+        return rows[:limit], len(rows) > limit
+
+    def _select_selective_terms(self, conn, terms):
+        """按包含的消息数从少到多选取关键词，候选消息总数不超过 MAX_RETRIEVAL_CANDIDATES
+
+        文档数从 fts5vocab 读取；trigram 分词下一个词的文档数取其各三字片段文档数的最小值。
+        出现在大量消息中的词区分度低，却会让 bm25 对这些消息逐条打分，直接舍弃。
+        """
+        conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS temp.messages_fts_vocab USING fts5vocab(main, messages_fts, 'row')")
+        frequencies = []
+        for term in terms:
+            counts = []
+            for gram in {term[i:i + 3].lower() for i in range(len(term) - 2)}:
+                row = conn.execute("SELECT doc FROM temp.messages_fts_vocab WHERE term = ?", (gram,)).fetchone()
+                counts.append(row[0] if row else 0)
+            if min(counts):
+                frequencies.append((min(counts), term))
+        selected = []
+        candidates = 0
+        for count, term in sorted(frequencies):
+            if candidates + count > self.MAX_RETRIEVAL_CANDIDATES:
+                break
+            selected.append(term)
+            candidates += count
+        return selected
+
+    def get_related_messages(self, chat_id, terms, before=None, limit=50):
+        """在群组中检索包含任一关键词的消息，按相关度（bm25）排序
+
+        关键词之间为 OR，bm25 会让命中较少见词语、命中词语较多的消息排在前面。
+        before 为时间戳，只返回早于它的消息。返回 (username, message_text, timestamp) 列表。
+        """
+        with self._get_connection() as conn:
+            trigram = self._fts_uses_trigram(conn)
+            if trigram:
+                terms = self._select_selective_terms(conn, [term for term in terms if len(term) >= 3])
+            phrases = [self._fts_phrase(term, trigram) for term in terms]
+            if not phrases:
+                return []
+            params = [' OR '.join(phrases), normalize_chat_id(chat_id)]
+            before_clause = ''
+            if before is not None:
+                before_clause = 'AND m.timestamp < ?'
+                params.append(str(before))
+            params.append(limit)
+            rows = conn.execute(f'''
+                SELECT m.username, m.message_text, m.timestamp
+                FROM messages_fts
+                JOIN messages m ON m.id = messages_fts.rowid
+                WHERE messages_fts MATCH ? AND m.chat_id = ? {before_clause}
+                ORDER BY messages_fts.rank
+                LIMIT ?
+            ''', params).fetchall()
+        logger.debug("群组 %s 检索到 %d 条相关消息，关键词：%s", chat_id, len(rows), terms)
+        return rows
+
+    def index_embeddings(self, batch_size=5000):
+        """把向量索引水位线之后的一批新消息加入索引，返回本批处理的消息数，未启用索引时返回 0"""
+        if self.embeddings is None:
+            return 0
+        # 同一时间只有一个线程追加，避免重复索引同一批消息
+        with self._embedding_lock:
+            with self._get_connection() as conn:
+                rows = conn.execute('''
+                    SELECT id, chat_id, message_text
+                    FROM messages
+                    WHERE id > ?
+                    ORDER BY id
+                    LIMIT ?
+                ''', (self.embeddings.watermark, batch_size)).fetchall()
+            if not rows:
+                return 0
+            # 没有文本的消息（如图片）不建立向量，但水位线照常推进
+            rows_with_text = [row for row in rows if row[2]]
+            self.embeddings.append(
+                [row[0] for row in rows_with_text],
+                [row[1] for row in rows_with_text],
+                [row[2] for row in rows_with_text],
+                watermark=rows[-1][0]
+            )
+        logger.debug("向量索引新增 %d 条消息，已索引到消息 %d", len(rows_with_text), rows[-1][0])
+        return len(rows)
+
+    def find_similar_messages(self, text, chat_id=None, limit=20, before=None):
+        """语义检索：返回与 text 相近的消息，按相似度从高到低排序
+
+        chat_id 为空时在所有群组中检索；before 为时间戳，只返回早于它的消息。
+        返回 (id, chat_id, username, message_text, timestamp) 列表，未启用向量索引时返回空列表。
+        """
+        if self.embeddings is None:
+            return []
+        # 已删除或被 before 过滤的消息会被丢弃，多取一些候选
+        hits = self.embeddings.search(text, limit=limit * 3, chat_id=normalize_chat_id(chat_id) if chat_id else None)
+        if not hits:
+            return []
+        scores = dict(hits)
+        params = list(scores)
+        before_clause = ''
+        if before is not None:
+            before_clause = 'AND timestamp < ?'
+            params.append(str(before))
+        with self._get_connection() as conn:
+            rows = conn.execute(f'''
+                SELECT id, chat_id, username, message_text, timestamp
+                FROM messages
+                WHERE id IN ({','.join('?' * len(scores))}) {before_clause}
+            ''', params).fetchall()
+        rows.sort(key=lambda row: scores[row[0]], reverse=True)
+        return rows[:limit]
+
     def get_last_message(self, chat_id):
-        print(f"\n=== 获取最后一条消息 ===")
-        print(f"群组ID: {chat_id}")
-        with sqlite3.connect(self.db_name) as conn:
+        with self._get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 SELECT username, message_text, timestamp
                 FROM messages
-                WHERE ABS(chat_id) = ABS(?)
+                WHERE chat_id = ?
                 ORDER BY timestamp DESC
                 LIMIT 1
-            ''', (chat_id,))
+            ''', (normalize_chat_id(chat_id),))
             message = cursor.fetchone()
-            if message:
-                print(f"找到最后一条消息：[{message[2]}] {message[0]}: {message[1][:50]}...")
-            else:
-                print("未找到任何消息")
+            logger.debug("获取群组 %s 最后一条消息：%s", chat_id, "已找到" if message else "无")
             return message
 
     def get_unique_chats(self):
-        print(f"\n=== 获取唯一群组列表 ===")
-        with sqlite3.connect(self.db_name) as conn:
+        with self._get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 SELECT DISTINCT chat_id
@@ -151,68 +639,138 @@ class DatabaseHandler:
                 ORDER BY chat_id
             ''')
             chats = [row[0] for row in cursor.fetchall()]
-            print(f"找到 {len(chats)} 个唯一群组")
+            logger.debug("找到 %d 个唯一群组", len(chats))
             return chats
 
     def store_messages_batch(self, messages):
-        """批量存储消息，支持去重"""
-        print(f"\n=== 批量存储消息 ===")
-        print(f"消息数量: {len(messages)}")
-        
+        """批量存储消息，按 (chat_id, message_id) 去重，与导入顺序和批次划分无关"""
         if not messages:
             return 0
-            
-        # 获取群组ID和最新消息时间
-        chat_id = messages[0]['chat_id']
-        latest_time = self.get_latest_message_time(chat_id)
-        
-        # 如果数据库中没有该群组的消息，直接存储所有消息
-        if not latest_time:
-            with sqlite3.connect(self.db_name) as conn:
-                cursor = conn.cursor()
-                cursor.executemany('''
-                    INSERT INTO messages (chat_id, user_id, username, message_text, timestamp)
-                    VALUES (:chat_id, :user_id, :username, :message_text, :timestamp)
-                ''', messages)
-                conn.commit()
-                stored_count = cursor.rowcount
-                print(f"新增 {stored_count} 条消息")
-                return stored_count
-        
-        # 如果数据库中已有消息，只存储新消息
-        new_messages = []
-        for msg in messages:
-            if msg['timestamp'] > latest_time:
-                new_messages.append(msg)
-        
-        if new_messages:
-            with sqlite3.connect(self.db_name) as conn:
-                cursor = conn.cursor()
-                cursor.executemany('''
-                    INSERT INTO messages (chat_id, user_id, username, message_text, timestamp)
-                    VALUES (:chat_id, :user_id, :username, :message_text, :timestamp)
-                ''', new_messages)
+
+        rows = self._message_rows(messages)
+        chat_ids = sorted({row['chat_id'] for row in rows})
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            # 只有群组中存在旧消息时才逐条检查内容，沿唯一索引查找 message_id 为 NULL 的行
+            has_legacy = cursor.execute(f'''
+                SELECT 1 FROM messages
+                WHERE chat_id IN ({','.join('?' * len(chat_ids))}) AND message_id IS NULL
+                LIMIT 1
+            ''', chat_ids).fetchone() is not None
+            sql = self._INSERT_MESSAGE_DEDUP_LEGACY_SQL if has_legacy else self._INSERT_MESSAGE_SQL
+            cursor.executemany(sql, rows)
+            conn.commit()
+            stored_count = cursor.rowcount
+            logger.info("批量存储 %d 条消息：新增 %d 条，跳过 %d 条重复消息",
+                        len(messages), stored_count, len(messages) - stored_count)
+            return stored_count
+
+    def store_live_messages(self, messages, chat_titles=None):
+        """在一个事务中写入一批实时消息，并更新有变化的群组名称"""
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.executemany(self._INSERT_MESSAGE_SQL, self._message_rows(messages))
+            stored_count = cursor.rowcount
+            # 群组名称未变化时不再重复插入 chat_info
+            for chat_id, chat_title in (chat_titles or {}).items():
+                chat_id = normalize_chat_id(chat_id)
+                cursor.execute('''
+                    INSERT INTO chat_info (chat_id, chat_title)
+                    SELECT ?, ?
+                    WHERE COALESCE((
+                        SELECT chat_title
+                        FROM chat_info
+                        WHERE chat_id = ?
+                        ORDER BY last_updated DESC, id DESC
+                        LIMIT 1
+                    ), '') != ?
+                ''', (chat_id, chat_title, chat_id, chat_title))
+            conn.commit()
+            logger.debug("批量写入实时消息 %d 条，新增 %d 条", len(messages), stored_count)
+            return stored_count
+
+    def merge_database(self, source_path):
+        """合并另一个机器人数据库中的消息、群组信息和分析记录
+
+        源数据库只读取、不修改，旧版本结构（没有 message_id、群组ID未规范化）也可以合并。
+        返回 (源消息数, 新增消息数)。
+        """
+        logger.info("合并数据库：%s", source_path)
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("ATTACH DATABASE ? AS source", (source_path,))
+            try:
+                columns = {row[1] for row in cursor.execute("PRAGMA source.table_info(messages)")}
+                message_id = "message_id" if "message_id" in columns else "NULL"
+                total_messages = cursor.execute("SELECT COUNT(*) FROM source.messages").fetchone()[0]
+                before = conn.total_changes
+
+                # 有 message_id 的消息依靠唯一索引去重
+                cursor.execute(f'''
+                    INSERT OR IGNORE INTO messages (chat_id, message_id, user_id, username, message_text, timestamp, created_at)
+                    SELECT -ABS(chat_id), {message_id}, user_id, username, message_text, timestamp, created_at
+                    FROM source.messages
+                    WHERE {message_id} IS NOT NULL
+                ''')
+                # 没有 message_id 的旧消息按群组、时间和内容去重
+                cursor.execute(f'''
+                    INSERT INTO messages (chat_id, user_id, username, message_text, timestamp, created_at)
+                    SELECT -ABS(s.chat_id), s.user_id, s.username, s.message_text, s.timestamp, s.created_at
+                    FROM source.messages s
+                    WHERE {message_id} IS NULL
+                      AND NOT EXISTS (
+                          SELECT 1 FROM messages m
+                          WHERE m.chat_id = -ABS(s.chat_id)
+                            AND m.timestamp = s.timestamp
+                            AND m.message_text = s.message_text
+                      )
+                ''')
+                new_messages = conn.total_changes - before
+
+                cursor.execute('''
+                    INSERT INTO chat_info (chat_id, chat_title, last_updated)
+                    SELECT -ABS(s.chat_id), s.chat_title, s.last_updated
+                    FROM source.chat_info s
+                    WHERE NOT EXISTS (
+                        SELECT 1 FROM chat_info c
+                        WHERE c.chat_id = -ABS(s.chat_id) AND c.chat_title = s.chat_title
+                    )
+                ''')
+                cursor.execute('''
+                    INSERT INTO analysis (chat_id, analysis_type, content, created_at)
+                    SELECT -ABS(s.chat_id), s.analysis_type, s.content, s.created_at
+                    FROM source.analysis s
+                    WHERE NOT EXISTS (
+                        SELECT 1 FROM analysis a
+                        WHERE a.chat_id = -ABS(s.chat_id)
+                          AND a.analysis_type = s.analysis_type
+                          AND a.created_at = s.created_at
+                    )
+                ''')
                 conn.commit()
-                stored_count = cursor.rowcount
-                print(f"新增 {stored_count} 条消息")
-                return stored_count
-        else:
-            print("没有新消息需要存储")
-            return 0
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                # 事务结束后才能分离数据库
+                cursor.execute("DETACH DATABASE source")
+        logger.info("源数据库消息数：%d，新增 %d 条", total_messages, new_messages)
+        return total_messages, new_messages
 
     def get_all_groups(self):
         """获取所有群组信息"""
-        print(f"\n=== 获取所有群组 ===")
-        with sqlite3.connect(self.db_name) as conn:
+        with self._get_connection() as conn:
             cursor = conn.cursor()
+            # 递归查询沿索引逐个跳到下一个群组ID，避免扫描全部消息
             cursor.execute('''
-                WITH group_messages AS (
-                    SELECT DISTINCT ABS(chat_id) as abs_id,
-                           FIRST_VALUE(chat_id) OVER (PARTITION BY ABS(chat_id) ORDER BY chat_id DESC) as chat_id
-                    FROM messages
-                    WHERE chat_id != 0  -- 排除无效的群组ID
+                WITH RECURSIVE group_messages(chat_id) AS (
+                    SELECT MIN(chat_id) FROM messages
+                    UNION ALL
+                    SELECT (SELECT MIN(chat_id) FROM messages WHERE chat_id > g.chat_id)
+                    FROM group_messages g
+                    WHERE g.chat_id IS NOT NULL
                 )
-                SELECT DISTINCT g.chat_id,
+                SELECT g.chat_id,
                        COALESCE(
                            (SELECT chat_title 
                             FROM chat_info 
@@ -222,28 +780,22 @@ class DatabaseHandler:
                            'Group ' || g.chat_id
                        ) as chat_title
                 FROM group_messages g
-                WHERE EXISTS (
-                    SELECT 1 
-                    FROM messages m 
-                    WHERE m.chat_id = g.chat_id
-                )
+                WHERE g.chat_id IS NOT NULL AND g.chat_id != 0  -- 排除无效的群组ID
                 ORDER BY ABS(g.chat_id)
             ''')
             groups = cursor.fetchall()
-            print(f"找到 {len(groups)} 个群组")
+            logger.debug("找到 %d 个群组", len(groups))
             return groups
 
     def get_group_info(self, chat_id):
         """获取特定群组的信息"""
-        print(f"\n=== 获取群组信息 ===")
-        print(f"群组ID: {chat_id}")
-        with sqlite3.connect(self.db_name) as conn:
+        with self._get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 WITH group_messages AS (
-                    SELECT DISTINCT chat_id
+                    SELECT chat_id
                     FROM messages
-                    WHERE ABS(chat_id) = ABS(?) AND chat_id != 0
+                    WHERE chat_id = ? AND chat_id != 0
                     LIMIT 1
                 )
                 SELECT m.chat_id,
@@ -256,20 +808,14 @@ class DatabaseHandler:
                            'Group ' || m.chat_id
                        ) as chat_title
                 FROM group_messages m
-            ''', (chat_id,))
+            ''', (normalize_chat_id(chat_id),))
             group = cursor.fetchone()
-            if group:
-                print(f"找到群组：{group[1]}")
-            else:
-                print("未找到群组信息")
+            logger.debug("获取群组 %s 信息：%s", chat_id, group[1] if group else "未找到")
             return group
 
     def update_chat_info(self, chat_id, chat_title):
         """更新群组信息"""
-        print(f"\n=== 更新群组信息 ===")
-        print(f"群组ID: {chat_id}")
-        print(f"群组名称: {chat_title}")
-        with sqlite3.connect(self.db_name) as conn:
+        with self._get_connection() as conn:
             cursor = conn.cursor()
             # 确保chat_info表存在
             cursor.execute('''
@@ -284,50 +830,39 @@ class DatabaseHandler:
             cursor.execute('''
                 INSERT INTO chat_info (chat_id, chat_title)
                 VALUES (?, ?)
-            ''', (chat_id, chat_title))
+            ''', (normalize_chat_id(chat_id), chat_title))
             conn.commit()
-            print("群组信息已更新") 
+            logger.info("群组信息已更新：%s -> %s", chat_id, chat_title)
 
     def check_chat_exists(self, chat_id):
         """检查群组是否存在"""
-        print(f"\n=== 检查群组是否存在 ===")
-        print(f"群组ID: {chat_id}")
-        with sqlite3.connect(self.db_name) as conn:
+        with self._get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 SELECT COUNT(*) 
                 FROM messages 
-                WHERE chat_id = ? OR chat_id = ?  -- 同时匹配正负群组ID
-            ''', (chat_id, -abs(chat_id)))  # 同时查询正负ID
+                WHERE chat_id = ?
+            ''', (normalize_chat_id(chat_id),))
             count = cursor.fetchone()[0]
             exists = count > 0
-            print(f"群组存在: {exists}, 现有消息数: {count}")
+            logger.debug("群组 %s 存在：%s，现有消息数：%d", chat_id, exists, count)
             return exists, count
 
-    def store_analysis(self, chat_id, analysis_type, content):
-        """存储分析结果"""
-        print(f"\n=== 存储分析结果 ===")
-        print(f"群组ID: {chat_id}")
-        print(f"分析类型: {analysis_type}")
-        print(f"分析内容: {content[:100]}...")
-        
-        with sqlite3.connect(self.db_name) as conn:
+    def store_analysis(self, chat_id, analysis_type, content, message_watermark=None):
+        """存储分析结果，message_watermark 为分析覆盖到的最后一条消息ID"""
+        with self._get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
-                INSERT INTO analysis (chat_id, analysis_type, content)
-                VALUES (?, ?, ?)
-            ''', (chat_id, analysis_type, content))
+                INSERT INTO analysis (chat_id, analysis_type, content, message_watermark)
+                VALUES (?, ?, ?, ?)
+            ''', (normalize_chat_id(chat_id), analysis_type, content, message_watermark))
             conn.commit()
-            print(f"分析结果已存储，ID: {cursor.lastrowid}")
+            logger.info("分析结果已存储：群组ID=%s，类型=%s，ID=%s", chat_id, analysis_type, cursor.lastrowid)
             return cursor.lastrowid
 
     def get_latest_analysis(self, chat_id, analysis_type):
         """获取最新的分析结果"""
-        print(f"\n=== 获取最新分析结果 ===")
-        print(f"群组ID: {chat_id}")
-        print(f"分析类型: {analysis_type}")
-        
-        with sqlite3.connect(self.db_name) as conn:
+        with self._get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 SELECT content, created_at
@@ -335,35 +870,34 @@ class DatabaseHandler:
                 WHERE chat_id = ? AND analysis_type = ?
                 ORDER BY created_at DESC
                 LIMIT 1
-            ''', (chat_id, analysis_type))
+            ''', (normalize_chat_id(chat_id), analysis_type))
             result = cursor.fetchone()
-            if result:
-                print(f"找到分析结果，创建时间: {result[1]}")
-                return result[0]
-            else:
-                print("未找到分析结果")
-                return None
+            logger.debug("获取群组 %s 的 %s 分析：%s", chat_id, analysis_type,
+                         result[1] if result else "未找到")
+            return result[0] if result else None
 
     def get_latest_message_time(self, chat_id):
         """获取群组最新消息时间"""
-        print(f"\n=== 获取群组最新消息时间 ===")
-        print(f"群组ID: {chat_id}")
-        with sqlite3.connect(self.db_name) as conn:
+        with self._get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
-                SELECT MAX(timestamp)
+                SELECT timestamp
                 FROM messages
-                WHERE ABS(chat_id) = ABS(?)
-            ''', (chat_id,))
-            latest_time = cursor.fetchone()[0]
-            print(f"最新消息时间: {latest_time}")
+                WHERE chat_id = ?
+                ORDER BY timestamp DESC
+                LIMIT 1
+            ''', (normalize_chat_id(chat_id),))
+            row = cursor.fetchone()
+            latest_time = row[0] if row else None
+            logger.debug("群组 %s 最新消息时间：%s", chat_id, latest_time)
             return latest_time
 
     def get_system_prompt(self, prompt_type):
         """获取指定类型的system prompt"""
-        print(f"\n=== 获取System Prompt ===")
-        print(f"类型: {prompt_type}")
-        with sqlite3.connect(self.db_name) as conn:
+        cached = self.prompt_cache.get(prompt_type)
+        if cached is not WriteThroughCache.MISSING:
+            return cached
+        with self._get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 SELECT prompt_text
@@ -371,130 +905,200 @@ class DatabaseHandler:
                 WHERE prompt_type = ?
             ''', (prompt_type,))
             result = cursor.fetchone()
-            if result:
-                print(f"找到prompt: {result[0][:50]}...")
-                return result[0]
-            else:
-                print("未找到prompt")
-                return None
+            logger.debug("获取 %s prompt：%s", prompt_type, "已找到" if result else "未找到")
+            return self.prompt_cache.fill(prompt_type, result[0] if result else None)
 
     def update_system_prompt(self, prompt_type, prompt_text):
         """更新指定类型的system prompt"""
-        print(f"\n=== 更新System Prompt ===")
-        print(f"类型: {prompt_type}")
-        print(f"内容: {prompt_text[:50]}...")
-        with sqlite3.connect(self.db_name) as conn:
+        with self._get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 INSERT OR REPLACE INTO system_prompts (prompt_type, prompt_text, updated_at)
                 VALUES (?, ?, CURRENT_TIMESTAMP)
             ''', (prompt_type, prompt_text))
             conn.commit()
-            print("System Prompt已更新")
+        self.prompt_cache.set(prompt_type, prompt_text)
+        logger.info("System Prompt 已更新：%s", prompt_type)
+
+    def get_cached_response(self, cache_key, max_age):
+        """获取未过期的缓存响应，max_age 为有效期（秒）"""
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT response
+                FROM response_cache
+                WHERE cache_key = ? AND created_at >= datetime('now', ?)
+            ''', (cache_key, f'-{int(max_age)} seconds'))
+            result = cursor.fetchone()
+            return result[0] if result else None
+
+    def store_cached_response(self, cache_key, model_name, response, max_age):
+        """写入缓存响应，同时清理已过期的条目"""
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT OR REPLACE INTO response_cache (cache_key, model_name, response, created_at)
+                VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+            ''', (cache_key, model_name, response))
+            cursor.execute('''
+                DELETE FROM response_cache
+                WHERE created_at < datetime('now', ?)
+            ''', (f'-{int(max_age)} seconds',))
+            conn.commit()
 
     def delete_chat_history(self, chat_id):
         """删除指定群组的所有记录"""
-        print(f"\n=== 删除群组记录 ===")
-        print(f"群组ID: {chat_id}")
-        with sqlite3.connect(self.db_name) as conn:
+        chat_id = normalize_chat_id(chat_id)
+        with self._get_connection() as conn:
             cursor = conn.cursor()
             # 删除消息记录
             cursor.execute('''
                 DELETE FROM messages 
-                WHERE ABS(chat_id) = ABS(?)
+                WHERE chat_id = ?
             ''', (chat_id,))
             deleted_messages = cursor.rowcount
             
             # 删除群组信息
             cursor.execute('''
                 DELETE FROM chat_info 
-                WHERE ABS(chat_id) = ABS(?)
+                WHERE chat_id = ?
             ''', (chat_id,))
             deleted_info = cursor.rowcount
             
             # 删除分析记录
             cursor.execute('''
                 DELETE FROM analysis 
-                WHERE ABS(chat_id) = ABS(?)
+                WHERE chat_id = ?
             ''', (chat_id,))
             deleted_analysis = cursor.rowcount
+
+            # 删除分层摘要
+            cursor.execute('''
+                DELETE FROM summaries
+                WHERE chat_id = ?
+            ''', (chat_id,))
+            deleted_analysis += cursor.rowcount
             
             conn.commit()
-            print(f"已删除 {deleted_messages} 条消息记录")
-            print(f"已删除 {deleted_info} 条群组信息")
-            print(f"已删除 {deleted_analysis} 条分析记录")
+            logger.info("已删除群组 %s 的 %d 条消息记录、%d 条群组信息、%d 条分析记录",
+                        chat_id, deleted_messages, deleted_info, deleted_analysis)
             return deleted_messages + deleted_info + deleted_analysis > 0
 
-    def check_and_analyze_group(self, chat_id):
+    def check_and_analyze_group(self, chat_id, threshold=20):
         """检查群组是否需要进行分析"""
-        print(f"\n=== 检查群组是否需要分析 ===")
-        print(f"群组ID: {chat_id}")
-        with sqlite3.connect(self.db_name) as conn:
+        chat_id = normalize_chat_id(chat_id)
+        _, watermark = self.get_background_state(chat_id)
+        with self._get_connection() as conn:
             cursor = conn.cursor()
-            # 检查消息数量
+            # 只统计水位线之后的消息，数到阈值即停止
             cursor.execute('''
-                SELECT COUNT(*) 
-                FROM messages 
-                WHERE ABS(chat_id) = ABS(?)
-            ''', (chat_id,))
-            message_count = cursor.fetchone()[0]
+                SELECT COUNT(*)
+                FROM (
+                    SELECT 1
+                    FROM messages
+                    WHERE chat_id = ? AND id > ?
+                    LIMIT ?
+                )
+            ''', (chat_id, watermark or 0, threshold))
+            new_messages = cursor.fetchone()[0]
+
+            if new_messages >= threshold:
+                if watermark is None:
+                    logger.info("群组 %s 有 %d 条以上消息，需要进行首次分析", chat_id, new_messages)
+                else:
+                    logger.info("群组 %s 在上次分析后有 %d 条以上新消息，需要更新分析", chat_id, new_messages)
+                return True
             
-            # 检查是否已有分析结果
+            logger.debug("群组 %s 暂不需要分析", chat_id)
+            return False
+
+    def get_background_state(self, chat_id):
+        """获取最新的背景分析及其水位线，没有时返回 (None, None)"""
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
             cursor.execute('''
-                SELECT created_at
+                SELECT content, message_watermark
                 FROM analysis
-                WHERE ABS(chat_id) = ABS(?) AND analysis_type = 'background'
-                ORDER BY created_at DESC
+                WHERE chat_id = ? AND analysis_type = 'background'
+                ORDER BY created_at DESC, id DESC
                 LIMIT 1
-            ''', (chat_id,))
-            last_analysis = cursor.fetchone()
-            
-            # 如果消息数量大于20且没有分析记录，或者最后一次分析后又有新消息
-            if message_count >= 20:
-                if not last_analysis:
-                    print(f"群组有 {message_count} 条消息，需要进行首次分析")
-                    return True
-                else:
-                    # 检查最后一次分析后是否有新消息
-                    cursor.execute('''
-                        SELECT COUNT(*)
-                        FROM messages
-                        WHERE ABS(chat_id) = ABS(?) AND created_at > ?
-                    ''', (chat_id, last_analysis[0]))
-                    new_messages = cursor.fetchone()[0]
-                    if new_messages >= 20:
-                        print(f"群组在上次分析后有 {new_messages} 条新消息，需要重新分析")
-                        return True
-            
-            print("群组暂不需要分析")
-            return False
+            ''', (normalize_chat_id(chat_id),))
+            result = cursor.fetchone()
+            logger.debug("群组 %s 背景分析水位线：%s", chat_id, result[1] if result else "无")
+            if result:
+                return result[0], result[1]
+            return None, None
+
+    def get_messages_since(self, chat_id, after_id, limit=200):
+        """获取某条消息之后收到的新消息，按时间正序返回 (消息列表, 对应的消息ID列表)
+
+        导入的历史消息ID较大但时间较早，时间早于 after_id 那条消息的不算新消息；
+        超过 limit 条时只返回最新的 limit 条。沿 (chat_id, timestamp) 索引从该时间开始扫描，
+        不会读取导入的旧消息。
+        """
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT id, username, message_text, timestamp
+                FROM messages
+                WHERE chat_id = ? AND id > ?
+                  AND timestamp >= COALESCE((SELECT timestamp FROM messages WHERE id = ?), '')
+                ORDER BY timestamp DESC, id DESC
+                LIMIT ?
+            ''', (normalize_chat_id(chat_id), after_id or 0, after_id or 0, limit))
+            rows = cursor.fetchall()
+            rows.reverse()
+            logger.debug("获取群组 %s 消息ID %s 之后的消息 %d 条", chat_id, after_id, len(rows))
+            return [row[1:] for row in rows], [row[0] for row in rows]
+
+    def advance_background_watermark(self, chat_id, message_watermark):
+        """只推进最新背景分析的水位线，不改变内容（新消息都是导入的旧历史时使用）"""
+        with self._get_connection() as conn:
+            conn.execute('''
+                UPDATE analysis
+                SET message_watermark = ?
+                WHERE id = (
+                    SELECT id
+                    FROM analysis
+                    WHERE chat_id = ? AND analysis_type = 'background'
+                    ORDER BY created_at DESC, id DESC
+                    LIMIT 1
+                )
+            ''', (message_watermark, normalize_chat_id(chat_id)))
+            conn.commit()
+
+    def get_latest_message_id(self, chat_id):
+        """获取群组最后一条消息的ID"""
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT MAX(id)
+                FROM messages
+                WHERE chat_id = ?
+            ''', (normalize_chat_id(chat_id),))
+            return cursor.fetchone()[0]
 
     def get_background_analysis(self, chat_id):
         """获取群组的背景分析"""
-        print(f"\n=== 获取群组背景分析 ===")
-        print(f"群组ID: {chat_id}")
-        with sqlite3.connect(self.db_name) as conn:
+        with self._get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 SELECT content
                 FROM analysis
-                WHERE ABS(chat_id) = ABS(?) AND analysis_type = 'background'
+                WHERE chat_id = ? AND analysis_type = 'background'
                 ORDER BY created_at DESC
                 LIMIT 1
-            ''', (chat_id,))
+            ''', (normalize_chat_id(chat_id),))
             result = cursor.fetchone()
-            if result:
-                print("找到群组背景分析")
-                return result[0]
-            else:
-                print("未找到群组背景分析")
-                return None
+            logger.debug("获取群组 %s 背景分析：%s", chat_id, "已找到" if result else "未找到")
+            return result[0] if result else None
 
     def get_user_language(self, user_id: int) -> str:
         """获取用户的语言偏好"""
-        print(f"\n=== 获取用户语言偏好 ===")
-        print(f"用户ID: {user_id}")
-        with sqlite3.connect(self.db_name) as conn:
+        cached = self.language_cache.get(user_id)
+        if cached is not WriteThroughCache.MISSING:
+            return cached
+        with self._get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 SELECT language
@@ -503,20 +1107,92 @@ class DatabaseHandler:
             ''', (user_id,))
             result = cursor.fetchone()
             language = result[0] if result else 'zh'
-            print(f"用户语言: {language}")
-            return language
+            logger.debug("用户 %s 语言：%s", user_id, language)
+            return self.language_cache.fill(user_id, language)
 
     def set_user_language(self, user_id: int, language: str) -> None:
         """设置用户的语言偏好"""
-        print(f"\n=== 设置用户语言偏好 ===")
-        print(f"用户ID: {user_id}")
-        print(f"语言: {language}")
-        with sqlite3.connect(self.db_name) as conn:
+        with self._get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 INSERT OR REPLACE INTO user_preferences (user_id, language, updated_at)
                 VALUES (?, ?, CURRENT_TIMESTAMP)
             ''', (user_id, language))
             conn.commit()
-            print("用户语言偏好已更新")
- 
\ No newline at end of file
+        self.language_cache.set(user_id, language)
+        logger.info("用户 %s 语言偏好已更新：%s", user_id, language)
+
+
+class AsyncDatabaseHandler:
+    """DatabaseHandler 的异步门面
+
+    写操作交给单个写线程串行执行，读操作在读线程池中并发执行，
+    事件循环线程只负责 await 结果，不会被磁盘 I/O 阻塞。
+    """
+    WRITE_METHODS = {
+        'init_db',
+        'store_message',
+        'store_messages_batch',
+        'store_live_messages',
+        'update_chat_info',
+        'store_analysis',
+        'store_summary',
+        'advance_background_watermark',
+        'update_system_prompt',
+        'delete_chat_history',
+        'set_user_language',
+        'store_cached_response',
+        'merge_database',
+    }
+    # 有进程内缓存的读操作（方法名 -> DatabaseHandler 上的缓存属性，第一个参数为缓存键），
+    # 命中时直接在事件循环中返回，不进入线程池
+    CACHED_READS = {
+        'get_user_language': 'language_cache',
+        'get_system_prompt': 'prompt_cache',
+    }
+
+    def __init__(self, db, max_readers=4):
+        self.db = db
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+        self._readers = ThreadPoolExecutor(max_workers=max_readers, thread_name_prefix='db-reader')
+
+    def __getattr__(self, name):
+        attr = getattr(self.db, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+        is_write = name in self.WRITE_METHODS
+        executor = self._writer if is_write else self._readers
+        pool = 'writer' if is_write else 'reader'
+
+        def run(submitted, args, kwargs):
+            # 分别记录在线程池中的排队时间和实际执行时间
+            start = time.perf_counter()
+            DB_QUEUE_SECONDS.observe(start - submitted, pool=pool)
+            try:
+                return attr(*args, **kwargs)
+            except Exception:
+                DB_ERRORS.inc(method=name)
+                raise
+            finally:
+                DB_QUERY_SECONDS.observe(time.perf_counter() - start, method=name)
+
+        cache = getattr(self.db, self.CACHED_READS[name]) if name in self.CACHED_READS else None
+
+        @functools.wraps(attr)
+        async def call(*args, **kwargs):
+            if cache is not None and args:
+                cached = cache.get(args[0])
+                if cached is not WriteThroughCache.MISSING:
+                    return cached
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(executor, run, time.perf_counter(), args, kwargs)
+
+        # 缓存包装函数，后续调用不再经过 __getattr__
+        setattr(self, name, call)
+        return call
+
+    def close(self):
+        """等待排队中的操作完成后关闭线程池和数据库连接"""
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+        self.db.close()
@@ -0,0 +1,196 @@
+import json
+import logging
+import math
+import os
+import re
+import threading
+import zlib
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# 英文单词/数字，以及连续的汉字
+_TOKENS = re.compile(r'[A-Za-z0-9]+|[\u4e00-\u9fff]+')
+
+
+class EmbeddingIndex:
+    """消息的本地向量索引，用于跨群组的语义检索（可选功能，需要 numpy）
+
+    - 向量：把字符 n-gram 特征哈希到 dim 维（中文取二字、三字片段，英文取单词和词内三字母片段），
+      按 log(1 + 次数) 加权、带符号累加后归一化，以 float16 保存。不需要模型，只用 CPU
+    - 存储：向量、消息ID、群组ID 和 SimHash 签名分别保存为定长数组文件，通过 numpy.memmap
+      按需映射，只追加不改写，容量不足时按倍数扩展；meta.json 记录条数和已索引的最大消息ID
+    - 检索：先按 64 位 SimHash 签名的汉明距离选出候选，再对候选计算余弦相似度重排
+    """
+    DIM = 256
+    INITIAL_CAPACITY = 65536
+    # 每次查询参与精确重排的候选数
+    CANDIDATES = 2000
+
+    _FILES = {
+        'vectors': np.float16,
+        'ids': np.int64,
+        'chats': np.int64,
+        'signatures': np.uint64,
+    }
+
+    def __init__(self, directory, dim=DIM, seed=0):
+        self.directory = directory
+        self.dim = dim
+        os.makedirs(directory, exist_ok=True)
+        # SimHash 的随机超平面，由 seed 决定，同一目录的索引必须使用相同的参数
+        self._planes = np.random.default_rng(seed).standard_normal((dim, 64)).astype(np.float32)
+        self._lock = threading.Lock()
+
+        meta = self._load_meta()
+        if meta and (meta['dim'] != dim or meta['seed'] != seed):
+            logger.warning("向量索引参数已变化（dim=%s, seed=%s），重新建立索引", meta['dim'], meta['seed'])
+            meta = None
+        self.count = meta['count'] if meta else 0
+        self.watermark = meta['watermark'] if meta else 0
+        self.seed = seed
+        self._open(max(meta['capacity'] if meta else 0, self.INITIAL_CAPACITY), reset=meta is None)
+        logger.info("向量索引已加载：%s，%d 条，已索引到消息 %d", directory, self.count, self.watermark)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _load_meta(self):
+        try:
+            with open(self._path('meta.json'), encoding='utf-8') as meta_file:
+                return json.load(meta_file)
+        except FileNotFoundError:
+            return None
+
+    def _save_meta(self):
+        # 先写临时文件再替换，中途退出时不会留下不完整的 meta.json
+        temp_path = self._path('meta.json.tmp')
+        with open(temp_path, 'w', encoding='utf-8') as meta_file:
+            json.dump({
+                'dim': self.dim,
+                'seed': self.seed,
+                'count': self.count,
+                'watermark': self.watermark,
+                'capacity': self.capacity,
+            }, meta_file)
+        os.replace(temp_path, self._path('meta.json'))
+
+    def _open(self, capacity, reset=False):
+        """按 capacity 行映射各数组文件，文件不够大时扩展"""
+        self.capacity = capacity
+        arrays = {}
+        for name, dtype in self._FILES.items():
+            path = self._path(f'{name}.bin')
+            width = self.dim if name == 'vectors' else 1
+            size = capacity * width * np.dtype(dtype).itemsize
+            mode = 'w+' if reset or not os.path.exists(path) else 'r+'
+            if mode == 'r+' and os.path.getsize(path) < size:
+                with open(path, 'r+b') as data_file:
+                    data_file.truncate(size)
+            shape = (capacity, width) if name == 'vectors' else (capacity,)
+            arrays[name] = np.memmap(path, dtype=dtype, mode=mode, shape=shape)
+        # 整体替换引用，正在进行的查询继续使用旧的映射
+        self._arrays = arrays
+
+    @property
+    def nbytes(self):
+        """索引文件占用的磁盘空间（字节）"""
+        return sum(os.path.getsize(self._path(f'{name}.bin')) for name in self._FILES)
+
+    def _features(self, text):
+        features = {}
+        for token in _TOKENS.findall(text.lower()):
+            if token.isascii():
+                grams = [token]
+                if len(token) > 4:
+                    grams.extend(token[i:i + 3] for i in range(len(token) - 2))
+            elif len(token) == 1:
+                grams = [token]
+            else:
+                grams = [token[i:i + 2] for i in range(len(token) - 1)]
+                grams.extend(token[i:i + 3] for i in range(len(token) - 2))
+            for gram in grams:
+                key = zlib.crc32(gram.encode('utf-8'))
+                features[key] = features.get(key, 0) + 1
+        return features
+
+    def embed(self, texts):
+        """计算一批文本的单位向量，返回 (len(texts), dim) 的 float32 数组；没有特征的文本为零向量"""
+        rows, columns, values = [], [], []
+        for row, text in enumerate(texts):
+            for key, count in self._features(text or '').items():
+                rows.append(row)
+                columns.append(key % self.dim)
+                # 用哈希的最高位决定符号，减少不同特征落到同一维时的相互抵消
+                values.append(math.log1p(count) if key & 0x80000000 else -math.log1p(count))
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        np.add.at(vectors, (np.asarray(rows, dtype=np.intp), np.asarray(columns, dtype=np.intp)), values)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        np.divide(vectors, norms, out=vectors, where=norms > 0)
+        return vectors
+
+    def _signatures(self, vectors):
+        bits = (vectors @ self._planes) > 0
+        return np.packbits(bits, axis=1).view('>u8').astype(np.uint64).ravel()
+
+    def append(self, message_ids, chat_ids, texts, watermark=None):
+        """追加一批消息，watermark 为本批覆盖到的最大消息ID（默认取 message_ids 的最大值）"""
+        with self._lock:
+            if message_ids:
+                vectors = self.embed(texts)
+                start, end = self.count, self.count + len(message_ids)
+                if end > self.capacity:
+                    capacity = self.capacity
+                    while capacity < end:
+                        capacity *= 2
+                    self._open(capacity)
+                arrays = self._arrays
+                arrays['vectors'][start:end] = vectors
+                arrays['ids'][start:end] = message_ids
+                arrays['chats'][start:end] = chat_ids
+                arrays['signatures'][start:end] = self._signatures(vectors)
+                for array in arrays.values():
+                    array.flush()
+                self.count = end
+            self.watermark = max(self.watermark, watermark or max(message_ids, default=0))
+            # 数据写入后才更新 meta.json，崩溃时最多重新索引最后一批
+            self._save_meta()
+
+    @staticmethod
+    def _popcount(values):
+        if hasattr(np, 'bitwise_count'):
+            return np.bitwise_count(values)
+        return np.unpackbits(values.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+    def search(self, text, limit=20, chat_id=None, candidates=CANDIDATES):
+        """返回与 text 最相似的 [(消息ID, 相似度)]，按相似度从高到低排序
+
+        chat_id 不为空时只在该群组中检索；candidates 为 None 时对所有向量精确计算（用于评估召回率）。
+        """
+        with self._lock:
+            count = self.count
+            arrays = self._arrays
+        query = self.embed([text])[0]
+        if count == 0 or not query.any():
+            return []
+
+        if chat_id is not None:
+            positions = np.flatnonzero(arrays['chats'][:count] == chat_id)
+            signatures = arrays['signatures'][positions]
+        else:
+            positions = np.arange(count)
+            signatures = arrays['signatures'][:count]
+        if candidates is not None and len(positions) > candidates:
+            signature = self._signatures(query[None, :])[0]
+            distances = self._popcount(signatures ^ signature)
+            positions = positions[np.argpartition(distances, candidates - 1)[:candidates]]
+            # 按位置顺序读取，memmap 上的访问更连续
+            positions.sort()
+
+        scores = arrays['vectors'][positions].astype(np.float32) @ query
+        top = np.argsort(-scores)[:limit]
+        return [
+            (int(arrays['ids'][positions[index]]), float(scores[index]))
+            for index in top if scores[index] > 0
+        ]
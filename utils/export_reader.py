@@ -0,0 +1,140 @@
+import json
+import re
+
+_WHITESPACE = re.compile(r'\s*')
+
+
+def parse_export_message(msg, chat_id):
+    """把导出文件中的一条消息转换为数据库记录，非文本消息返回 None"""
+    if msg.get('type') != 'message' or 'text' not in msg:
+        return None
+
+    # 处理文本内容
+    text = msg['text']
+    if isinstance(text, list):  # 处理富文本消息
+        text_parts = []
+        for part in text:
+            if isinstance(part, str):
+                text_parts.append(part)
+            elif isinstance(part, dict):
+                text_parts.append(part.get('text', ''))
+        text = ' '.join(text_parts)
+
+    return {
+        'chat_id': chat_id,
+        'message_id': msg.get('id'),
+        'user_id': msg.get('from_id', '').replace('user', '') if msg.get('from_id') else 0,
+        'username': msg.get('from', 'unknown'),
+        'message_text': text,
+        'timestamp': msg.get('date', '')
+    }
+
+
+class ExportReader:
+    """流式读取 Telegram Desktop 导出的 JSON 文件
+
+    每次只读入 chunk_size 个字符，逐条解析 messages 数组中的消息，
+    内存占用与文件大小无关。群组信息（id、name 等）需位于 messages 之前，
+    这也是 Telegram Desktop 导出文件的字段顺序。
+    """
+
+    def __init__(self, fileobj, chunk_size=1 << 20):
+        self.file = fileobj
+        self.chunk_size = chunk_size
+        self.header = {}
+        self._decoder = json.JSONDecoder()
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+        self._in_messages = False
+
+    def _fill(self):
+        """读入下一块数据，文件结束时返回 False"""
+        if self._eof:
+            return False
+        data = self.file.read(self.chunk_size)
+        if not data:
+            self._eof = True
+            return False
+        self._buffer = self._buffer[self._pos:] + data
+        self._pos = 0
+        return True
+
+    def _peek(self):
+        """跳过空白并返回下一个字符，文件结束时返回空字符串"""
+        while True:
+            self._pos = _WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer) or not self._fill():
+                break
+        return self._buffer[self._pos:self._pos + 1]
+
+    def _expect(self, char):
+        found = self._peek()
+        if found != char:
+            raise ValueError(f"JSON 格式错误：期望 {char!r}，实际为 {found!r}")
+        self._pos += 1
+
+    def _value(self):
+        """解析下一个完整的 JSON 值，数据不足时继续读入"""
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+                # 值恰好结束在缓冲区末尾时可能被截断（如数字），需确认后面还有内容
+                if end < len(self._buffer) or self._eof:
+                    self._pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+            self._fill()
+
+    def read_header(self):
+        """读取 messages 之前的顶层字段，读到 messages 数组开头时停止"""
+        self._expect('{')
+        while True:
+            if self._peek() == '}':
+                raise ValueError("JSON文件格式不正确，找不到消息记录")
+            key = self._value()
+            self._expect(':')
+            if key == 'messages':
+                self._expect('[')
+                self._in_messages = True
+                return self.header
+            self.header[key] = self._value()
+            if self._peek() == ',':
+                self._pos += 1
+
+    def iter_messages(self):
+        """逐条返回 messages 数组中的原始消息"""
+        if not self._in_messages:
+            self.read_header()
+        if self._peek() == ']':
+            self._pos += 1
+            return
+        while True:
+            yield self._value()
+            separator = self._peek()
+            self._pos += 1
+            if separator == ']':
+                return
+            if separator != ',':
+                raise ValueError(f"JSON 格式错误：消息之间期望 ',' 或 ']'，实际为 {separator!r}")
+
+    def iter_records(self, chat_id):
+        """逐条返回可直接写入数据库的消息记录"""
+        for msg in self.iter_messages():
+            record = parse_export_message(msg, chat_id)
+            if record is not None:
+                yield record
+
+    def iter_batches(self, chat_id, batch_size):
+        """按批返回消息记录"""
+        batch = []
+        for record in self.iter_records(chat_id):
+            batch.append(record)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
@@ -0,0 +1,184 @@
+import asyncio
+import collections
+import hashlib
+import math
+import random
+import time
+
+from utils.context_builder import estimate_tokens
+
+
+class BackendError(Exception):
+    """后端调用失败，status 为对应的 HTTP 状态码（未知时为 None）"""
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+    @property
+    def retryable(self):
+        """限流（429）和服务端错误（5xx）可以重试"""
+        return self.status == 429 or (self.status or 0) >= 500
+
+
+class RateLimitError(BackendError):
+    """请求被限流（HTTP 429）"""
+
+    def __init__(self, message):
+        super().__init__(message, status=429)
+
+
+class GenerationResult:
+    """一次非流式生成的结果，token 数未知时为 None"""
+
+    def __init__(self, text, prompt_tokens=None, response_tokens=None):
+        self.text = text
+        self.prompt_tokens = prompt_tokens
+        self.response_tokens = response_tokens
+
+
+class GeminiBackend:
+    """GeminiHandler 使用的后端接口
+
+    generate 返回 GenerationResult；stream 是异步生成器，逐块返回文本。
+    调用失败时抛出 BackendError，超时和并发控制由 GeminiHandler 负责。
+    """
+    name = ''
+
+    async def generate(self, model_name, prompt):
+        raise NotImplementedError
+
+    async def stream(self, model_name, prompt):
+        raise NotImplementedError
+        yield
+
+
+class GoogleGeminiBackend(GeminiBackend):
+    """通过 google-generativeai 调用 Gemini API"""
+    name = 'google'
+
+    def __init__(self, api_key):
+        # 只在使用真实 API 时导入，离线运行 fake 后端不需要安装这些依赖
+        import google.generativeai as genai
+        from google.api_core import exceptions as google_exceptions
+
+        genai.configure(api_key=api_key)
+        self._genai = genai
+        self._api_errors = google_exceptions.GoogleAPICallError
+        self._models = {}
+
+    def _model(self, model_name):
+        model = self._models.get(model_name)
+        if model is None:
+            model = self._models[model_name] = self._genai.GenerativeModel(model_name)
+        return model
+
+    def _translate(self, error):
+        """把 google-api-core 的异常转换为 BackendError"""
+        status = getattr(error, 'code', None)
+        if status == 429:
+            return RateLimitError(str(error))
+        return BackendError(str(error), status=status)
+
+    async def generate(self, model_name, prompt):
+        try:
+            response = await self._model(model_name).generate_content_async(prompt)
+        except self._api_errors as e:
+            # 其他异常不捕获，保持原来的异常和调用栈
+            raise self._translate(e) from e
+        usage = getattr(response, 'usage_metadata', None)
+        return GenerationResult(
+            response.text,
+            getattr(usage, 'prompt_token_count', None),
+            getattr(usage, 'candidates_token_count', None),
+        )
+
+    async def stream(self, model_name, prompt):
+        try:
+            response = await self._model(model_name).generate_content_async(prompt, stream=True)
+            async for chunk in response:
+                if chunk.text:
+                    yield chunk.text
+        except self._api_errors as e:
+            raise self._translate(e) from e
+
+
+class FakeGeminiBackend(GeminiBackend):
+    """本地模拟的 Gemini 后端，用于压测和离线调试
+
+    - 延迟服从中位数为 latency、形状参数为 jitter 的对数正态分布
+    - 按 error_rate 的概率返回 429；设置 rpm 后，每分钟超过 rpm 次的请求也返回 429
+    - 响应内容只由 prompt 决定；延迟和错误由 (seed, prompt, 第几次调用) 决定，
+      与并发调度的先后顺序无关，相同输入的多次压测结果可以复现
+    """
+    name = 'fake'
+
+    WORDS = [
+        '今天', '明天', '会议', '项目', '进度', '上线', '测试', '问题', '需要', '确认',
+        '文档', '接口', '数据库', '性能', '优化', '安排', '待办', '负责', '完成', '跟进',
+    ]
+
+    def __init__(self, latency=0.5, jitter=0.3, error_rate=0.0, rpm=0, seed=0,
+                 response_chars=800, chunks=8):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rpm = rpm
+        self.seed = seed
+        self.response_chars = response_chars
+        self.chunks = chunks
+        self._calls = collections.Counter()
+        self._recent = collections.deque()
+
+    def _rng(self, model_name, prompt):
+        digest = hashlib.sha256(f'{self.seed}:{model_name}:{prompt}'.encode('utf-8')).hexdigest()
+        self._calls[digest] += 1
+        return random.Random(f'{digest}:{self._calls[digest]}')
+
+    def _admit(self, rng):
+        """检查限流，被拒绝时抛出 RateLimitError"""
+        if self.rpm:
+            now = time.monotonic()
+            while self._recent and now - self._recent[0] >= 60:
+                self._recent.popleft()
+            if len(self._recent) >= self.rpm:
+                raise RateLimitError(f"模拟限流：每分钟超过 {self.rpm} 次请求")
+            self._recent.append(now)
+        if rng.random() < self.error_rate:
+            raise RateLimitError("模拟限流：随机错误")
+
+    def _delay(self, rng):
+        if self.latency <= 0:
+            return 0.0
+        return rng.lognormvariate(math.log(self.latency), self.jitter)
+
+    def _text(self, prompt):
+        rng = random.Random(hashlib.sha256(prompt.encode('utf-8')).hexdigest())
+        return ''.join(rng.choice(self.WORDS) for _ in range(self.response_chars // 2))
+
+    async def generate(self, model_name, prompt):
+        rng = self._rng(model_name, prompt)
+        self._admit(rng)
+        await asyncio.sleep(self._delay(rng))
+        text = self._text(prompt)
+        return GenerationResult(text, estimate_tokens(prompt), estimate_tokens(text))
+
+    async def stream(self, model_name, prompt):
+        rng = self._rng(model_name, prompt)
+        self._admit(rng)
+        text = self._text(prompt)
+        size = max(1, math.ceil(len(text) / self.chunks))
+        pieces = [text[i:i + size] for i in range(0, len(text), size)]
+        delay = self._delay(rng) / len(pieces)
+        for piece in pieces:
+            await asyncio.sleep(delay)
+            yield piece
+
+
+def create_backend(name, api_key=None, **fake_options):
+    """按名称创建后端：google（默认）或 fake"""
+    if name == 'fake':
+        return FakeGeminiBackend(**fake_options)
+    if name == 'google':
+        return GoogleGeminiBackend(api_key)
+    raise ValueError(f"不支持的 Gemini 后端：{name}")
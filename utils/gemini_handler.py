@@ -1,22 +1,56 @@
-import google.generativeai as genai
-import json
+import asyncio
+import logging
+import random
+import time
+from contextlib import contextmanager
+
+from utils.context_builder import estimate_tokens
+from utils.gemini_backends import BackendError, GoogleGeminiBackend
+from utils.metrics import GEMINI_REQUEST_SECONDS, GEMINI_REQUESTS, GEMINI_TOKENS, GEMINI_CACHE_HITS, GEMINI_RETRIES
+from utils.rate_limiter import RequestGovernor
+
+logger = logging.getLogger(__name__)
+
+
+class GeminiError(Exception):
+    """Gemini 调用失败（超时、限流重试耗尽或其他错误），消息可直接展示给用户"""
+
 
 class GeminiHandler:
+    # context_budget：每次请求中聊天记录等上下文可使用的 token 预算
     AVAILABLE_MODELS = {
-        'gemini-pro': 'gemini-pro',
-        'gemini-exp-1206': 'gemini-exp-1206',
-        'gemini-2.0-flash-exp': 'gemini-2.0-flash-exp'
+        'gemini-pro': {'context_budget': 24000},
+        'gemini-exp-1206': {'context_budget': 128000},
+        'gemini-2.0-flash-exp': {'context_budget': 128000}
     }
     DEFAULT_MODEL = 'gemini-2.0-flash-exp'
+    DEFAULT_TIMEOUT = 120
+    DEFAULT_MAX_CONCURRENCY = 8
+    DEFAULT_MAX_RETRIES = 3
+    DEFAULT_RETRY_BASE_DELAY = 2
+    MAX_RETRY_DELAY = 60
+    # 请求前按 prompt 加上这么多响应 token 预扣 tpm 配额，完成后按实际用量结算
+    EXPECTED_RESPONSE_TOKENS = 1000
 
-    def __init__(self, api_key, model_name=None):
-        print(f"初始化 Gemini API...")
-        genai.configure(api_key=api_key)
+    def __init__(self, api_key, model_name=None, timeout=None, max_concurrency=None, cache=None,
+                 context_budget=None, backend=None, governor=None, max_retries=None, retry_base_delay=None):
+        # 实际发送请求的后端（见 utils/gemini_backends.py），默认调用 Google 的 Gemini API
+        self.backend = backend or GoogleGeminiBackend(api_key)
         
         # 使用指定的模型或默认模型
         self.model_name = model_name if model_name in self.AVAILABLE_MODELS else self.DEFAULT_MODEL
-        self.model = genai.GenerativeModel(self.model_name)
-        print(f"Gemini API 初始化完成，使用模型：{self.model_name}")
+        # 单次调用超时（秒）
+        self.timeout = timeout or self.DEFAULT_TIMEOUT
+        # 客户端限流：并发上限、每分钟请求数/token 数配额，以及所有者请求与后台请求之间的公平排队
+        self.governor = governor or RequestGovernor(max_concurrency or self.DEFAULT_MAX_CONCURRENCY)
+        # 遇到 429 和 5xx 时的重试次数和退避基数（秒）
+        self.max_retries = self.DEFAULT_MAX_RETRIES if max_retries is None else max_retries
+        self.retry_base_delay = self.DEFAULT_RETRY_BASE_DELAY if retry_base_delay is None else retry_base_delay
+        # 可选的响应缓存（ResponseCache），相同模型和 prompt 的请求直接返回缓存结果
+        self.cache = cache
+        # 设置后覆盖所有模型的默认上下文预算
+        self.context_budget_override = context_budget
+        logger.info("Gemini API 初始化完成，后端：%s，使用模型：%s", self.backend.name, self.model_name)
 
     def set_model(self, model_name):
         """切换到指定的模型"""
@@ -24,65 +58,234 @@ class GeminiHandler:
             raise ValueError(f"不支持的模型：{model_name}。可用模型：{list(self.AVAILABLE_MODELS.keys())}")
         
         self.model_name = model_name
-        self.model = genai.GenerativeModel(model_name)
-        print(f"已切换到模型：{model_name}")
-
-    async def analyze_group_history(self, messages, system_prompt=None):
-        print(f"\n=== 开始分析群组历史 ===")
-        print(f"使用模型：{self.model_name}")
-        print(f"输入消息原始内容：\n{messages}")
-        print(f"输入消息长度：{len(messages)} 字符")
-        prompt = f"{system_prompt or '分析以下群组聊天记录，提供群组的背景信息：'}\n{messages}"
-        print(f"完整的 Prompt：\n{prompt}")
+        logger.info("已切换到模型：%s", model_name)
+
+    @property
+    def context_budget(self):
+        """当前模型的上下文 token 预算"""
+        return self.context_budget_override or self.AVAILABLE_MODELS[self.model_name]['context_budget']
+
+    def _retry_delay(self, model_name, error, attempt):
+        """可以重试时返回退避时间（秒），否则返回 None
+
+        退避时间按指数增长并加入随机抖动，避免多个请求同时重试；
+        429 时还会暂停该模型的所有请求，直到退避结束。
+        """
+        if not isinstance(error, BackendError) or not error.retryable or attempt >= self.max_retries:
+            return None
+        ceiling = min(self.MAX_RETRY_DELAY, self.retry_base_delay * 2 ** attempt)
+        delay = ceiling / 2 + random.uniform(0, ceiling / 2)
+        if error.status == 429:
+            self.governor.penalize(model_name, delay)
+        GEMINI_RETRIES.inc(model=model_name, status=error.status)
+        logger.warning("Gemini API 返回 %s，%.1f 秒后第 %d 次重试：%s",
+                       error.status, delay, attempt + 1, error)
+        return delay
+
+    async def _generate(self, prompt, priority=RequestGovernor.PRIORITY_OWNER):
+        """异步调用 Gemini API，不阻塞事件循环
+
+        请求先在限流器中排队等待配额；遇到 429 或 5xx 时退避后重试，最多 self.max_retries 次。
+        单次调用超过 self.timeout 秒会被取消并抛出 asyncio.TimeoutError。
+        调用方任务被取消时，进行中的请求也会一并取消。返回 GenerationResult。
+        """
+        # 固定调用时的模型，避免等待期间 set_model 切换导致前后不一致
+        model_name = self.model_name
+        reserved = estimate_tokens(prompt) + self.EXPECTED_RESPONSE_TOKENS
+        attempt = 0
+        while True:
+            async with self.governor.request(model_name, reserved, priority) as permit:
+                try:
+                    with self._track_request(model_name, 'unary'):
+                        result = await asyncio.wait_for(self.backend.generate(model_name, prompt), timeout=self.timeout)
+                except BackendError as e:
+                    delay = self._retry_delay(model_name, e, attempt)
+                    if delay is None:
+                        raise
+                else:
+                    prompt_tokens = result.prompt_tokens or estimate_tokens(prompt)
+                    response_tokens = result.response_tokens or estimate_tokens(result.text)
+                    self.governor.settle(permit, prompt_tokens + response_tokens)
+                    return result
+            # 退避期间不占用并发名额
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    @contextmanager
+    def _track_request(self, model_name, mode):
+        """记录一次 API 请求的耗时和结果（ok/timeout/error/cancelled）"""
+        start = time.perf_counter()
+        status = 'cancelled'
         try:
-            print("正在调用 Gemini API...")
-            response = self.model.generate_content(prompt)
-            print(f"Gemini API 响应原始内容：")
-            print(json.dumps(response.candidates[0].content.parts[0].text, ensure_ascii=False, indent=2))
-            print(f"Gemini 响应文本：\n{response.text}")
-            return response.text
-        except Exception as e:
-            print(f"Gemini API 调用出错：{str(e)}")
-            print(f"错误类型：{type(e)}")
-            return f"分析过程中出错：{str(e)}"
-
-    async def find_action_items(self, messages, system_prompt=None):
-        print(f"\n=== 开始查找待办事项 ===")
-        print(f"使用模型：{self.model_name}")
-        print(f"输入消息原始内容：\n{messages}")
-        print(f"输入消息长度：{len(messages)} 字符")
-        prompt = f"{system_prompt or '分析以下今日群组聊天记录，找出需要我执行的待办事项：'}\n{messages}"
-        print(f"完整的 Prompt：\n{prompt}")
+            yield
+            status = 'ok'
+        except asyncio.TimeoutError:
+            status = 'timeout'
+            raise
+        except Exception:
+            status = 'error'
+            raise
+        finally:
+            GEMINI_REQUESTS.inc(model=model_name, status=status)
+            GEMINI_REQUEST_SECONDS.observe(time.perf_counter() - start, model=model_name, mode=mode)
+
+    @staticmethod
+    def _count_tokens(model_name, prompt, text, prompt_tokens=None, response_tokens=None):
+        """记录 token 用量，后端没有返回实际数量时使用本地估算"""
+        if prompt_tokens is None:
+            prompt_tokens = estimate_tokens(prompt)
+        if response_tokens is None:
+            response_tokens = estimate_tokens(text)
+        GEMINI_TOKENS.inc(prompt_tokens, model=model_name, direction='input')
+        GEMINI_TOKENS.inc(response_tokens, model=model_name, direction='output')
+
+    async def _generate_text(self, prompt, priority=RequestGovernor.PRIORITY_OWNER):
+        """生成回复文本，命中缓存时不调用 API"""
+        model_name = self.model_name
+        cache_key = None
+        if self.cache:
+            cache_key = self.cache.make_key(model_name, prompt)
+            cached = await self.cache.get(cache_key)
+            if cached is not None:
+                logger.debug("命中响应缓存")
+                GEMINI_CACHE_HITS.inc()
+                return cached
+
+        result = await self._generate(prompt, priority)
+        text = result.text
+        self._count_tokens(model_name, prompt, text, result.prompt_tokens, result.response_tokens)
+        if self.cache:
+            await self.cache.set(cache_key, model_name, text)
+        return text
+
+    async def _complete(self, prompt, priority):
+        """生成回复文本，失败时抛出 GeminiError"""
+        logger.debug("完整的 Prompt：\n%s", prompt)
         try:
-            print("正在调用 Gemini API...")
-            response = self.model.generate_content(prompt)
-            print(f"Gemini API 响应原始内容：")
-            print(json.dumps(response.candidates[0].content.parts[0].text, ensure_ascii=False, indent=2))
-            print(f"Gemini 响应文本：\n{response.text}")
-            return response.text
+            text = await self._generate_text(prompt, priority)
+        except asyncio.TimeoutError as e:
+            logger.error("Gemini API 调用超时（%s 秒）", self.timeout)
+            raise GeminiError("请求超时") from e
         except Exception as e:
-            print(f"Gemini API 调用出错：{str(e)}")
-            print(f"错误类型：{type(e)}")
-            print(f"错误详情：")
-            print(f"消息内容：{messages[:200]}...")  # 只打印前200个字符
-            print(f"系统提示词：{system_prompt[:200]}...")  # 只打印前200个字符
-            return f"分析过程中出错：{str(e)}"
-
-    async def suggest_reply(self, last_message, system_prompt=None):
-        print(f"\n=== 开始生成回复建议 ===")
-        print(f"使用模型：{self.model_name}")
-        print(f"输入消息原始内容：\n{last_message}")
-        print(f"输入消息长度：{len(last_message)} 字符")
-        prompt = f"{system_prompt or '根据以下最新消息，建议一个合适的回复：'}\n{last_message}"
-        print(f"完整的 Prompt：\n{prompt}")
+            logger.exception("Gemini API 调用出错：%s", e)
+            raise GeminiError(str(e)) from e
+        logger.debug("Gemini 响应文本：\n%s", text)
+        return text
+
+    async def analyze_group_history(self, messages, system_prompt=None, priority=RequestGovernor.PRIORITY_OWNER):
+        prompt = f"{system_prompt or '分析以下群组聊天记录，提供群组的背景信息：'}\n{messages}"
+        logger.info("开始分析群组历史，模型：%s，输入消息长度：%d 字符", self.model_name, len(messages))
+        return await self._complete(prompt, priority)
+
+    async def _stream_text(self, prompt, priority=RequestGovernor.PRIORITY_OWNER):
+        """流式生成回复文本，逐块返回；命中缓存时一次性返回完整结果
+
+        每个数据块的等待时间不超过 self.timeout 秒，超时抛出 asyncio.TimeoutError。
+        只有在还没有返回任何数据块时才会重试 429 和 5xx 错误。
+        """
+        model_name = self.model_name
+        cache_key = None
+        if self.cache:
+            cache_key = self.cache.make_key(model_name, prompt)
+            cached = await self.cache.get(cache_key)
+            if cached is not None:
+                logger.debug("命中响应缓存")
+                GEMINI_CACHE_HITS.inc()
+                yield cached
+                return
+
+        chunks = []
+        reserved = estimate_tokens(prompt) + self.EXPECTED_RESPONSE_TOKENS
+        attempt = 0
+        while True:
+            try:
+                async with self.governor.request(model_name, reserved, priority) as permit:
+                    with self._track_request(model_name, 'stream'):
+                        iterator = self.backend.stream(model_name, prompt)
+                        try:
+                            while True:
+                                try:
+                                    chunk = await asyncio.wait_for(iterator.__anext__(), timeout=self.timeout)
+                                except StopAsyncIteration:
+                                    break
+                                chunks.append(chunk)
+                                yield chunk
+                        finally:
+                            await iterator.aclose()
+                    self.governor.settle(permit, estimate_tokens(prompt) + estimate_tokens("".join(chunks)))
+                break
+            except BackendError as e:
+                delay = None if chunks else self._retry_delay(model_name, e, attempt)
+                if delay is None:
+                    raise
+            await asyncio.sleep(delay)
+            attempt += 1
+
+        self._count_tokens(model_name, prompt, "".join(chunks))
+        if self.cache and chunks:
+            await self.cache.set(cache_key, model_name, "".join(chunks))
+
+    async def stream_group_analysis(self, messages, system_prompt=None, priority=RequestGovernor.PRIORITY_OWNER):
+        """流式分析群组历史，逐块返回分析文本，出错时抛出 GeminiError"""
+        prompt = f"{system_prompt or '分析以下群组聊天记录，提供群组的背景信息：'}\n{messages}"
+        logger.info("开始流式分析群组历史，模型：%s，输入消息长度：%d 字符", self.model_name, len(messages))
+        logger.debug("完整的 Prompt：\n%s", prompt)
         try:
-            print("正在调用 Gemini API...")
-            response = self.model.generate_content(prompt)
-            print(f"Gemini API 响应原始内容：")
-            print(json.dumps(response.candidates[0].content.parts[0].text, ensure_ascii=False, indent=2))
-            print(f"Gemini 响应文本：\n{response.text}")
-            return response.text
+            async for chunk in self._stream_text(prompt, priority):
+                yield chunk
+        except asyncio.TimeoutError as e:
+            logger.error("Gemini API 流式调用超时（%s 秒）", self.timeout)
+            raise GeminiError("请求超时") from e
         except Exception as e:
-            print(f"Gemini API 调用出错：{str(e)}")
-            print(f"错误类型：{type(e)}")
-            return f"生成建议时出错：{str(e)}" 
\ No newline at end of file
+            logger.error("Gemini API 流式调用出错：%s（%s）", e, type(e).__name__)
+            raise GeminiError(str(e)) from e
+
+    async def update_group_summary(self, previous_summary, new_messages, system_prompt=None,
+                                   priority=RequestGovernor.PRIORITY_OWNER):
+        """在已有背景信息的基础上合并新消息，只发送增量内容"""
+        logger.info("开始增量更新群组背景，模型：%s，已有背景长度：%d 字符，新消息长度：%d 字符",
+                    self.model_name, len(previous_summary), len(new_messages))
+        prompt = (
+            f"{system_prompt or '分析以下群组聊天记录，提供群组的背景信息：'}\n\n"
+            f"以下是此前已总结的群组背景信息：\n{previous_summary}\n\n"
+            f"以下是此后的新消息。请结合新消息更新群组背景信息，"
+            f"输出完整的、更新后的背景信息：\n{new_messages}"
+        )
+        return await self._complete(prompt, priority)
+
+    async def compress_summary(self, summary, max_length, priority=RequestGovernor.PRIORITY_OWNER):
+        """压缩过长的群组背景信息，为合并新消息留出上下文预算"""
+        logger.info("开始压缩群组背景，模型：%s，背景长度：%d 字符", self.model_name, len(summary))
+        prompt = (
+            f"以下群组背景信息过长。请压缩到不超过 {max_length} 字，保留群组的主题、成员、"
+            f"仍在进行的事项和重要的结论：\n{summary}"
+        )
+        return await self._complete(prompt, priority)
+
+    async def summarize_period(self, messages, period, max_length, priority=RequestGovernor.PRIORITY_OWNER):
+        """总结一个时间段内的聊天记录，用于分层摘要"""
+        logger.info("开始总结 %s 的聊天记录，模型：%s，输入消息长度：%d 字符", period, self.model_name, len(messages))
+        prompt = (
+            f"总结以下群组在 {period} 的聊天记录。保留主要话题、结论和决定、待办事项及相关人物，"
+            f"按重要性排列，不超过 {max_length} 字：\n{messages}"
+        )
+        return await self._complete(prompt, priority)
+
+    async def merge_summaries(self, summaries, period, max_length, priority=RequestGovernor.PRIORITY_OWNER):
+        """把一个时间段内按时间排列的多段总结合并为一段"""
+        logger.info("开始合并 %s 的聊天总结，模型：%s，输入长度：%d 字符", period, self.model_name, len(summaries))
+        prompt = (
+            f"以下是群组在 {period} 内各时段的聊天总结，按时间排列。请合并为这段时间的总结，"
+            f"保留主要话题、结论和决定、待办事项及相关人物，按重要性排列，不超过 {max_length} 字：\n{summaries}"
+        )
+        return await self._complete(prompt, priority)
+
+    async def find_action_items(self, messages, system_prompt=None, priority=RequestGovernor.PRIORITY_OWNER):
+        prompt = f"{system_prompt or '分析以下今日群组聊天记录，找出需要我执行的待办事项：'}\n{messages}"
+        logger.info("开始查找待办事项，模型：%s，输入消息长度：%d 字符", self.model_name, len(messages))
+        return await self._complete(prompt, priority)
+
+    async def suggest_reply(self, last_message, system_prompt=None, priority=RequestGovernor.PRIORITY_OWNER):
+        prompt = f"{system_prompt or '根据以下最新消息，建议一个合适的回复：'}\n{last_message}"
+        logger.info("开始生成回复建议，模型：%s，输入消息长度：%d 字符", self.model_name, len(last_message))
+        return await self._complete(prompt, priority)
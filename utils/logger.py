@@ -0,0 +1,62 @@
+import json
+import logging
+import random
+import sys
+
+TEXT_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+# 高频事件（如每条消息的处理）带上此标记，按 LOG_SAMPLE_RATE 抽样输出
+SAMPLED = {'sampled': True}
+
+# LogRecord 自带的属性，JSON 格式中不重复输出
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    """每条日志输出为一行 JSON，通过 extra 传入的字段作为独立的键保留"""
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS and key != 'sampled':
+                entry[key] = value
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """按比例丢弃带 sampled 标记的日志，其他日志不受影响"""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if getattr(record, 'sampled', False):
+            return self.rate >= 1 or random.random() < self.rate
+        return True
+
+
+def setup_logging(level='INFO', fmt='text', sample_rate=1.0):
+    """配置根日志记录器，程序启动时调用一次
+
+    level：日志级别；fmt：text 或 json；sample_rate：高频事件的抽样比例（0~1）。
+    """
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonFormatter() if fmt == 'json' else logging.Formatter(TEXT_FORMAT))
+    handler.addFilter(SamplingFilter(sample_rate))
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+
+    # httpx 会为每个 Bot API 请求输出一条 INFO 日志
+    logging.getLogger('httpx').setLevel(logging.WARNING)
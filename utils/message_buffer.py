@@ -0,0 +1,111 @@
+import asyncio
+import logging
+import time
+
+from utils.metrics import MESSAGES_RECEIVED, MESSAGES_STORED, MESSAGES_DROPPED, BUFFER_FLUSH_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+class MessageBuffer:
+    """实时消息的写入缓冲区
+
+    新消息先进入内存，攒满 max_size 条或距上次写入超过 flush_interval 秒后，
+    在一个事务中批量写入数据库，分摊每次提交的 fsync 开销。
+    写入失败的消息留在缓冲区中重试，最多保留 MAX_PENDING_BATCHES 批，超出时丢弃最早的消息。
+    """
+    MAX_PENDING_BATCHES = 50
+
+    def __init__(self, db, max_size=200, flush_interval=0.5, on_flush=None):
+        self.db = db
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        # 写入完成后的回调，参数为本批涉及的群组ID集合
+        self.on_flush = on_flush
+        self._messages = []
+        self._chat_titles = {}
+        # 上次记录日志以来因缓冲区已满丢弃的消息数
+        self._dropped = 0
+        self._flush_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def __len__(self):
+        return len(self._messages)
+
+    def start(self):
+        """启动后台写入任务，需在事件循环中调用"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+            logger.info("消息缓冲区已启动（批量：%d 条，间隔：%s 秒）", self.max_size, self.flush_interval)
+
+    async def add(self, message, chat_title=None):
+        """加入一条待写入的消息，不等待落盘"""
+        self._messages.append(message)
+        MESSAGES_RECEIVED.inc()
+        self._drop_overflow()
+        if chat_title:
+            self._chat_titles[message['chat_id']] = chat_title
+        if len(self._messages) >= self.max_size:
+            self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        """将缓冲区中的消息在一个事务中写入数据库，返回写入条数"""
+        async with self._flush_lock:
+            if not self._messages and not self._chat_titles:
+                return 0
+            messages, self._messages = self._messages, []
+            chat_titles, self._chat_titles = self._chat_titles, {}
+            start = time.perf_counter()
+            try:
+                stored = await self.db.store_live_messages(messages, chat_titles)
+            except Exception as e:
+                logger.error("批量写入消息时出错：%s，%d 条消息将在下次重试", e, len(messages))
+                # 放回缓冲区头部，保持消息顺序
+                self._messages[:0] = messages
+                for chat_id, title in chat_titles.items():
+                    self._chat_titles.setdefault(chat_id, title)
+                self._drop_overflow()
+                if self._dropped:
+                    logger.warning("写入缓冲区已满，已丢弃最早的 %d 条消息", self._dropped)
+                    self._dropped = 0
+                return 0
+            BUFFER_FLUSH_SECONDS.observe(time.perf_counter() - start)
+            MESSAGES_STORED.inc(stored)
+
+        if self.on_flush:
+            chat_ids = {msg['chat_id'] for msg in messages}
+            try:
+                await self.on_flush(chat_ids)
+            except Exception as e:
+                logger.exception("执行写入回调时出错：%s", e)
+        return stored
+
+    def _drop_overflow(self):
+        """数据库持续写入失败（如磁盘已满、文件被锁）时限制内存占用，丢弃最早的消息"""
+        dropped = len(self._messages) - self.max_size * self.MAX_PENDING_BATCHES
+        if dropped > 0:
+            del self._messages[:dropped]
+            self._dropped += dropped
+            MESSAGES_DROPPED.inc(dropped)
+
+    async def close(self):
+        """停止后台任务并写入剩余消息"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        stored = await self.flush()
+        logger.info("消息缓冲区已关闭，最后写入 %d 条消息", stored)
@@ -0,0 +1,280 @@
+import functools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# 默认的延迟分桶（秒），覆盖从毫秒级数据库查询到分钟级 Gemini 调用
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """指标基类，按标签值分别记录，可在多个线程中同时更新"""
+    type_name = ''
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"指标 {self.name} 需要标签 {self.labelnames}，实际为 {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} {self.type_name}',
+        ]
+        for suffix, label_values, extra, value in self._samples():
+            labels = _format_labels(self.labelnames, label_values, extra)
+            lines.append(f'{self.name}{suffix}{labels} {_format_value(value)}')
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    """只增不减的计数器"""
+    type_name = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        return [('', key, (), value) for key, value in items]
+
+
+class Gauge(_Metric):
+    """可增可减的当前值；set_function 设置的回调在输出时求值"""
+    type_name = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._function = None
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function):
+        self._function = function
+
+    def _samples(self):
+        if self._function is not None:
+            return [('', (), (), self._function())]
+        with self._lock:
+            items = list(self._values.items())
+        return [('', key, (), value) for key, value in items]
+
+
+class Histogram(_Metric):
+    """按分桶统计的分布，用于延迟等数值"""
+    type_name = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][index] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """记录 with 代码块的执行时间"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self):
+        with self._lock:
+            items = [(key, (list(state[0]), state[1], state[2])) for key, state in self._values.items()]
+        samples = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                samples.append(('_bucket', key, (('le', _format_value(float(bound))),), cumulative))
+            samples.append(('_sum', key, (), total))
+            samples.append(('_count', key, (), count))
+        return samples
+
+
+class MetricsRegistry:
+    """指标注册表，以 Prometheus 文本格式输出所有指标"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, cls, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+# 数据库
+DB_QUERY_SECONDS = REGISTRY.histogram(
+    'tgassist_db_query_seconds', "数据库操作执行时间", ('method',))
+DB_QUEUE_SECONDS = REGISTRY.histogram(
+    'tgassist_db_queue_seconds', "数据库操作在线程池中的排队时间", ('pool',))
+DB_ERRORS = REGISTRY.counter(
+    'tgassist_db_errors_total', "数据库操作出错次数", ('method',))
+
+# Gemini
+GEMINI_REQUEST_SECONDS = REGISTRY.histogram(
+    'tgassist_gemini_request_seconds', "Gemini 请求耗时（流式请求为完整耗时）", ('model', 'mode'))
+GEMINI_REQUESTS = REGISTRY.counter(
+    'tgassist_gemini_requests_total', "Gemini 请求次数", ('model', 'status'))
+GEMINI_TOKENS = REGISTRY.counter(
+    'tgassist_gemini_tokens_total', "Gemini 请求的 token 数（后端未返回时为本地估算值）", ('model', 'direction'))
+GEMINI_CACHE_HITS = REGISTRY.counter(
+    'tgassist_gemini_cache_hits_total', "命中响应缓存的请求次数")
+GEMINI_RETRIES = REGISTRY.counter(
+    'tgassist_gemini_retries_total', "因限流或服务端错误重试的次数", ('model', 'status'))
+GOVERNOR_WAIT_SECONDS = REGISTRY.histogram(
+    'tgassist_governor_wait_seconds', "请求在客户端限流器中等待配额的时间", ('priority',))
+GOVERNOR_QUEUE_DEPTH = REGISTRY.gauge(
+    'tgassist_governor_queue_depth', "在客户端限流器中等待配额的请求数")
+
+# 消息写入
+MESSAGES_RECEIVED = REGISTRY.counter(
+    'tgassist_messages_received_total', "进入写入缓冲区的消息数")
+MESSAGES_STORED = REGISTRY.counter(
+    'tgassist_messages_stored_total', "批量写入数据库的消息数")
+MESSAGES_DROPPED = REGISTRY.counter(
+    'tgassist_messages_dropped_total', "数据库持续写入失败、缓冲区已满时丢弃的消息数")
+BUFFER_FLUSH_SECONDS = REGISTRY.histogram(
+    'tgassist_buffer_flush_seconds', "写入缓冲区每次批量写入的耗时")
+BUFFER_PENDING = REGISTRY.gauge(
+    'tgassist_buffer_pending', "写入缓冲区中尚未落盘的消息数")
+
+# Telegram 处理函数
+HANDLER_SECONDS = REGISTRY.histogram(
+    'tgassist_handler_seconds', "处理函数执行时间", ('handler',))
+HANDLER_ERRORS = REGISTRY.counter(
+    'tgassist_handler_errors_total', "处理函数抛出异常的次数", ('handler',))
+HANDLER_LAG_SECONDS = REGISTRY.histogram(
+    'tgassist_handler_lag_seconds', "消息发送到开始处理之间的延迟", ('handler',))
+
+# 分析调度器
+SCHEDULER_QUEUE_DEPTH = REGISTRY.gauge(
+    'tgassist_scheduler_queue_depth', "等待执行的分析任务数")
+SCHEDULER_RUNNING = REGISTRY.gauge(
+    'tgassist_scheduler_running', "正在执行的分析任务数")
+SCHEDULER_WAIT_SECONDS = REGISTRY.histogram(
+    'tgassist_scheduler_wait_seconds', "分析任务从提交到开始执行的等待时间")
+
+
+def track_handler(callback, name=None):
+    """包装 Telegram 处理函数，记录执行时间、异常次数和消息处理延迟"""
+    handler = name or callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        message = getattr(update, 'message', None)
+        if message is not None and message.date is not None:
+            HANDLER_LAG_SECONDS.observe(max(0.0, time.time() - message.date.timestamp()), handler=handler)
+        start = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=handler)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - start, handler=handler)
+
+    return wrapper
+
+
+async def start_metrics_server(host, port, registry=REGISTRY):
+    """在 host:port 上启动 /metrics 接口，返回用于关闭的 AppRunner
+
+    端口被占用等无法监听时只记录警告并返回 None，不影响机器人启动。
+    """
+    # 只有机器人进程需要 HTTP 接口，离线导入等脚本记录指标时不依赖 aiohttp
+    from aiohttp import web
+
+    async def handle_metrics(request):
+        return web.Response(text=registry.render(), content_type='text/plain', charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+    except OSError as e:
+        logger.warning("无法在 %s:%s 启动指标接口：%s", host, port, e)
+        await runner.cleanup()
+        return None
+    logger.info("指标接口已启动：http://%s:%s/metrics", host, port)
+    return runner
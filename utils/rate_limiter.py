@@ -0,0 +1,196 @@
+import asyncio
+import collections
+import logging
+import math
+import time
+from contextlib import asynccontextmanager
+
+from utils.metrics import GOVERNOR_WAIT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """令牌桶：容量为每分钟的配额，按 per_minute / 60 的速度匀速补充
+
+    consume 允许透支，余额为负时后续请求需要等待补足，
+    用于请求完成后按实际 token 用量结算。
+    """
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount, now):
+        """取出 amount 个令牌还需等待的秒数，超过容量的请求按容量计算"""
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount, now):
+        self._refill(now)
+        self.tokens = min(self.capacity, self.tokens - amount)
+
+
+class _Permit:
+    def __init__(self, model_name, tokens, priority, future):
+        self.model_name = model_name
+        self.tokens = tokens
+        self.priority = priority
+        self.future = future
+        self.created = time.monotonic()
+
+
+class RequestGovernor:
+    """Gemini 请求的客户端限流器
+
+    - 按模型分别维护每分钟请求数（rpm）和 token 数（tpm）的令牌桶，0 表示不限
+    - 限制同时进行的请求数
+    - 所有者请求和后台请求分两个队列：两边都有请求排队时，每放行 owner_weight 个
+      所有者请求至少放行一个后台请求，后台任务不会被饿死，也不会占满配额
+    - 收到 429 后通过 penalize 暂停该模型的请求，避免继续触发限流
+    """
+    PRIORITY_OWNER = 'owner'
+    PRIORITY_BACKGROUND = 'background'
+
+    def __init__(self, max_concurrency=8, rpm=0, tpm=0, owner_weight=3):
+        self.max_concurrency = max_concurrency
+        self.rpm = rpm
+        self.tpm = tpm
+        self.owner_weight = max(1, owner_weight)
+        self._queues = {
+            self.PRIORITY_OWNER: collections.deque(),
+            self.PRIORITY_BACKGROUND: collections.deque(),
+        }
+        self._buckets = {}
+        self._paused_until = {}
+        self._in_flight = 0
+        self._owner_streak = 0
+        self._wakeup = asyncio.Event()
+        self._dispatcher = None
+
+    @property
+    def queue_depth(self):
+        """等待放行的请求数"""
+        return sum(len(queue) for queue in self._queues.values())
+
+    @asynccontextmanager
+    async def request(self, model_name, tokens, priority=PRIORITY_OWNER):
+        """等待配额后进入代码块，tokens 为预计消耗的 token 数（可用 settle 按实际用量结算）"""
+        permit = await self._acquire(model_name, tokens, priority)
+        try:
+            yield permit
+        finally:
+            self._in_flight -= 1
+            self._wakeup.set()
+
+    def settle(self, permit, actual_tokens):
+        """按实际 token 用量修正预扣的数量"""
+        _, tpm_bucket = self._buckets_for(permit.model_name)
+        if tpm_bucket is not None:
+            tpm_bucket.consume(actual_tokens - permit.tokens, time.monotonic())
+        permit.tokens = actual_tokens
+
+    def penalize(self, model_name, seconds):
+        """在接下来的 seconds 秒内暂停放行该模型的请求"""
+        until = time.monotonic() + seconds
+        if until > self._paused_until.get(model_name, 0):
+            self._paused_until[model_name] = until
+            logger.info("模型 %s 被限流，暂停 %.1f 秒", model_name, seconds)
+
+    def _buckets_for(self, model_name):
+        buckets = self._buckets.get(model_name)
+        if buckets is None:
+            buckets = self._buckets[model_name] = (
+                TokenBucket(self.rpm) if self.rpm else None,
+                TokenBucket(self.tpm) if self.tpm else None,
+            )
+        return buckets
+
+    async def _acquire(self, model_name, tokens, priority):
+        permit = _Permit(model_name, tokens, priority, asyncio.get_running_loop().create_future())
+        self._queues[priority].append(permit)
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        self._wakeup.set()
+        try:
+            await permit.future
+        except asyncio.CancelledError:
+            if permit.future.done() and not permit.future.cancelled():
+                # 已经放行但调用方在恢复执行前被取消，归还并发名额
+                self._in_flight -= 1
+                self._wakeup.set()
+            else:
+                try:
+                    self._queues[priority].remove(permit)
+                except ValueError:
+                    pass
+            raise
+        GOVERNOR_WAIT_SECONDS.observe(time.monotonic() - permit.created, priority=priority)
+        return permit
+
+    def _next_queue(self):
+        owner = self._queues[self.PRIORITY_OWNER]
+        background = self._queues[self.PRIORITY_BACKGROUND]
+        if owner and background:
+            if self._owner_streak >= self.owner_weight:
+                return background
+            return owner
+        return owner or background
+
+    def _rate_delay(self, permit, now):
+        delay = max(0.0, self._paused_until.get(permit.model_name, 0) - now)
+        rpm_bucket, tpm_bucket = self._buckets_for(permit.model_name)
+        if rpm_bucket is not None:
+            delay = max(delay, rpm_bucket.delay(1, now))
+        if tpm_bucket is not None:
+            delay = max(delay, tpm_bucket.delay(permit.tokens, now))
+        return delay
+
+    def _try_grant(self):
+        """尝试放行下一个请求，成功返回 0，否则返回需要等待的秒数"""
+        queue = self._next_queue()
+        permit = queue[0]
+        if permit.future.cancelled():
+            queue.popleft()
+            return 0.0
+        if self._in_flight >= self.max_concurrency:
+            return math.inf
+        now = time.monotonic()
+        delay = self._rate_delay(permit, now)
+        if delay > 0:
+            return delay
+
+        queue.popleft()
+        rpm_bucket, tpm_bucket = self._buckets_for(permit.model_name)
+        if rpm_bucket is not None:
+            rpm_bucket.consume(1, now)
+        if tpm_bucket is not None:
+            tpm_bucket.consume(permit.tokens, now)
+        if permit.priority == self.PRIORITY_OWNER and self._queues[self.PRIORITY_BACKGROUND]:
+            self._owner_streak += 1
+        else:
+            self._owner_streak = 0
+        self._in_flight += 1
+        permit.future.set_result(None)
+        return 0.0
+
+    async def _dispatch(self):
+        """按公平顺序放行排队的请求，队列清空后退出"""
+        while any(self._queues.values()):
+            self._wakeup.clear()
+            delay = self._try_grant()
+            if delay == 0:
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=None if delay == math.inf else delay)
+            except asyncio.TimeoutError:
+                pass
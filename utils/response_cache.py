@@ -0,0 +1,49 @@
+import hashlib
+import logging
+
+from utils.cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseCache:
+    """Gemini 响应缓存
+
+    缓存键由模型名和完整 prompt（system prompt + 格式化后的消息窗口）的哈希组成，
+    消息没有变化时重复请求直接返回结果。内存中保留最近使用的条目，
+    同时持久化到 SQLite，重启后仍然有效。
+    """
+
+    def __init__(self, db, ttl=3600, maxsize=256):
+        self.db = db
+        self.ttl = ttl
+        self._memory = TTLCache(ttl=ttl, maxsize=maxsize)
+
+    @staticmethod
+    def make_key(model_name, prompt):
+        digest = hashlib.sha256()
+        digest.update(model_name.encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(prompt.encode('utf-8'))
+        return digest.hexdigest()
+
+    async def get(self, key):
+        """先查内存再查数据库，未命中时返回 None"""
+        response = self._memory.get(key)
+        if response is not None:
+            return response
+        try:
+            response = await self.db.get_cached_response(key, self.ttl)
+        except Exception as e:
+            logger.warning("读取响应缓存时出错：%s", e)
+            return None
+        if response is not None:
+            self._memory.set(key, response)
+        return response
+
+    async def set(self, key, model_name, response):
+        self._memory.set(key, response)
+        try:
+            await self.db.store_cached_response(key, model_name, response, self.ttl)
+        except Exception as e:
+            logger.warning("写入响应缓存时出错：%s", e)
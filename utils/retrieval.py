@@ -0,0 +1,65 @@
+import collections
+import re
+
+from utils.context_builder import build_context
+
+# 英文单词、数字、版本号等，至少 3 个字符
+_ASCII_WORDS = re.compile(r'[A-Za-z0-9][A-Za-z0-9_.\-]{2,}')
+# 连续的汉字
+_CJK_RUNS = re.compile(r'[\u4e00-\u9fff]{3,}')
+
+_ASCII_STOPWORDS = {
+    'the', 'and', 'for', 'you', 'that', 'this', 'with', 'are', 'was', 'have', 'not', 'but',
+    'can', 'will', 'from', 'what', 'just', 'all', 'get', 'has', 'our', 'your', 'they', 'out',
+    'http', 'https', 'www', 'com',
+}
+# 虚词和代词，由它们组成的三字片段不适合作为检索词
+_CJK_STOP_CHARS = set('的了是在我你他她它们这那有和就不也都吗呢吧啊哦嗯个要会说去到没')
+
+# 历史消息单条最多占用的 token 数，比最近消息更严格，留出预算给更多条目
+MAX_RELATED_MESSAGE_TOKENS = 200
+
+
+def extract_keywords(texts, max_terms=30):
+    """从最近的对话中提取检索关键词
+
+    英文按单词提取；中文没有分词，按三字滑动窗口提取片段，与全文索引的 trigram
+    分词一致。按出现在多少条消息中计分，越新的消息权重越高，返回得分最高的 max_terms 个。
+    """
+    texts = [text for text in texts if text]
+    scores = collections.Counter()
+    for index, text in enumerate(texts):
+        weight = 1 + index / len(texts)
+        terms = {word.lower() for word in _ASCII_WORDS.findall(text)} - _ASCII_STOPWORDS
+        for run in _CJK_RUNS.findall(text):
+            for start in range(len(run) - 2):
+                gram = run[start:start + 3]
+                if sum(char in _CJK_STOP_CHARS for char in gram) < 2:
+                    terms.add(gram)
+        for term in terms:
+            scores[term] += weight
+    return [term for term, _ in scores.most_common(max_terms)]
+
+
+def select_related(messages, budget):
+    """按相关度从高到低选取预算内的历史消息，按时间正序格式化
+
+    messages 为按相关度排序的 (username, text, timestamp)，返回 (格式化文本, 选取的条数)。
+    """
+    if budget <= 0 or not messages:
+        return "", 0
+    _, count = build_context(messages, budget, keep='oldest', max_message_tokens=MAX_RELATED_MESSAGE_TOKENS)
+    chosen = sorted(messages[:count], key=lambda message: str(message[2]))
+    return build_context(chosen, budget, keep='oldest', max_message_tokens=MAX_RELATED_MESSAGE_TOKENS)
+
+
+def merge_ranked(*rankings, limit=None):
+    """交替合并多个按相关度排序的结果列表并去重，保持各列表内部的顺序"""
+    merged = []
+    seen = set()
+    for index in range(max((len(ranking) for ranking in rankings), default=0)):
+        for ranking in rankings:
+            if index < len(ranking) and ranking[index] not in seen:
+                seen.add(ranking[index])
+                merged.append(ranking[index])
+    return merged[:limit] if limit is not None else merged
@@ -0,0 +1,140 @@
+import asyncio
+import itertools
+import logging
+import time
+
+from utils.metrics import SCHEDULER_WAIT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+class _Job:
+    def __init__(self, key, factory, priority):
+        self.key = key
+        self.factory = factory
+        self.priority = priority
+        # waiting: 等待防抖计时；queued: 已进入队列；running/done
+        self.state = 'waiting'
+        self.timer = None
+        # 首次入队时间，不含防抖等待
+        self.enqueued_at = None
+        self.future = asyncio.get_running_loop().create_future()
+        # 后台任务的结果没有人等待，提前取出异常避免 "never retrieved" 警告
+        self.future.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+
+class AnalysisScheduler:
+    """后台分析任务调度器
+
+    - 相同 key 的任务去重：排队中的任务被重复提交时共用同一个结果，
+      同一 key 同时只会有一个任务在运行
+    - 防抖：带 debounce 的提交会延迟入队，期间的重复触发合并为一次
+    - 全局并发上限，priority 数值越小越先执行（所有者请求优先于自动刷新）
+    """
+    PRIORITY_OWNER = 0
+    PRIORITY_BACKGROUND = 10
+
+    def __init__(self, max_concurrency=2):
+        self.max_concurrency = max_concurrency
+        self._queue = asyncio.PriorityQueue()
+        self._counter = itertools.count()
+        # 尚未开始执行的任务，每个 key 最多一个
+        self._pending = {}
+        self._running = set()
+        self._workers = []
+
+    @property
+    def queue_depth(self):
+        """等待执行的任务数（包括防抖中和排队中的任务）"""
+        return len(self._pending)
+
+    @property
+    def running_count(self):
+        return len(self._running)
+
+    def start(self):
+        """启动工作协程，需在事件循环中调用"""
+        if not self._workers:
+            self._workers = [asyncio.create_task(self._worker()) for _ in range(self.max_concurrency)]
+            logger.info("分析调度器已启动，并发上限：%d", self.max_concurrency)
+
+    async def stop(self):
+        """停止工作协程，取消尚未执行的任务"""
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        for job in self._pending.values():
+            if job.timer:
+                job.timer.cancel()
+            job.future.cancel()
+        self._pending.clear()
+        logger.info("分析调度器已停止")
+
+    def submit(self, key, factory, priority=PRIORITY_BACKGROUND, debounce=0):
+        """提交任务，返回可 await 的 future
+
+        factory 是无参数的协程函数，真正执行时才会调用。
+        """
+        job = self._pending.get(key)
+        if job is not None:
+            if priority < job.priority:
+                # 更高优先级的请求：提升优先级，不再等待防抖
+                job.priority = priority
+                job.factory = factory
+                if job.state != 'deferred':
+                    self._enqueue(job)
+            return job.future
+
+        job = _Job(key, factory, priority)
+        self._pending[key] = job
+        if debounce > 0:
+            job.timer = asyncio.get_running_loop().call_later(debounce, self._enqueue, job)
+        else:
+            self._enqueue(job)
+        logger.debug("分析任务已提交：%s，优先级：%d，排队任务数：%d", key, priority, self.queue_depth)
+        return job.future
+
+    def _enqueue(self, job):
+        if job.timer:
+            job.timer.cancel()
+            job.timer = None
+        job.state = 'queued'
+        if job.enqueued_at is None:
+            job.enqueued_at = time.monotonic()
+        # 提升优先级时旧条目仍留在队列中，出队时按 state 和 priority 跳过
+        self._queue.put_nowait((job.priority, next(self._counter), job))
+
+    async def _worker(self):
+        while True:
+            priority, _, job = await self._queue.get()
+            if job.state != 'queued' or priority != job.priority:
+                continue
+            if job.key in self._running:
+                # 同 key 任务正在运行，等它结束后再入队；期间的重复提交仍合并到此任务
+                job.state = 'deferred'
+                continue
+            await self._run(job)
+
+    async def _run(self, job):
+        job.state = 'running'
+        SCHEDULER_WAIT_SECONDS.observe(time.monotonic() - job.enqueued_at)
+        self._pending.pop(job.key, None)
+        self._running.add(job.key)
+        try:
+            result = await job.factory()
+            if not job.future.done():
+                job.future.set_result(result)
+        except asyncio.CancelledError:
+            job.future.cancel()
+            raise
+        except Exception as e:
+            logger.exception("分析任务 %s 执行出错：%s", job.key, e)
+            if not job.future.done():
+                job.future.set_exception(e)
+        finally:
+            job.state = 'done'
+            self._running.discard(job.key)
+            deferred = self._pending.get(job.key)
+            if deferred is not None and deferred.state == 'deferred':
+                self._enqueue(deferred)
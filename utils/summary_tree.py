@@ -0,0 +1,378 @@
+import asyncio
+import bisect
+import logging
+from datetime import datetime, timedelta
+
+from utils.context_builder import build_context, estimate_tokens, truncate_text
+from utils.rate_limiter import RequestGovernor
+
+logger = logging.getLogger(__name__)
+
+DAY = 'day'
+WEEK = 'week'
+MONTH = 'month'
+YEAR = 'year'
+
+# 每一层由哪一层组成
+_CHILD_LEVEL = {WEEK: DAY, MONTH: WEEK, YEAR: MONTH}
+
+
+def _next_month(day):
+    return (day.replace(day=1) + timedelta(days=32)).replace(day=1)
+
+
+def period_start(level, day):
+    """day 所在周期的第一天
+
+    周按月内的第 1–7、8–14、15–21、22–28 日和 29 日至月底划分，不跨月，
+    这样每个月恰好由若干个完整的周组成。
+    """
+    if level == YEAR:
+        return day.replace(month=1, day=1)
+    if level == MONTH:
+        return day.replace(day=1)
+    if level == WEEK:
+        return day - timedelta(days=(day.day - 1) % 7)
+    return day
+
+
+def period_end(level, start):
+    """周期结束后的第一天（不包含）"""
+    if level == YEAR:
+        return start.replace(year=start.year + 1)
+    if level == MONTH:
+        return _next_month(start)
+    if level == WEEK:
+        return min(start + timedelta(days=7), _next_month(start))
+    return start + timedelta(days=1)
+
+
+def children(level, start):
+    """组成该周期的下一层周期 [(层级, 起始日期)]"""
+    child = _CHILD_LEVEL[level]
+    end = period_end(level, start)
+    result = []
+    while start < end:
+        result.append((child, start))
+        start = period_end(child, start)
+    return result
+
+
+def cover(start, end):
+    """把 [start, end) 分解为尽量少的完整周期，按时间排列
+
+    与线段树的区间分解相同：范围内的完整年、月、周直接使用对应的摘要，只有两端
+    不完整的部分才细分到更小的周期，所需的摘要数随范围长度近似对数增长。
+    """
+    nodes = []
+    while start < end:
+        for level in (YEAR, MONTH, WEEK, DAY):
+            if period_start(level, start) == start and period_end(level, start) <= end:
+                nodes.append((level, start))
+                start = period_end(level, start)
+                break
+    return nodes
+
+
+def range_label(first, last):
+    """日期范围的显示文本，first 和 last 都包含在内"""
+    return first.isoformat() if first == last else f"{first.isoformat()} 至 {last.isoformat()}"
+
+
+def period_label(level, start):
+    return range_label(start, period_end(level, start) - timedelta(days=1))
+
+
+class SummaryBuildLimitError(Exception):
+    """范围内缺少的摘要超过单次分析允许生成的数量"""
+
+    def __init__(self, needed, limit):
+        super().__init__(f"需要生成 {needed} 个摘要，超过上限 {limit}")
+        self.needed = needed
+        self.limit = limit
+
+
+class _BuildLimitReached(Exception):
+    pass
+
+
+async def _gather(coroutines):
+    """并发执行，任何一个出错时取消其余的，并原样抛出该异常"""
+    tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+    try:
+        return await asyncio.gather(*tasks)
+    except _BuildLimitReached:
+        # 已开始的摘要继续完成并保存，没开始的在达到上限时各自停止
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+class _Build:
+    """一次构建的状态：按天的消息统计、已保存的摘要和剩余的生成次数"""
+
+    def __init__(self, chat_id, stats, cached, priority, limit=None, progress=None, concurrency=4):
+        self.chat_id = chat_id
+        self.days = sorted(stats)
+        self.stats = stats
+        self.cached = cached
+        self.priority = priority
+        self.limit = limit
+        self.progress = progress
+        # 同时进行的 Gemini 调用数；每次构建单独计数，后台补齐不会占用所有者请求的名额
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.started = 0
+        self.built = 0
+
+    def reserve(self):
+        """开始生成一个摘要，达到 limit 时抛出 _BuildLimitReached"""
+        if self.limit is not None and self.started >= self.limit:
+            raise _BuildLimitReached()
+        self.started += 1
+
+    def is_cached(self, level, start):
+        """该周期的摘要是否已保存且没有过期，周期内没有消息时也返回 True"""
+        count, watermark = self.period_stats(level, start)
+        cached = self.cached.get((level, start))
+        return not count or (cached is not None and cached[1] == count and cached[2] == watermark)
+
+    def period_stats(self, level, start):
+        """周期内的 (消息数, 最大消息ID)"""
+        low = bisect.bisect_left(self.days, start)
+        high = bisect.bisect_left(self.days, period_end(level, start))
+        values = [self.stats[day] for day in self.days[low:high]]
+        return sum(count for count, _ in values), max((max_id for _, max_id in values), default=None)
+
+
+class SummaryTree:
+    """群组聊天的分层时间摘要：日 → 周 → 月 → 年
+
+    - 每个已经结束的周期（今天之前）生成一段摘要并保存在 summaries 表中：日摘要由当天的
+      消息生成，周、月、年摘要由下一层的摘要合并而成，不再读取原始消息
+    - 摘要记录生成时周期内的消息数和最大消息ID，与当前统计不一致时（如导入或同步了更早的
+      消息）重新生成，上层摘要随之重新合并
+    - compose 把任意日期范围分解为尽量少的完整周期，组合缓存的摘要和今天的原始消息，
+      分析长期历史时读取和发送的内容随范围长度近似对数增长
+    """
+    # 各层摘要的目标长度（字）
+    SUMMARY_LENGTH = {DAY: 300, WEEK: 500, MONTH: 800, YEAR: 1200}
+    # 生成摘要时为提示词预留的 token 数
+    PROMPT_TOKENS = 300
+    # 每次构建同时进行的 Gemini 调用数
+    BUILD_CONCURRENCY = 4
+    # 合并摘要最多进行的分组轮数，超过或某一轮没有变短时截断后合并
+    MAX_MERGE_ROUNDS = 4
+
+    def __init__(self, db, gemini, build_limit=50):
+        self.db = db
+        self.gemini = gemini
+        # 后台每次刷新最多生成的摘要数，补齐较长的历史时分多次完成
+        self.build_limit = build_limit
+        # 各群组最近一次补齐摘要的日期
+        self._refreshed = {}
+
+    @staticmethod
+    def today():
+        # 与 get_today_messages 一致，按本地日期划分
+        return datetime.now().date()
+
+    def is_current(self, chat_id):
+        """今天是否已经补齐过该群组的摘要"""
+        return self._refreshed.get(chat_id) == self.today()
+
+    def _build_budget(self):
+        return self.gemini.context_budget - self.PROMPT_TOKENS
+
+    async def _load(self, chat_id, start, end, priority, limit=None, progress=None):
+        stats = await self.db.get_daily_message_stats(chat_id, start, end)
+        cached = await self.db.get_summaries(chat_id, start, end)
+        return _Build(chat_id, stats, cached, priority, limit, progress, self.BUILD_CONCURRENCY)
+
+    async def refresh(self, chat_id, priority=RequestGovernor.PRIORITY_BACKGROUND):
+        """补齐该群组到昨天为止所有周期的摘要，从最近的周期开始
+
+        全部完成时返回 True；生成数达到 build_limit 时返回 False，剩余的留给下一次。
+        """
+        today = self.today()
+        stats = await self.db.get_daily_message_stats(chat_id, end=today)
+        if not stats:
+            self._refreshed[chat_id] = today
+            return True
+
+        start = period_start(YEAR, min(stats))
+        state = await self._load(chat_id, start, today, priority, limit=self.build_limit)
+        try:
+            for level, period in reversed(cover(start, today)):
+                await self._ensure(state, level, period)
+        except _BuildLimitReached:
+            logger.info("群组 %s 已生成 %d 个摘要，剩余的下次继续", chat_id, state.built)
+            return False
+        if state.built:
+            logger.info("群组 %s 的分层摘要已更新，生成了 %d 个摘要", chat_id, state.built)
+        self._refreshed[chat_id] = today
+        return True
+
+    async def compose(self, chat_id, start, end, budget, recent_limit=None,
+                      priority=RequestGovernor.PRIORITY_OWNER, progress=None, build_limit=None):
+        """组合 [start, end) 日期范围内的聊天内容，总长度不超过 budget 个 token
+
+        今天之前的部分使用各周期的摘要（缺少或过期的先并发生成并保存），今天的消息原样附上，
+        最多读取 recent_limit 条。需要生成的摘要超过 build_limit 个时不调用 Gemini，抛出
+        SummaryBuildLimitError。progress 为可选的协程函数，每生成一个摘要后以已生成的
+        数量调用。范围内没有消息时返回 None。
+        """
+        today = self.today()
+        closed_end = min(end, today)
+        parts = []
+        state = None
+        if start < closed_end:
+            state = await self._load(chat_id, start, closed_end, priority, progress=progress)
+            nodes = cover(start, closed_end)
+            needed = sum(self._count_builds(state, level, period) for level, period in nodes)
+            if build_limit is not None and needed > build_limit:
+                raise SummaryBuildLimitError(needed, build_limit)
+            texts = await _gather(self._ensure(state, level, period) for level, period in nodes)
+            for (level, period), text in zip(nodes, texts):
+                if text:
+                    parts.append((period, period_end(level, period) - timedelta(days=1), text))
+            if state.built:
+                logger.info("群组 %s 分析时生成了 %d 个摘要", chat_id, state.built)
+
+        messages = []
+        if end > today:
+            messages = await self.db.get_messages_between(chat_id, max(start, today), end, limit=recent_limit)
+        if not parts and not messages:
+            return None
+
+        sections = []
+        if parts:
+            # 摘要最多占用一半预算，其余留给今天的消息
+            header = f"以下是 {range_label(start, closed_end - timedelta(days=1))} 的分时段总结：\n"
+            summary_budget = (budget // 2 if messages else budget) - estimate_tokens(header)
+            if len(parts) > 1 and estimate_tokens(self._format_parts(parts)) > summary_budget:
+                merged = await self._merge(state, parts, range_label(parts[0][0], parts[-1][1]), YEAR)
+                parts = [(parts[0][0], parts[-1][1], merged)]
+            if estimate_tokens(self._format_parts(parts)) > summary_budget:
+                # 只有一段摘要或合并结果仍然过长时截断
+                first, last, text = parts[0]
+                label_tokens = estimate_tokens(self._format_parts([(first, last, "")]))
+                parts = [(first, last, truncate_text(text, summary_budget - label_tokens))]
+            sections.append(header + self._format_parts(parts))
+        if messages:
+            header = "以下是今天的消息：\n"
+            used_budget = sum(estimate_tokens(section) for section in sections) + estimate_tokens(header)
+            formatted, _ = build_context(messages, budget - used_budget)
+            sections.append(header + formatted)
+        return "\n\n".join(sections)
+
+    def _count_builds(self, state, level, start):
+        """该周期需要生成的摘要数（不调用 Gemini），用于在分析前判断是否超出上限"""
+        if state.is_cached(level, start):
+            return 0
+        if level == DAY:
+            return 1
+        return 1 + sum(self._count_builds(state, child_level, child_start)
+                       for child_level, child_start in children(level, start))
+
+    async def _ensure(self, state, level, start):
+        """返回该周期的摘要，缺少或过期时先生成；周期内没有消息时返回 None"""
+        count, watermark = state.period_stats(level, start)
+        if not count:
+            return None
+        if state.is_cached(level, start):
+            return state.cached[(level, start)][0]
+
+        label = period_label(level, start)
+        if level == DAY:
+            state.reserve()
+            messages = await self.db.get_messages_between(state.chat_id, start, period_end(DAY, start))
+            content = await self._summarize_messages(state, messages, label)
+        else:
+            nodes = children(level, start)
+            texts = await _gather(self._ensure(state, child_level, child_start) for child_level, child_start in nodes)
+            parts = [
+                (child_start, period_end(child_level, child_start) - timedelta(days=1), text)
+                for (child_level, child_start), text in zip(nodes, texts)
+                if text
+            ]
+            state.reserve()
+            # 只有一个下层周期有消息时直接沿用它的摘要
+            if len(parts) == 1:
+                content = parts[0][2]
+            else:
+                content = await self._merge(state, parts, label, level)
+
+        await self.db.store_summary(state.chat_id, level, start, content, count, watermark)
+        state.cached[(level, start)] = (content, count, watermark)
+        state.built += 1
+        logger.debug("已生成群组 %s 的摘要：%s %s，%d 条消息", state.chat_id, level, label, count)
+        if state.progress is not None:
+            await state.progress(state.built)
+        return content
+
+    async def _summarize_messages(self, state, messages, label):
+        """总结一天的消息，超出单次请求的预算时分段总结后再合并"""
+        budget = self._build_budget()
+        max_length = self.SUMMARY_LENGTH[DAY]
+        parts = []
+        while messages:
+            formatted, used = build_context(messages, budget, keep='oldest')
+            async with state.semaphore:
+                parts.append(await self.gemini.summarize_period(formatted, label, max_length, state.priority))
+            messages = messages[used:]
+        if len(parts) == 1:
+            return parts[0]
+        async with state.semaphore:
+            return await self.gemini.merge_summaries(
+                truncate_text("\n\n".join(parts), budget), label, max_length, state.priority
+            )
+
+    async def _merge(self, state, parts, label, level):
+        """合并按时间排列的多段摘要，超出单次请求的预算时先分组合并
+
+        分组合并最多进行 MAX_MERGE_ROUNDS 轮；某一轮没有使总长度变短时不再分组，
+        截断到单次请求的预算后直接合并。
+        """
+        max_length = self.SUMMARY_LENGTH[level]
+        budget = self._build_budget()
+
+        async def merge(group, group_label):
+            async with state.semaphore:
+                return await self.gemini.merge_summaries(
+                    truncate_text(self._format_parts(group), budget), group_label, max_length, state.priority
+                )
+
+        size = estimate_tokens(self._format_parts(parts))
+        for _ in range(self.MAX_MERGE_ROUNDS):
+            groups = self._pack(parts, budget)
+            if len(groups) == 1:
+                break
+            texts = await _gather(merge(group, range_label(group[0][0], group[-1][1])) for group in groups)
+            merged = [(group[0][0], group[-1][1], text) for group, text in zip(groups, texts)]
+            merged_size = estimate_tokens(self._format_parts(merged))
+            if merged_size >= size:
+                logger.warning("合并 %s 的摘要时长度没有缩短（%d -> %d token），截断后合并", label, size, merged_size)
+                break
+            parts, size = merged, merged_size
+        return await merge(parts, label)
+
+    @staticmethod
+    def _format_parts(parts):
+        return "\n\n".join(f"[{range_label(first, last)}]\n{text}" for first, last, text in parts)
+
+    def _pack(self, parts, budget):
+        """按顺序把摘要分组，每组的长度不超过 budget"""
+        groups = [[]]
+        used = 0
+        for part in parts:
+            cost = estimate_tokens(self._format_parts([part])) + 2
+            if groups[-1] and used + cost > budget:
+                groups.append([])
+                used = 0
+            groups[-1].append(part)
+            used += cost
+        return groups